@@ -0,0 +1,537 @@
+'''
+Builds the targets of the Makefile in parallel and caches their outputs.
+
+AX51 mixes up DEFINE() inputs when several instances run at once, which
+is why the Makefile is .NOTPARALLEL. The likely cause is the temp
+directory: wine sets %TEMP% from the registry of its prefix, not from the
+environment, so all instances in one prefix share it. Here every worker
+runs the Keil tools in a wine prefix of its own, a copy of WINEPREFIX in
+build/wine with the Keil directory linked, and every target is assembled,
+linked and converted in a directory of its own, so targets build on all
+cores:
+
+    python3 tools/buildmatrix.py                         # like make all
+    python3 tools/buildmatrix.py --layout A --mcu H --deadtime 5 --pwm 24
+    python3 tools/buildmatrix.py --stub --jobs 8         # without Keil
+
+The .OBJ, .OMF and .hex files of every target are kept in a content
+addressed cache (build/cache). The key of a target is made of its DEFINE()
+values, the tools and flags and the hashes of the files it includes, so
+after a change only the targets that include a changed file are built
+again. Which files a target includes is found with the preprocessor of
+tools/cycles and remembered until one of them changes.
+
+Outputs are named and placed like the Makefile places them, hex files in
+build/hex. --stub replaces the Keil tools with tools/keilstub.py.
+
+Parallel builds were only checked with --stub, the Keil tools were not
+available. If outputs of the real tools differ from make all, compare them
+with tools/comparehex.py and build with --jobs 1.
+'''
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+toolsDir = os.path.dirname(os.path.abspath(__file__))
+rootDir = os.path.dirname(toolsDir)
+
+sys.path.insert(0, os.path.join(toolsDir, "cycles"))
+from cycles import configuration, mcuTypes, pwmFrequencies
+from preprocessor import Preprocessor, PreprocessorError
+
+# Target parameters, like the Makefile
+layouts = ["A", "B", "C", "D", "E", "F", "G", "H", "I", "J", "K", "L", "M", "N", "O", "P", "Q", "R", "S",
+           "T", "U", "V", "W", "Z", "OA"]
+mcus = ["H"]
+layoutsX = ["A", "B", "C", "D", "E"]
+mcusX = ["X"]
+deadtimes = [0, 5, 10, 15, 20, 25, 30, 40, 50, 70, 90, 120]
+pwms = [24, 48, 96]
+
+ax51Flags = "NOMOD51 REGISTERBANK(0,1,2) NOLIST NOSYMBOLS"
+lx51Flags = ""
+
+# Outputs kept in the cache, the listing and map are only left by fresh builds
+cachedOutputs = ["OBJ", "OMF", "hex"]
+
+# Version of the cache layout and key
+cacheVersion = 1
+
+Target = collections.namedtuple("Target", ["layout", "mcu", "deadtime", "pwm"])
+Job = collections.namedtuple("Job", [
+    "target", "name", "source", "settingsDir", "outputDir", "hexDir", "cacheDir",
+    "tools", "toolsHash", "hashes", "dependencies",
+])
+Outcome = collections.namedtuple("Outcome", ["target", "status", "seconds", "log"])
+
+errorPattern = re.compile(r"\*\*\* (ERROR|WARNING)")
+
+# Wine prefix of this worker process, see initWorker
+workerPrefix = None
+
+class BuildError(Exception):
+    pass
+
+def matrix():
+    '''
+    Yields all targets of make all.
+    '''
+    for layoutList, mcuList in [(layouts, mcus), (layoutsX, mcusX)]:
+        for layout in layoutList:
+            for mcu in mcuList:
+                for deadtime in deadtimes:
+                    for pwm in pwms:
+                        # L mcus can not do 96kHz
+                        if mcu == "L" and pwm == 96:
+                            continue
+
+                        yield Target(layout, mcu, deadtime, pwm)
+
+def targetId(target):
+    return "%s_%s_%d_%d" % target
+
+def fileHash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 16), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+def relativePath(path):
+    return os.path.relpath(os.path.abspath(path), rootDir).replace(os.sep, "/")
+
+def hashTree(directories):
+    '''
+    Returns the hashes of all files below directories by relative path.
+    '''
+    hashes = {}
+    for directory in directories:
+        for dirPath, dirNames, fileNames in os.walk(directory):
+            for fileName in fileNames:
+                path = os.path.join(dirPath, fileName)
+                hashes.setdefault(relativePath(path), fileHash(path))
+
+    return hashes
+
+def toolCommands(args):
+    if args.stub:
+        stub = [sys.executable, os.path.join(toolsDir, "keilstub.py")]
+        return {"ax51": stub + ["ax51"], "lx51": stub + ["lx51"], "ohx51": stub + ["ohx51"]}
+
+    keilPath = os.path.expanduser(args.keilPath)
+    wine = [args.wine] if args.wine else []
+    return {
+        "ax51": wine + [os.path.join(keilPath, "AX51.exe")],
+        "lx51": wine + [os.path.join(keilPath, "LX51.exe")],
+        "ohx51": wine + [os.path.join(keilPath, "Ohx51.exe")],
+    }
+
+def toolsHash(tools):
+    '''
+    Hash of the tool commands, their binaries and flags.
+    '''
+    digest = hashlib.sha256(json.dumps([cacheVersion, tools, ax51Flags, lx51Flags], sort_keys=True).encode())
+    for command in sorted(tools.values()):
+        for part in command:
+            if os.path.isfile(part):
+                digest.update(fileHash(part).encode())
+
+    return digest.hexdigest()
+
+def cacheKey(job, dependencies):
+    key = {
+        "tools": job.toolsHash,
+        "defines": sorted(configuration(job.target).items()),
+        "sources": sorted(dependencies.items()),
+    }
+    return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+
+def manifestPath(cacheDir, target):
+    return os.path.join(cacheDir, "manifests", targetId(target) + ".json")
+
+def loadManifest(cacheDir, target, hashes):
+    '''
+    Returns the dependencies a target had on its last build or None if
+    one of them changed since.
+    '''
+    try:
+        with open(manifestPath(cacheDir, target), 'r') as file:
+            dependencies = json.load(file)["dependencies"]
+
+    except (OSError, ValueError, KeyError):
+        return None
+
+    for path, digest in dependencies.items():
+        if hashes.get(path) != digest:
+            return None
+
+    return dependencies
+
+def saveManifest(cacheDir, target, dependencies):
+    path = manifestPath(cacheDir, target)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = "%s.%d" % (path, os.getpid())
+    with open(temporary, 'w') as file:
+        json.dump({"dependencies": dependencies}, file, indent=2, sort_keys=True)
+
+    os.replace(temporary, path)
+
+def scanDependencies(job):
+    '''
+    Returns the hashes of the files the target includes by relative path.
+
+    If the preprocessor can not follow the sources every file counts.
+    '''
+    preprocessor = Preprocessor(configuration(job.target), [job.settingsDir])
+    try:
+        for _ in preprocessor.run(job.source):
+            pass
+
+    except PreprocessorError:
+        return dict(job.hashes)
+
+    dependencies = {}
+    for path in preprocessor.includes:
+        relative = relativePath(path)
+        dependencies[relative] = job.hashes.get(relative) or fileHash(path)
+
+    return dependencies
+
+def objectDir(cacheDir, key):
+    return os.path.join(cacheDir, "objects", key[:2], key)
+
+def outputPaths(job):
+    paths = {}
+    for extension in cachedOutputs:
+        directory = job.hexDir if extension == "hex" else job.outputDir
+        paths[extension] = os.path.join(directory, "%s.%s" % (job.name, extension))
+
+    return paths
+
+def restore(job, key):
+    '''
+    Copies the cached outputs of key to the output directories, returns
+    False if they are not cached.
+    '''
+    directory = objectDir(job.cacheDir, key)
+    if not all(os.path.isfile(os.path.join(directory, "target." + extension)) for extension in cachedOutputs):
+        return False
+
+    for extension, path in outputPaths(job).items():
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(os.path.join(directory, "target." + extension), path)
+
+    return True
+
+def store(job, key, workDir):
+    '''
+    Moves the outputs of a build into the cache.
+    '''
+    directory = objectDir(job.cacheDir, key)
+    os.makedirs(os.path.dirname(directory), exist_ok=True)
+    temporary = tempfile.mkdtemp(dir=os.path.dirname(directory))
+    for extension in cachedOutputs:
+        shutil.copyfile(os.path.join(workDir, "%s.%s" % (job.name, extension)),
+                        os.path.join(temporary, "target." + extension))
+
+    try:
+        os.rename(temporary, directory)
+
+    except OSError:
+        # Another build stored the same key first
+        shutil.rmtree(temporary, ignore_errors=True)
+
+def excerpt(path, before=0, after=0):
+    '''
+    Lines around errors and warnings of a listing or map, like grep -B/-A.
+    '''
+    try:
+        with open(path, 'r', errors='replace') as file:
+            lines = file.read().splitlines()
+
+    except OSError:
+        return "%s is missing" % os.path.basename(path)
+
+    selected = []
+    for index, line in enumerate(lines):
+        if errorPattern.search(line):
+            selected.extend(lines[max(0, index - before):index + after + 1])
+
+    return "\n".join(selected)
+
+def run(command, workDir, environment):
+    return subprocess.run(command, cwd=workDir, env=environment, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.DEVNULL).returncode
+
+def assemble(job, workDir):
+    '''
+    Runs AX51, LX51 and Ohx51 like the Makefile in workDir.
+    '''
+    temporary = os.path.join(workDir, "tmp")
+    os.makedirs(temporary)
+    environment = dict(os.environ, TMPDIR=temporary, WINEDEBUG="-all")
+    if workerPrefix:
+        environment["WINEPREFIX"] = workerPrefix
+
+    # Sources are reached through links, so the tools see the same relative paths as with make
+    os.symlink(os.path.dirname(os.path.abspath(job.source)), os.path.join(workDir, "src"))
+    os.symlink(os.path.abspath(job.settingsDir), os.path.join(workDir, "settings"))
+
+    defines = ["DEFINE(%s=%d) " % item for item in configuration(job.target).items()]
+    command = job.tools["ax51"] + ["src/" + os.path.basename(job.source), "INCDIR(settings) "] + defines + [
+        "OBJECT(%s.OBJ) " % job.name, "PRINT(%s.LST) " % job.name, ax51Flags]
+    if run(command, workDir, environment) != 0:
+        raise BuildError(excerpt(os.path.join(workDir, job.name + ".LST"), before=3))
+
+    command = job.tools["lx51"] + [job.name + ".OBJ", "TO", job.name + ".OMF"] + ([lx51Flags] if lx51Flags else [])
+    mapPath = os.path.join(workDir, job.name.upper() + ".MAP")
+
+    # Linking should produce exactly 1 warning
+    status = run(command, workDir, environment)
+    try:
+        with open(mapPath, 'r', errors='replace') as file:
+            linked = status < 2 and "1 WARNING" in file.read()
+
+    except OSError:
+        linked = False
+
+    if not linked:
+        raise BuildError(excerpt(mapPath, after=3))
+
+    command = job.tools["ohx51"] + [job.name + ".OMF", "HEXFILE (%s.hex)" % job.name]
+    if run(command, workDir, environment) != 0:
+        raise BuildError("Could not make hex file")
+
+def buildTarget(job):
+    '''
+    Restores one target from the cache or builds and caches it.
+    '''
+    start = time.perf_counter()
+    dependencies = job.dependencies
+    if dependencies is None:
+        dependencies = scanDependencies(job)
+        saveManifest(job.cacheDir, job.target, dependencies)
+
+    key = cacheKey(job, dependencies)
+    if restore(job, key):
+        return Outcome(job.target, "cached", time.perf_counter() - start, None)
+
+    workDir = tempfile.mkdtemp(prefix=targetId(job.target) + "-")
+    try:
+        assemble(job, workDir)
+        store(job, key, workDir)
+        for extension in ["LST", "MAP"]:
+            name = "%s.%s" % (job.name.upper() if extension == "MAP" else job.name, extension)
+            if os.path.isfile(os.path.join(workDir, name)):
+                shutil.copyfile(os.path.join(workDir, name), os.path.join(job.outputDir, name))
+
+        restore(job, key)
+        return Outcome(job.target, "built", time.perf_counter() - start, None)
+
+    except (BuildError, OSError) as e:
+        return Outcome(job.target, "failed", time.perf_counter() - start, str(e))
+
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+def preparePrefixes(basePrefix, keilPath, directory, count):
+    '''
+    Returns count wine prefixes in directory, copies of basePrefix.
+
+    The Keil directory is linked instead of copied. Copies are made again
+    when the registry of basePrefix changed.
+    '''
+    basePrefix = os.path.realpath(os.path.expanduser(basePrefix))
+    keilPath = os.path.realpath(os.path.expanduser(keilPath))
+    stamp = json.dumps([basePrefix] + [os.path.getmtime(os.path.join(basePrefix, name))
+                                       for name in ["system.reg", "user.reg"]])
+
+    # Top directory of the Keil installation in drive_c, e.g. Keil_v5
+    linked = None
+    driveC = os.path.join(basePrefix, "drive_c")
+    if keilPath.startswith(driveC + os.sep):
+        linked = os.path.join(driveC, os.path.relpath(keilPath, driveC).split(os.sep)[0])
+
+    def ignore(path, names):
+        return [name for name in names if os.path.join(os.path.realpath(path), name) == linked]
+
+    prefixes = []
+    for index in range(count):
+        prefix = os.path.join(directory, str(index))
+        stampPath = os.path.join(prefix, ".buildmatrix")
+        try:
+            with open(stampPath, 'r') as file:
+                current = file.read() == stamp
+
+        except OSError:
+            current = False
+
+        if not current:
+            shutil.rmtree(prefix, ignore_errors=True)
+            shutil.copytree(basePrefix, prefix, symlinks=True, ignore=ignore)
+            if linked:
+                os.symlink(linked, os.path.join(prefix, os.path.relpath(linked, basePrefix)))
+
+            with open(stampPath, 'w') as file:
+                file.write(stamp)
+
+        prefixes.append(prefix)
+
+    return prefixes
+
+def initWorker(prefixes):
+    '''
+    Takes a wine prefix of its own for this worker process.
+    '''
+    global workerPrefix
+    workerPrefix = prefixes.get()
+
+def selectTargets(args):
+    selected = []
+    for target in matrix():
+        if args.layouts and target.layout not in args.layouts:
+            continue
+
+        if args.mcus and target.mcu not in args.mcus:
+            continue
+
+        if args.deadtimes and target.deadtime not in args.deadtimes:
+            continue
+
+        if args.pwms and target.pwm not in args.pwms:
+            continue
+
+        selected.append(target)
+
+    return selected
+
+def gitVersion():
+    try:
+        return subprocess.run(["git", "describe", "--tags", "--abbrev=0"], cwd=rootDir, capture_output=True,
+                              text=True).stdout.strip()
+
+    except OSError:
+        return ""
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description="Build Bluejay targets in parallel with a cache.")
+    parser.add_argument("--layout", dest="layouts", nargs="+", type=str.upper,
+                        default=None, help="only build these layouts")
+    parser.add_argument("--mcu", dest="mcus", nargs="+", type=str.upper, choices=sorted(mcuTypes),
+                        default=None, help="only build these mcus")
+    parser.add_argument("--deadtime", dest="deadtimes", nargs="+", type=int,
+                        default=None, help="only build these dead times")
+    parser.add_argument("--pwm", dest="pwms", nargs="+", type=int, choices=sorted(pwmFrequencies),
+                        default=None, help="only build these pwm frequencies")
+    parser.add_argument("--version", dest="version",
+                        default=None, help="version in the file names, default is the latest git tag")
+    parser.add_argument("--source", dest="source",
+                        default=os.path.join(rootDir, "src", "Bluejay.asm"), help="main source file")
+    parser.add_argument("--settings-dir", dest="settingsDir",
+                        default=os.path.join(rootDir, "src", "Settings"), help="like SETTINGSDIR of the Makefile")
+    parser.add_argument("--output-dir", dest="outputDir",
+                        default=os.path.join(rootDir, "build"), help="like OUTPUT_DIR of the Makefile")
+    parser.add_argument("--cache", dest="cache",
+                        default=None, help="cache directory, default is OUTPUT_DIR/cache")
+    parser.add_argument("--no-cache", dest="noCache", action="store_true",
+                        default=False, help="build every target again")
+    parser.add_argument("--jobs", "-j", dest="jobs", type=int,
+                        default=os.cpu_count() or 1, help="targets built at the same time")
+    parser.add_argument("--keil-path", dest="keilPath",
+                        default=os.environ.get("KEIL_PATH", "~/.wine/drive_c/Keil_v5/C51/BIN"),
+                        help="path to the Keil binaries")
+    parser.add_argument("--wine", dest="wine",
+                        default="wine", help="runs the Keil binaries, empty to run them directly")
+    parser.add_argument("--wine-prefix", dest="winePrefix",
+                        default=os.environ.get("WINEPREFIX", "~/.wine"),
+                        help="wine prefix with the Keil tools, copied for every worker")
+    parser.add_argument("--stub", dest="stub", action="store_true",
+                        default=False, help="use tools/keilstub.py instead of the Keil tools")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parseArgs(argv)
+    start = time.perf_counter()
+    targets = selectTargets(args)
+    if not targets:
+        print("No targets selected")
+        return 2
+
+    tools = toolCommands(args)
+    if not args.stub:
+        for command in tools.values():
+            if not os.path.isfile(command[-1]):
+                print("Could not find %s. Make sure to set the correct paths to the Keil binaries" % command[-1])
+                return 2
+
+    version = args.version if args.version is not None else gitVersion()
+    outputDir = os.path.abspath(args.outputDir)
+    cacheDir = os.path.abspath(args.cache or os.path.join(outputDir, "cache"))
+    if args.noCache:
+        cacheDir = tempfile.mkdtemp(prefix="bluejay-cache-")
+
+    hashes = hashTree([os.path.dirname(os.path.abspath(args.source)), args.settingsDir])
+    toolsDigest = toolsHash(tools)
+    os.makedirs(outputDir, exist_ok=True)
+
+    # Targets whose includes did not change are restored right away
+    outcomes = []
+    jobs = []
+    for target in targets:
+        job = Job(target, "%s_%s" % (targetId(target), version), os.path.abspath(args.source),
+                  os.path.abspath(args.settingsDir), outputDir, os.path.join(outputDir, "hex"), cacheDir,
+                  tools, toolsDigest, hashes, None)
+        dependencies = loadManifest(cacheDir, target, hashes)
+        if dependencies is not None:
+            job = job._replace(dependencies=dependencies)
+            if restore(job, cacheKey(job, dependencies)):
+                outcomes.append(Outcome(target, "cached", 0.0, None))
+                continue
+
+        jobs.append(job)
+
+    # Every worker gets a wine prefix of its own
+    jobCount = max(1, min(args.jobs, len(jobs)))
+    prefixes = multiprocessing.Queue()
+    if jobs and not args.stub and args.wine:
+        for prefix in preparePrefixes(args.winePrefix, args.keilPath, os.path.join(outputDir, "wine"), jobCount):
+            prefixes.put(prefix)
+
+    else:
+        for _ in range(jobCount):
+            prefixes.put(None)
+
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobCount, initializer=initWorker,
+                                                    initargs=(prefixes,)) as executor:
+            futures = [executor.submit(buildTarget, job) for job in jobs]
+            for future in concurrent.futures.as_completed(futures):
+                outcome = future.result()
+                outcomes.append(outcome)
+                print("%-7s %-14s %.2fs" % (outcome.status, targetId(outcome.target), outcome.seconds))
+                if outcome.log:
+                    print(outcome.log)
+
+    finally:
+        if args.noCache:
+            shutil.rmtree(cacheDir, ignore_errors=True)
+
+    counts = collections.Counter(outcome.status for outcome in outcomes)
+    print("%d targets in %.2fs (%d jobs): %d built, %d cached, %d failed" % (
+        len(outcomes), time.perf_counter() - start, args.jobs, counts["built"], counts["cached"], counts["failed"]))
+
+    return 1 if counts["failed"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,263 @@
+'''
+Compares two directories of hex files, e.g. the build/hex of two commits:
+
+    python3 tools/comparehex.py build/hex build_before/hex
+
+Files are paired by LAYOUT_MCU_DEADTIME_PWM, so builds of different
+versions can be compared. Both directories are hashed in parallel and
+only files whose hashes differ are loaded. Their images are compared byte
+by byte, gaps count as erased flash (0FFh), and every range of differing
+addresses is reported with the region of the flash it falls in:
+
+    B_H_5_24: 2 ranges, 3 bytes
+      0x0412-0x0413  app code       2 bytes
+      0x1A0B-0x1A0B  settings       1 byte
+
+Two single hex files can be compared the same way. Exits with 1 if
+anything differs.
+'''
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
+import re
+import sys
+
+namePattern = re.compile(r"^([A-Z]+)_([A-Z])_(\d+)_(\d+)(?:_.*)?\.hex$", re.IGNORECASE)
+
+# Code space layout of src/Modules/Codespace.asm, start address and region.
+# Code ends at CSEG_RESET, the startup melody takes MELODY_SIZE (140) bytes
+# from CSEG_MELODY on, see src/Modules/Eeprom.asm.
+regionsBB2 = [
+    (0x0000, "app code"),
+    (0x1A00, "settings"),
+    (0x1A40, "layout tag"),
+    (0x1A50, "mcu tag"),
+    (0x1A60, "name"),
+    (0x1A70, "melody"),
+    (0x1AFC, "unused"),
+    (0x1C00, "bootloader"),
+]
+regionsBB51 = [
+    (0x0000, "app code"),
+    (0x3000, "settings"),
+    (0x3040, "layout tag"),
+    (0x3050, "mcu tag"),
+    (0x3060, "name"),
+    (0x3070, "melody"),
+    (0x30FC, "unused"),
+    (0xF000, "bootloader"),
+]
+
+Range = collections.namedtuple("Range", ["start", "end", "region"])
+
+class HexError(Exception):
+    pass
+
+def targetKey(fileName):
+    '''
+    LAYOUT_MCU_DEADTIME_PWM of a hex file name without its version.
+    '''
+    match = namePattern.match(fileName)
+    if not match:
+        return os.path.splitext(fileName)[0]
+
+    layout, mcu, deadtime, pwm = match.groups()
+    return "%s_%s_%s_%s" % (layout.upper(), mcu.upper(), deadtime, pwm)
+
+def regionsOf(key):
+    parts = key.split("_")
+    return regionsBB51 if len(parts) > 1 and parts[1] == "X" else regionsBB2
+
+def fileHash(path):
+    with open(path, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+def collect(directory):
+    '''
+    Returns the hex files of a directory by target key.
+    '''
+    files = {}
+    duplicates = []
+    for fileName in sorted(os.listdir(directory)):
+        if not fileName.lower().endswith(".hex"):
+            continue
+
+        key = targetKey(fileName)
+        if key in files:
+            duplicates.append(fileName)
+            continue
+
+        files[key] = os.path.join(directory, fileName)
+
+    return files, duplicates
+
+def loadImage(path):
+    '''
+    Returns the bytes of an Intel hex file by address.
+    '''
+    image = {}
+    base = 0
+    with open(path, 'r') as file:
+        for number, line in enumerate(file, 1):
+            line = line.strip()
+            if not line:
+                continue
+
+            try:
+                if not line.startswith(":"):
+                    raise ValueError
+
+                record = bytes.fromhex(line[1:])
+
+            except ValueError:
+                raise HexError("%s:%d: no hex record" % (path, number))
+
+            if len(record) < 5 or len(record) != record[0] + 5 or sum(record) & 0xFF:
+                raise HexError("%s:%d: broken hex record" % (path, number))
+
+            address = (record[1] << 8) | record[2]
+            kind = record[3]
+            data = record[4:-1]
+            if kind == 0:
+                for offset, value in enumerate(data):
+                    image[base + address + offset] = value
+
+            elif kind == 1:
+                break
+
+            elif kind == 2:
+                base = int.from_bytes(data, "big") << 4
+
+            elif kind == 4:
+                base = int.from_bytes(data, "big") << 16
+
+    return image
+
+def differences(imageA, imageB, regions):
+    '''
+    Returns the ranges of addresses whose bytes differ, split at region
+    boundaries.
+    '''
+    addresses = sorted(address for address in set(imageA) | set(imageB)
+                       if imageA.get(address, 0xFF) != imageB.get(address, 0xFF))
+    starts = [start for start, _ in regions]
+
+    def regionIndex(address):
+        index = 0
+        while index + 1 < len(starts) and starts[index + 1] <= address:
+            index += 1
+
+        return index
+
+    ranges = []
+    for address in addresses:
+        index = regionIndex(address)
+        if ranges and ranges[-1].end == address - 1 and regionIndex(ranges[-1].end) == index:
+            ranges[-1] = ranges[-1]._replace(end=address)
+
+        else:
+            ranges.append(Range(address, address, regions[index][1]))
+
+    return ranges
+
+def compareFiles(key, pathA, pathB):
+    try:
+        return differences(loadImage(pathA), loadImage(pathB), regionsOf(key))
+
+    except (HexError, OSError) as e:
+        return str(e)
+
+def hashAll(paths, jobs):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        return dict(zip(paths, executor.map(fileHash, paths)))
+
+def formatSize(count):
+    return "%d byte%s" % (count, "" if count == 1 else "s")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare two directories of Bluejay hex files.")
+    parser.add_argument("source", metavar="SOURCE",
+                        help="directory or hex file of the new build")
+    parser.add_argument("target", metavar="TARGET",
+                        help="directory or hex file to compare with")
+    parser.add_argument("--jobs", "-j", dest="jobs", type=int,
+                        default=os.cpu_count() or 1, help="files hashed at the same time")
+    parser.add_argument("--max-ranges", dest="maxRanges", type=int,
+                        default=10, help="ranges printed per file, 0 prints all")
+    parser.add_argument("--json", dest="json",
+                        default=None, help="also store the differences as json")
+    args = parser.parse_args(argv)
+
+    if os.path.isfile(args.source) and os.path.isfile(args.target):
+        key = targetKey(os.path.basename(args.target))
+        sourceFiles, targetFiles, duplicates = {key: args.source}, {key: args.target}, []
+
+    elif os.path.isdir(args.source) and os.path.isdir(args.target):
+        sourceFiles, sourceDuplicates = collect(args.source)
+        targetFiles, targetDuplicates = collect(args.target)
+        duplicates = sourceDuplicates + targetDuplicates
+
+    else:
+        parser.error("SOURCE and TARGET have to be two directories or two files")
+
+    for fileName in duplicates:
+        print("Ignoring %s, another version of it is compared" % fileName)
+
+    common = sorted(set(sourceFiles) & set(targetFiles))
+    hashes = hashAll([sourceFiles[key] for key in common] + [targetFiles[key] for key in common], max(1, args.jobs))
+    changed = [key for key in common if hashes[sourceFiles[key]] != hashes[targetFiles[key]]]
+
+    # Hex files can differ in their records only, those count as matching
+    different = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        results = executor.map(compareFiles, changed, [sourceFiles[key] for key in changed],
+                               [targetFiles[key] for key in changed])
+        for key, result in zip(changed, results):
+            if result:
+                different[key] = result
+
+    for key in sorted(different):
+        result = different[key]
+        if isinstance(result, str):
+            print("%s: %s" % (key, result))
+            continue
+
+        print("%s: %d ranges, %s" % (key, len(result), formatSize(sum(r.end - r.start + 1 for r in result))))
+        shown = result if args.maxRanges <= 0 else result[:args.maxRanges]
+        for r in shown:
+            print("  0x%04X-0x%04X  %-12s %s" % (r.start, r.end, r.region, formatSize(r.end - r.start + 1)))
+
+        if len(shown) < len(result):
+            print("  ... %d more" % (len(result) - len(shown)))
+
+    newFiles = sorted(set(sourceFiles) - set(targetFiles))
+    missingFiles = sorted(set(targetFiles) - set(sourceFiles))
+    for key in missingFiles:
+        print("Missing in %s: %s" % (args.source, os.path.basename(targetFiles[key])))
+
+    print("Total files: %d; New files: %d" % (len(sourceFiles), len(newFiles)))
+    if different:
+        print("Different: %d/%d" % (len(different), len(common)))
+
+    else:
+        print("All existing files match!")
+
+    if args.json:
+        report = {
+            "compared": len(common),
+            "new": [os.path.basename(sourceFiles[key]) for key in newFiles],
+            "missing": [os.path.basename(targetFiles[key]) for key in missingFiles],
+            "different": dict((key, result if isinstance(result, str) else [
+                {"start": r.start, "end": r.end, "region": r.region} for r in result
+            ]) for key, result in different.items()),
+        }
+        with open(args.json, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    return 1 if different else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
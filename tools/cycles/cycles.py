@@ -0,0 +1,588 @@
+'''
+Static best and worst case cycle counts of the interrupt routines and the
+routines they share the timing budget with.
+
+The sources are preprocessed for one build configuration, given like the
+Makefile takes it (--layout, --mcu, --deadtime, --pwm). Every routine is
+followed from its label along all branches until ret or reti, calls add
+the cycles of the called routine. Counts are SYSCLK cycles from the
+CIP-51 instruction table of the EFM8 reference manuals. Flash wait
+states, the interrupt response and the jump in the interrupt vector are
+not included. Loops are counted once and marked in the report.
+
+Reported are the interrupt routines, every routine that is called and
+every label behind a banner that is not reached by falling through, in
+the files given with --file (Isrs.asm, DShot.asm and Commutation.asm by
+default). Store a report with --json and compare against it with
+--baseline to fail when a change adds worst case cycles:
+
+    python3 tools/cycles/cycles.py --json /tmp/base.json    # on the base commit
+    python3 tools/cycles/cycles.py --baseline /tmp/base.json
+'''
+import argparse
+import collections
+import json
+import os
+import sys
+
+from preprocessor import Preprocessor, PreprocessorError, lexer
+
+srcDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src")
+defaultFiles = ["Isrs.asm", "DShot.asm", "Commutation.asm"]
+
+# Clock cycles of the CIP-51 core, conditional branches list not taken/taken.
+# The generic JMP and CALL become the short or the long form depending on
+# the distance, so they list both.
+instructionTable = '''
+ADD A,Rn 1
+ADD A,direct 2
+ADD A,@Ri 2
+ADD A,#data 2
+ADDC A,Rn 1
+ADDC A,direct 2
+ADDC A,@Ri 2
+ADDC A,#data 2
+SUBB A,Rn 1
+SUBB A,direct 2
+SUBB A,@Ri 2
+SUBB A,#data 2
+INC A 1
+INC Rn 1
+INC direct 2
+INC @Ri 2
+DEC A 1
+DEC Rn 1
+DEC direct 2
+DEC @Ri 2
+INC DPTR 1
+MUL AB 4
+DIV AB 8
+DA A 1
+ANL A,Rn 1
+ANL A,direct 2
+ANL A,@Ri 2
+ANL A,#data 2
+ANL direct,A 2
+ANL direct,#data 3
+ORL A,Rn 1
+ORL A,direct 2
+ORL A,@Ri 2
+ORL A,#data 2
+ORL direct,A 2
+ORL direct,#data 3
+XRL A,Rn 1
+XRL A,direct 2
+XRL A,@Ri 2
+XRL A,#data 2
+XRL direct,A 2
+XRL direct,#data 3
+CLR A 1
+CPL A 1
+RL A 1
+RLC A 1
+RR A 1
+RRC A 1
+SWAP A 1
+MOV A,Rn 1
+MOV A,direct 2
+MOV A,@Ri 2
+MOV A,#data 2
+MOV Rn,A 1
+MOV Rn,direct 2
+MOV Rn,#data 2
+MOV direct,A 2
+MOV direct,Rn 2
+MOV direct,direct 3
+MOV direct,@Ri 2
+MOV direct,#data 3
+MOV @Ri,A 2
+MOV @Ri,direct 2
+MOV @Ri,#data 2
+MOV DPTR,#data 3
+MOVC A,@A+DPTR 3
+MOVC A,@A+PC 3
+MOVX A,@Ri 3
+MOVX @Ri,A 3
+MOVX A,@DPTR 3
+MOVX @DPTR,A 3
+PUSH direct 2
+POP direct 2
+XCH A,Rn 1
+XCH A,direct 2
+XCH A,@Ri 2
+XCHD A,@Ri 2
+CLR C 1
+CLR bit 2
+SETB C 1
+SETB bit 2
+CPL C 1
+CPL bit 2
+ANL C,bit 2
+ANL C,/bit 2
+ORL C,bit 2
+ORL C,/bit 2
+MOV C,bit 2
+MOV bit,C 2
+JC rel 2/3
+JNC rel 2/3
+JB bit,rel 3/4
+JNB bit,rel 3/4
+JBC bit,rel 3/4
+ACALL addr 3
+LCALL addr 4
+CALL addr 3-4
+RET 5
+RETI 5
+AJMP addr 3
+LJMP addr 4
+SJMP rel 3
+JMP addr 3-4
+JMP @A+DPTR 3
+JZ rel 2/3
+JNZ rel 2/3
+CJNE A,direct,rel 3/4
+CJNE A,#data,rel 3/4
+CJNE Rn,#data,rel 3/4
+CJNE @Ri,#data,rel 4/5
+DJNZ Rn,rel 2/3
+DJNZ direct,rel 3/4
+NOP 1
+'''
+
+returns = frozenset(["RET", "RETI"])
+jumps = frozenset(["SJMP", "AJMP", "LJMP", "JMP"])
+calls = frozenset(["ACALL", "LCALL", "CALL"])
+branches = frozenset(["JZ", "JNZ", "JC", "JNC", "JB", "JNB", "JBC", "CJNE", "DJNZ"])
+fixedOperands = frozenset(["A", "C", "AB", "DPTR", "@DPTR", "@A+DPTR", "@A+PC"])
+registers = frozenset(["R%d" % index for index in range(8)])
+
+# Interrupt vectors are at 3 + 8 * n below the application code
+vectorLimit = 0x80
+
+# Makefile names of the build configuration
+mcuTypes = {"L": 0, "H": 1, "X": 2}
+pwmFrequencies = {24: 0, 48: 1, 96: 2}
+
+def parseCycles(text):
+    '''
+    Returns ((best, worst) not taken, (best, worst) taken).
+    '''
+    if "/" in text:
+        notTaken, taken = text.split("/")
+        return (int(notTaken), int(notTaken)), (int(taken), int(taken))
+
+    best, _, worst = text.partition("-")
+    cycles = (int(best), int(worst or best))
+    return cycles, cycles
+
+timings = dict((" ".join(row.split()[:-1]), parseCycles(row.split()[-1]))
+               for row in instructionTable.strip().split("\n"))
+
+class AnalyzerError(Exception):
+    def __init__(self, message, path=None, number=None):
+        super().__init__(message)
+        self.message = message
+        self.path = path
+        self.number = number
+
+    def __str__(self):
+        if self.path is None:
+            return self.message
+
+        return "%s:%d: %s" % (self.path, self.number, self.message)
+
+Instruction = collections.namedtuple("Instruction", ["mnemonic", "target", "cycles", "path", "number"])
+Result = collections.namedtuple("Result", ["best", "worst", "instructions", "flags"])
+Routine = collections.namedtuple("Routine", ["name", "kind", "path", "number", "result"])
+
+def operandClasses(operand, resolve):
+    '''
+    Candidate classes of an operand, in the order they are looked up.
+    '''
+    if operand.startswith("#"):
+        return ["#data"]
+
+    if operand.startswith("/"):
+        return ["/bit"]
+
+    if operand.startswith("@"):
+        register = resolve(operand[1:]).upper()
+        if register in ("R0", "R1"):
+            return ["@Ri"]
+
+        return [("@" + register).replace(" ", "")]
+
+    resolved = resolve(operand).upper()
+    if resolved in registers:
+        return ["Rn"]
+
+    compact = resolved.replace(" ", "")
+    if compact in fixedOperands:
+        return [compact]
+
+    return ["direct", "bit", "rel", "addr"]
+
+def lookupCycles(mnemonic, operands, resolve):
+    candidates = [mnemonic]
+    for operand in operands:
+        classes = operandClasses(operand, resolve)
+        candidates = [("%s,%s" % (candidate, cls)) if candidate != mnemonic else "%s %s" % (candidate, cls)
+                      for candidate in candidates for cls in classes]
+
+    for candidate in candidates:
+        if candidate in timings:
+            return timings[candidate]
+
+    return None
+
+class Program:
+    '''
+    The instructions and code labels of one build configuration.
+    '''
+
+    def __init__(self, preprocessor, statements):
+        self.instructions = []
+        self.labels = {}
+        self.labelSources = {}
+        self.vectors = []
+        self.candidates = []
+        self.callTargets = set()
+
+        segment = "CSEG"
+        vector = False
+        afterBanner = False
+        for path, line in statements:
+            kind = line.kind
+            if kind == lexer.BANNER:
+                afterBanner = True
+                continue
+
+            if kind == lexer.DIRECTIVE:
+                mnemonic = line.mnemonic.upper()
+                if mnemonic in ("CSEG", "DSEG", "ISEG", "BSEG", "XSEG"):
+                    segment = mnemonic
+                    vector = False
+                    argument = line.argument.strip()
+                    if mnemonic == "CSEG" and argument.upper().startswith("AT"):
+                        address = preprocessor.evaluate(argument[2:])
+                        vector = address < vectorLimit and address % 8 == 3
+
+            if line.label and segment == "CSEG":
+                name = line.label.upper()
+                self.labels[name] = len(self.instructions)
+                self.labelSources[name] = (line.label, path, line.number)
+                previous = self.instructions[-1] if self.instructions else None
+                if afterBanner and (previous is None or previous.mnemonic in returns or
+                                    previous.mnemonic in jumps):
+                    self.candidates.append(name)
+
+            if kind == lexer.INSTRUCTION:
+                self.instructions.append(self.instruction(preprocessor, line, path))
+                if vector and self.instructions[-1].target:
+                    self.vectors.append(self.instructions[-1].target.upper())
+                    vector = False
+
+                afterBanner = False
+
+    def instruction(self, preprocessor, line, path):
+        mnemonic = line.mnemonic.upper()
+        operands = line.operands
+        cycles = lookupCycles(mnemonic, operands, preprocessor.resolve)
+        if cycles is None:
+            raise AnalyzerError("no timing for '%s'" % line.code, path, line.number)
+
+        target = None
+        if mnemonic in jumps or mnemonic in calls or mnemonic in branches:
+            target = operands[-1]
+            if target.upper() == "@A+DPTR":
+                target = None
+
+            elif mnemonic in calls:
+                self.callTargets.add(target.upper())
+
+        return Instruction(mnemonic, target, cycles, path, line.number)
+
+class Analyzer:
+    '''
+    Best and worst case cycles from an instruction to the end of its routine.
+
+    A jump back to an instruction of the same loop, that is to a lower or
+    the same address within a strongly connected component of the control
+    flow, ends the path. Every cycle has such a jump, so the rest of the
+    flow is acyclic and the result of an instruction does not depend on
+    the routine it was reached from.
+    '''
+
+    def __init__(self, program):
+        self.program = program
+        self.results = {}
+        self.components = self.stronglyConnected()
+
+    def target(self, index, name):
+        if name == "$":
+            return index
+
+        return self.program.labels.get(name.upper())
+
+    def successors(self, index):
+        instruction = self.program.instructions[index]
+        mnemonic = instruction.mnemonic
+        if mnemonic in returns:
+            return []
+
+        targets = [] if mnemonic in jumps else [index + 1]
+        if instruction.target is not None:
+            if mnemonic in calls:
+                targets.append(self.program.labels.get(instruction.target.upper()))
+
+            elif mnemonic in jumps or mnemonic in branches:
+                targets.append(self.target(index, instruction.target))
+
+        return [target for target in targets
+                if target is not None and target < len(self.program.instructions)]
+
+    def stronglyConnected(self):
+        '''
+        Returns the strongly connected component of every instruction
+        (Tarjan's algorithm, iterative).
+        '''
+        count = len(self.program.instructions)
+        components = [None] * count
+        order = [None] * count
+        lowest = [0] * count
+        stack = []
+        onStack = set()
+        counter = 0
+        for root in range(count):
+            if order[root] is not None:
+                continue
+
+            work = [(root, iter(self.successors(root)))]
+            order[root] = lowest[root] = counter
+            counter += 1
+            stack.append(root)
+            onStack.add(root)
+            while work:
+                index, pending = work[-1]
+                for successor in pending:
+                    if order[successor] is None:
+                        order[successor] = lowest[successor] = counter
+                        counter += 1
+                        stack.append(successor)
+                        onStack.add(successor)
+                        work.append((successor, iter(self.successors(successor))))
+                        break
+
+                    if successor in onStack:
+                        lowest[index] = min(lowest[index], order[successor])
+
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowest[parent] = min(lowest[parent], lowest[index])
+
+                    if lowest[index] == order[index]:
+                        while True:
+                            member = stack.pop()
+                            onStack.discard(member)
+                            components[member] = index
+                            if member == index:
+                                break
+
+        return components
+
+    def loops(self, index, target):
+        return (target <= index and target < len(self.components) and
+                self.components[target] == self.components[index])
+
+    def routine(self, name):
+        index = self.program.labels.get(name.upper())
+        if index is None:
+            return Result(0, 0, 0, frozenset(["unresolved"]))
+
+        return self.analyze(index)
+
+    def call(self, index, name):
+        target = self.program.labels.get(name.upper())
+        if target is None:
+            return Result(0, 0, 0, frozenset(["unresolved"]))
+
+        if self.loops(index, target):
+            # Recursion is counted once
+            return Result(0, 0, 0, frozenset(["loop"]))
+
+        return self.analyze(target)
+
+    def follow(self, index, name):
+        target = self.target(index, name)
+        if target is None:
+            return Result(0, 0, 0, frozenset(["unresolved"]))
+
+        if self.loops(index, target):
+            # Loops are counted once
+            return Result(0, 0, 0, frozenset(["loop"]))
+
+        return self.analyze(target)
+
+    def analyze(self, index):
+        if index in self.results:
+            return self.results[index]
+
+        if index >= len(self.program.instructions):
+            return Result(0, 0, 0, frozenset(["end"]))
+
+        result = self.step(index)
+        self.results[index] = result
+        return result
+
+    def step(self, index):
+        instruction = self.program.instructions[index]
+        mnemonic = instruction.mnemonic
+        (best, worst), (takenBest, takenWorst) = instruction.cycles
+
+        if mnemonic in returns:
+            return Result(best, worst, 1, frozenset())
+
+        if mnemonic == "JMP" and instruction.target is None:
+            return Result(best, worst, 1, frozenset(["indirect"]))
+
+        if mnemonic in jumps:
+            after = self.follow(index, instruction.target)
+            return Result(best + after.best, worst + after.worst, after.instructions + 1, after.flags)
+
+        if mnemonic in calls:
+            called = self.call(index, instruction.target)
+            after = self.analyze(index + 1)
+            return Result(best + called.best + after.best, worst + called.worst + after.worst,
+                          called.instructions + after.instructions + 1, called.flags | after.flags)
+
+        if mnemonic in branches:
+            notTaken = self.analyze(index + 1)
+            taken = self.follow(index, instruction.target)
+            longest = notTaken if worst + notTaken.worst >= takenWorst + taken.worst else taken
+            return Result(min(best + notTaken.best, takenBest + taken.best),
+                          max(worst + notTaken.worst, takenWorst + taken.worst),
+                          longest.instructions + 1, notTaken.flags | taken.flags)
+
+        after = self.analyze(index + 1)
+        return Result(best + after.best, worst + after.worst, after.instructions + 1, after.flags)
+
+def configuration(args):
+    layout = args.layout.upper()
+    escNumber = 27 if layout == "OA" else ord(layout) - ord("A") + 1
+    return {
+        "ESCNO": escNumber,
+        "MCU_TYPE": mcuTypes[args.mcu.upper()],
+        "DEADTIME": args.deadtime,
+        "PWM_FREQ": pwmFrequencies[args.pwm],
+    }
+
+def analyzeSource(source, defines, includeDirs, files, extra=()):
+    '''
+    Returns the reported routines of a source in one build configuration.
+    '''
+    preprocessor = Preprocessor(defines, includeDirs)
+    program = Program(preprocessor, preprocessor.run(source))
+    analyzer = Analyzer(program)
+
+    selected = [name for name in program.candidates + sorted(program.callTargets)
+                if name in program.labelSources and
+                os.path.basename(program.labelSources[name][1]) in files]
+    names = program.vectors + [name.upper() for name in extra] + selected
+
+    routines = []
+    seen = set()
+    for name in names:
+        if name in seen or name not in program.labelSources:
+            continue
+
+        seen.add(name)
+        label, path, number = program.labelSources[name]
+        kind = "isr" if name in program.vectors else "routine"
+        routines.append(Routine(label, kind, os.path.relpath(path), number, analyzer.routine(name)))
+
+    return routines
+
+def printReport(routines, baseline):
+    print("%-40s %-8s %6s %6s %6s  %s" % ("ROUTINE", "KIND", "BEST", "WORST", "DELTA", "NOTES"))
+    regressions = []
+    for routine in routines:
+        result = routine.result
+        delta = ""
+        if baseline is not None and routine.name in baseline:
+            change = result.worst - baseline[routine.name]["worst"]
+            delta = "%+d" % change if change else "0"
+            if change > 0:
+                regressions.append((routine, change))
+
+        notes = ", ".join(sorted(result.flags))
+        print("%-40s %-8s %6d %6d %6s  %s" % (routine.name, routine.kind, result.best, result.worst, delta,
+                                              notes or "%s:%d" % (routine.path, routine.number)))
+
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Count the cycles of the Bluejay interrupt routines.")
+    parser.add_argument("--source", dest="source",
+                        default=os.path.join(srcDir, "Bluejay.asm"), help="main source file")
+    parser.add_argument("--incdir", dest="incdirs", nargs="+",
+                        default=[os.path.join(srcDir, "Settings")], help="include directories like INCDIR()")
+    parser.add_argument("--layout", dest="layout",
+                        default="A", help="layout, like LAYOUT of the Makefile")
+    parser.add_argument("--mcu", dest="mcu", choices=sorted(mcuTypes),
+                        default="H", help="mcu, like MCU of the Makefile")
+    parser.add_argument("--deadtime", dest="deadtime", type=int,
+                        default=5, help="dead time, like DEADTIME of the Makefile")
+    parser.add_argument("--pwm", dest="pwm", type=int, choices=sorted(pwmFrequencies),
+                        default=24, help="pwm frequency in kHz, like PWM of the Makefile")
+    parser.add_argument("--file", dest="files", nargs="+",
+                        default=defaultFiles, help="files whose routines are reported")
+    parser.add_argument("--routine", dest="routines", nargs="+",
+                        default=[], help="labels to report in addition")
+    parser.add_argument("--json", dest="json",
+                        default=None, help="store the report as json")
+    parser.add_argument("--baseline", dest="baseline",
+                        default=None, help="report stored with --json to compare with, exits 1 on more worst case cycles")
+    args = parser.parse_args(argv)
+
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 100000))
+    defines = configuration(args)
+    try:
+        routines = analyzeSource(args.source, defines, args.incdirs, args.files, args.routines)
+
+    except (PreprocessorError, AnalyzerError, OSError) as e:
+        print("Failed analyzing %s: %s" % (args.source, e))
+        return 2
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)["routines"]
+
+    print("%s_%s_%d_%d: %s" % (args.layout.upper(), args.mcu.upper(), args.deadtime, args.pwm,
+                               ", ".join("%s=%d" % item for item in defines.items())))
+    regressions = printReport(routines, baseline)
+
+    if args.json:
+        report = {
+            "configuration": defines,
+            "routines": dict((routine.name, {
+                "kind": routine.kind, "path": routine.path, "line": routine.number,
+                "best": routine.result.best, "worst": routine.result.worst,
+                "flags": sorted(routine.result.flags),
+            }) for routine in routines),
+        }
+        with open(args.json, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    if regressions:
+        for routine, change in regressions:
+            print("Worst case of %s grew by %d cycles" % (routine.name, change))
+
+        return 1
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,444 @@
+'''
+Resolves $include, IF/ELSEIF/ELSE/ENDIF, $set/$if and macros of the
+Bluejay sources for one build configuration, like AX51 does before it
+assembles them:
+
+    preprocessor = Preprocessor({"ESCNO": 1, "MCU_TYPE": 1, "DEADTIME": 5, "PWM_FREQ": 0},
+                                includeDirs=["src/Settings"])
+    for statement in preprocessor.run("src/Bluejay.asm"):
+        print(statement.path, statement.line.number, statement.line.text)
+
+Only as much of AX51 is implemented as the sources need. Symbols defined
+with EQU, SET, DATA, BIT and friends are evaluated when possible and kept
+as text otherwise (Temp1 EQU R0), text literals (pON LIT 'setb') are
+replaced in instructions.
+'''
+import collections
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "formatter"))
+import lexer
+
+# Directives that define a symbol
+definitions = frozenset(["BIT", "CODE", "DATA", "EQU", "IDATA", "SET", "XDATA"])
+
+# Value of $set (NAME) without a value, NOT of it is 0
+setTrue = -1
+
+Statement = collections.namedtuple("Statement", ["path", "line"])
+
+tokenPattern = re.compile(r"""
+    \s*(?:
+        (?P<number>0[xX][0-9A-Fa-f]+|[0-9][0-9A-Fa-f]*[HhBbOoQqDd]?\b) |
+        (?P<string>'[^']*'|"[^"]*") |
+        (?P<name>[A-Za-z_?][\w?]*) |
+        (?P<operator>==|!=|<>|<=|>=|<<|>>|&&|\|\||[-+*/%()<>=!~&|^])
+    )""", re.VERBOSE)
+
+wordPattern = re.compile(r"[A-Za-z_?][\w?]*")
+concatenatePattern = re.compile(r"(?<=\w)&|&(?=\w)")
+evaluatePattern = re.compile(r"%\(([^()]*(?:\([^()]*\)[^()]*)*)\)")
+
+def truncate(a, b):
+    quotient = abs(a) // abs(b)
+    return quotient if (a < 0) == (b < 0) else -quotient
+
+# Binary operators from the lowest to the highest precedence, NOT sits
+# between AND and the relational operators
+binaryLevels = [
+    {"OR": lambda a, b: a | b, "|": lambda a, b: a | b, "||": lambda a, b: int(bool(a or b)),
+     "XOR": lambda a, b: a ^ b, "^": lambda a, b: a ^ b},
+    {"AND": lambda a, b: a & b, "&": lambda a, b: a & b, "&&": lambda a, b: int(bool(a and b))},
+    {"EQ": lambda a, b: int(a == b), "==": lambda a, b: int(a == b), "=": lambda a, b: int(a == b),
+     "NE": lambda a, b: int(a != b), "!=": lambda a, b: int(a != b), "<>": lambda a, b: int(a != b),
+     "LT": lambda a, b: int(a < b), "<": lambda a, b: int(a < b),
+     "LE": lambda a, b: int(a <= b), "<=": lambda a, b: int(a <= b),
+     "GT": lambda a, b: int(a > b), ">": lambda a, b: int(a > b),
+     "GE": lambda a, b: int(a >= b), ">=": lambda a, b: int(a >= b)},
+    {"+": lambda a, b: a + b, "-": lambda a, b: a - b},
+    {"*": lambda a, b: a * b, "/": truncate, "MOD": lambda a, b: a % b, "%": lambda a, b: a % b,
+     "SHL": lambda a, b: a << b, "<<": lambda a, b: a << b, "SHR": lambda a, b: a >> b, ">>": lambda a, b: a >> b},
+]
+notLevel = 2
+unaryOperators = {
+    "-": lambda a: -a, "+": lambda a: a, "~": lambda a: ~a, "!": lambda a: int(not a),
+    "HIGH": lambda a: (a >> 8) & 0xFF, "LOW": lambda a: a & 0xFF,
+}
+
+class PreprocessorError(Exception):
+    def __init__(self, message, path=None, number=None):
+        super().__init__(message)
+        self.message = message
+        self.path = path
+        self.number = number
+
+    def __str__(self):
+        if self.path is None:
+            return self.message
+
+        return "%s:%d: %s" % (self.path, self.number, self.message)
+
+def parseNumber(text):
+    lower = text.lower()
+    if lower.startswith("0x"):
+        return int(lower[2:], 16)
+
+    if lower.endswith("h"):
+        return int(lower[:-1], 16)
+
+    if lower.endswith("b") and set(lower[:-1]) <= set("01"):
+        return int(lower[:-1], 2)
+
+    if lower[-1] in "oq":
+        return int(lower[:-1], 8)
+
+    if lower.endswith("d"):
+        return int(lower[:-1])
+
+    return int(lower)
+
+class Expression:
+    '''
+    Evaluates an AX51 expression with the values of symbols.
+
+    Relational operators are 1 when true, arithmetic does not wrap.
+    '''
+
+    def __init__(self, text, lookup):
+        self.text = text
+        self.lookup = lookup
+        self.tokens = []
+        position = 0
+        text = text.rstrip()
+        while position < len(text):
+            match = tokenPattern.match(text, position)
+            if not match:
+                raise PreprocessorError("can not evaluate '%s'" % self.text)
+
+            kind = match.lastgroup
+            value = match.group(kind)
+            if kind == "name" and value.upper() in ("AND", "OR", "XOR", "NOT", "MOD", "SHL", "SHR",
+                                                     "EQ", "NE", "LT", "LE", "GT", "GE", "HIGH", "LOW"):
+                kind, value = "operator", value.upper()
+
+            self.tokens.append((kind, value))
+            position = match.end()
+
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def next(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def evaluate(self):
+        value = self.parse(0)
+        if self.position != len(self.tokens):
+            raise PreprocessorError("can not evaluate '%s'" % self.text)
+
+        return value
+
+    def parse(self, level):
+        if level == len(binaryLevels):
+            return self.unary()
+
+        if level == notLevel:
+            kind, value = self.peek()
+            if kind == "operator" and value == "NOT":
+                self.next()
+                return ~self.parse(level)
+
+        value = self.parse(level + 1)
+        operators = binaryLevels[level]
+        while True:
+            kind, operator = self.peek()
+            if kind != "operator" or operator not in operators:
+                return value
+
+            self.next()
+            value = operators[operator](value, self.parse(level + 1))
+
+    def unary(self):
+        kind, value = self.next()
+        if kind == "operator" and value in unaryOperators:
+            return unaryOperators[value](self.unary())
+
+        if kind == "operator" and value == "(":
+            result = self.parse(0)
+            if self.next() != ("operator", ")"):
+                raise PreprocessorError("missing ) in '%s'" % self.text)
+
+            return result
+
+        if kind == "number":
+            return parseNumber(value)
+
+        if kind == "string":
+            result = 0
+            for char in value[1:-1]:
+                result = (result << 8) | ord(char)
+
+            return result
+
+        if kind == "name":
+            return self.lookup(value)
+
+        raise PreprocessorError("can not evaluate '%s'" % self.text)
+
+class Macro:
+    __slots__ = ("name", "parameters", "body", "path", "number")
+
+    def __init__(self, name, parameters, path, number):
+        self.name = name
+        self.parameters = parameters
+        self.body = []
+        self.path = path
+        self.number = number
+
+class Preprocessor:
+    '''
+    Yields the statements of a source as AX51 would assemble them.
+
+    defines are the DEFINE() values of the command line, includeDirs the
+    INCDIR() directories. includes lists the files that were read.
+    '''
+
+    def __init__(self, defines=None, includeDirs=()):
+        self.symbols = dict((name.upper(), value) for name, value in (defines or {}).items())
+        self.controls = {}
+        self.includeDirs = list(includeDirs)
+        self.macros = {}
+        self.literals = {}
+        self.locals = 0
+        self.baseDir = None
+        self.includes = []
+
+    def lookup(self, name, depth=0):
+        try:
+            value = self.symbols[name.upper()]
+
+        except KeyError:
+            raise PreprocessorError("undefined symbol %s" % name)
+
+        if isinstance(value, str):
+            if depth > 16:
+                raise PreprocessorError("recursive symbol %s" % name)
+
+            return Expression(value, lambda other: self.lookup(other, depth + 1)).evaluate()
+
+        return value
+
+    def evaluate(self, text):
+        return Expression(text, self.lookup).evaluate()
+
+    def evaluateControl(self, text):
+        return Expression(text, lambda name: self.controls.get(name.upper(), 0)).evaluate()
+
+    def resolve(self, name):
+        '''
+        Text a symbol like Temp1 stands for, name itself if it is no alias.
+        '''
+        for _ in range(16):
+            value = self.symbols.get(name.upper())
+            if not isinstance(value, str) or not wordPattern.fullmatch(value):
+                return name
+
+            name = value
+
+        return name
+
+    def findInclude(self, name, path):
+        name = name.strip().strip("()").strip().replace("\\", "/")
+        for directory in [self.baseDir, os.path.dirname(path)] + self.includeDirs:
+            candidate = os.path.join(directory, name)
+            if os.path.isfile(candidate):
+                return candidate
+
+        raise PreprocessorError("can not find include %s" % name)
+
+    def run(self, path):
+        self.baseDir = os.path.dirname(path)
+        self.includes.append(path)
+        with open(path, 'r', errors='replace') as file:
+            lines = list(lexer.tokenize(file))
+
+        yield from self.process(lines, path)
+
+    def process(self, lines, path):
+        # Every entry is [active, taken] of one IF/ELSEIF/ELSE chain
+        conditions = []
+        recording = None
+        depth = 0
+        for line in lines:
+            try:
+                kind = line.kind
+                if recording is not None:
+                    if kind == lexer.MACRO:
+                        depth += 1 if line.mnemonic.upper() == "MACRO" else -1
+
+                    if depth == 0:
+                        recording = None
+
+                    else:
+                        recording.body.append(line.text)
+
+                    continue
+
+                active = all(condition[0] for condition in conditions)
+                if kind == lexer.CONDITIONAL or (kind == lexer.PREPROCESSOR and line.mnemonic.lower() in
+                                                ("$if", "$elseif", "$else", "$endif")):
+                    self.condition(line, conditions, active)
+                    continue
+
+                if not active:
+                    continue
+
+                if kind == lexer.PREPROCESSOR:
+                    yield from self.control(line, path)
+                    continue
+
+                if kind == lexer.MACRO and line.mnemonic.upper() == "MACRO":
+                    parameters = [name.upper() for name in re.split(r"[\s,]+", line.argument) if name]
+                    recording = Macro(line.name, parameters, path, line.number)
+                    self.macros[line.name.upper()] = recording
+                    depth = 1
+                    continue
+
+                if self.literals and kind == lexer.INSTRUCTION:
+                    line = self.substituteLiterals(line)
+                    kind = line.kind
+
+                if kind == lexer.DIRECTIVE and line.name and line.mnemonic.upper() == "LIT":
+                    self.literals[line.name.upper()] = line.argument.strip().strip("'\"")
+                    continue
+
+                if kind == lexer.DIRECTIVE and line.name and line.mnemonic.upper() in definitions:
+                    self.define(line)
+
+                elif kind == lexer.INSTRUCTION and line.mnemonic.upper() in self.macros:
+                    yield from self.expand(self.macros[line.mnemonic.upper()], line, path)
+                    continue
+
+                yield Statement(path, line)
+
+            except PreprocessorError as e:
+                if e.path is None:
+                    e.path, e.number = path, line.number
+
+                raise
+
+        if recording is not None:
+            raise PreprocessorError("missing ENDM of %s" % recording.name, recording.path, recording.number)
+
+        if conditions:
+            raise PreprocessorError("missing ENDIF", path, lines[-1].number if lines else 0)
+
+    def condition(self, line, conditions, active):
+        keyword = line.mnemonic.upper().lstrip("$")
+        evaluate = self.evaluateControl if line.mnemonic.startswith("$") else self.evaluate
+        if keyword == "IF":
+            # Conditions in skipped blocks are not evaluated
+            if active:
+                taken = evaluate(line.argument) != 0
+                conditions.append([taken, taken])
+
+            else:
+                conditions.append([False, True])
+
+            return
+
+        if not conditions:
+            raise PreprocessorError("%s without IF" % keyword)
+
+        condition = conditions[-1]
+        if keyword == "ENDIF":
+            conditions.pop()
+
+        elif condition[1]:
+            condition[0] = False
+
+        elif keyword == "ELSE":
+            condition[0] = condition[1] = True
+
+        else:
+            condition[0] = condition[1] = evaluate(line.argument) != 0
+
+    def control(self, line, path):
+        keyword = line.mnemonic.lower()
+        if keyword == "$include":
+            includePath = self.findInclude(line.argument, path)
+            self.includes.append(includePath)
+            with open(includePath, 'r', errors='replace') as file:
+                lines = list(lexer.tokenize(file))
+
+            yield from self.process(lines, includePath)
+
+        elif keyword == "$set":
+            for assignment in lexer.splitOperands(line.argument.strip().strip("()")):
+                name, _, value = assignment.partition("=")
+                self.controls[name.strip().upper()] = self.evaluateControl(value) if value.strip() else setTrue
+
+        elif keyword == "$reset":
+            for name in lexer.splitOperands(line.argument.strip().strip("()")):
+                self.controls[name.strip().upper()] = 0
+
+    def substituteLiterals(self, line):
+        '''
+        Replace text literals (pON LIT 'setb') in an instruction.
+        '''
+        if not any(field.upper() in self.literals for field in line.fields):
+            return line
+
+        text = wordPattern.sub(lambda match: self.literals.get(match.group(0).upper(), match.group(0)), line.text)
+        substituted = next(lexer.tokenize([text]))
+        substituted.number = line.number
+        return substituted
+
+    def define(self, line):
+        try:
+            value = self.evaluate(line.argument)
+
+        except PreprocessorError:
+            # Register aliases and symbols that are defined later
+            value = line.argument.strip()
+
+        self.symbols[line.name.upper()] = value
+
+    def expand(self, macro, line, path):
+        arguments = []
+        for argument in line.operands:
+            # %(expression) passes the value of the expression
+            match = evaluatePattern.fullmatch(argument)
+            arguments.append(str(self.evaluate(match.group(1))) if match else argument)
+
+        values = dict(zip(macro.parameters, arguments))
+        for parameter in macro.parameters[len(arguments):]:
+            values[parameter] = ""
+
+        def substitute(match):
+            return values.get(match.group(0).upper(), match.group(0))
+
+        body = []
+        for text in macro.body:
+            words = text.split(" ")
+            if words[0].upper() == "LOCAL":
+                for name in re.split(r"[\s,]+", " ".join(words[1:]).split(";")[0]):
+                    if name:
+                        self.locals += 1
+                        values[name.upper()] = "%s??%04d" % (name, self.locals)
+
+                continue
+
+            body.append(concatenatePattern.sub("", wordPattern.sub(substitute, text)))
+
+        expanded = list(lexer.tokenize(body))
+        for token in expanded:
+            # Report expanded lines at the line of the invocation
+            token.number = line.number
+
+        yield from self.process(expanded, path)
@@ -0,0 +1,64 @@
+'''
+Tests of the cycle counts of cycles.py:
+
+    cd tools/cycles && python3 -m unittest test_cycles
+'''
+import os
+import sys
+import tempfile
+import unittest
+
+from cycles import Analyzer, Program, configuration, srcDir
+from preprocessor import Preprocessor
+
+class Configuration:
+    layout = "A"
+    deadtime = 5
+    pwm = 24
+
+    def __init__(self, mcu):
+        self.mcu = mcu
+
+def loadProgram(source, defines=None, includeDirs=()):
+    preprocessor = Preprocessor(defines or {}, list(includeDirs))
+    return Program(preprocessor, preprocessor.run(source))
+
+class AnalyzerTest(unittest.TestCase):
+    def setUp(self):
+        sys.setrecursionlimit(max(sys.getrecursionlimit(), 100000))
+
+    def analyzeSnippet(self, code, name):
+        with tempfile.TemporaryDirectory() as directory:
+            source = os.path.join(directory, "test.asm")
+            with open(source, 'w') as file:
+                file.write(code)
+
+            return Analyzer(loadProgram(source)).routine(name)
+
+    def testLoopCountedOnce(self):
+        result = self.analyzeSnippet(
+            "loop:\n"
+            "    inc  A\n"
+            "    djnz R2, loop\n"
+            "    ret\n", "loop")
+        # INC A and DJNZ taken back to the loop, or INC A, DJNZ and RET
+        self.assertEqual((result.best, result.worst), (1 + 3, 1 + 2 + 5))
+        self.assertIn("loop", result.flags)
+
+    def testOrderIndependent(self):
+        # A routine has the same counts no matter what was analyzed before
+        for mcu in ("H", "X"):
+            program = loadProgram(os.path.join(srcDir, "Bluejay.asm"), configuration(Configuration(mcu)),
+                                  [os.path.join(srcDir, "Settings")])
+            names = sorted(program.labels)
+            forward = Analyzer(program)
+            backward = Analyzer(program)
+            results = dict((name, forward.routine(name)) for name in names)
+            for name in reversed(names):
+                self.assertEqual(backward.routine(name), results[name], "%s (%s)" % (name, mcu))
+
+            for name in names[::10]:
+                self.assertEqual(Analyzer(program).routine(name), results[name], "%s (%s)" % (name, mcu))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+#
+# This file is part of efm8load. efm8load is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+import crcmod.predefined
+from intelhex import IntelHex
+
+from efm8emu import EFM8Emulator, find_variant
+from efm8load import ByteOrder, CRCIndex, EFM8Loader, FlashPlan, crc16
+
+
+def synthetic_image(filename, size, seed = 0):
+    """ write a hex file of code-like bytes, distributed like ByteOrder.PRIOR """
+    rng = random.Random(seed)
+    values = list(range(256))
+    weights = [ByteOrder.PRIOR.get(value, 0) + 1 for value in values]
+    ih = IntelHex()
+    for address, value in enumerate(rng.choices(values, weights, k=size)):
+        ih[address] = value
+    ih.write_hex_file(filename)
+
+class Benchmark:
+    """Runs efm8load operations against an emulated bootloader"""
+
+    def __init__(self, emulator, image, baudrate = 115200, pipeline = 1):
+        self.emulator = emulator
+        self.image    = image
+        self.baudrate = baudrate
+        self.pipeline = pipeline
+        self.results  = []
+
+    def loader(self):
+        return EFM8Loader(self.emulator.port, self.baudrate, pipeline=self.pipeline,
+                          output=lambda message, end: None)
+
+    def measure(self, name, operation):
+        loader = self.loader()
+        self.emulator.reset_stats()
+        started = time.monotonic()
+        with loader:
+            operation(loader)
+        seconds = time.monotonic() - started
+        result = { "name": name, "round_trips": loader.round_trips,
+                   "bytes_in": self.emulator.bytes_in, "bytes_out": self.emulator.bytes_out,
+                   "seconds": seconds }
+        self.results.append(result)
+        return result
+
+    def identify(self, loader):
+        loader.identify_chip()
+
+    def upload(self, loader):
+        loader.upload(self.image)
+
+    def upload_differential(self, loader):
+        loader.upload(self.image, differential=True)
+
+    def upload_repair(self, loader):
+        #two bad bytes in different pages, both get repaired by rewriting their page
+        self.emulator.corrupt(0x0205)
+        self.emulator.corrupt(0x1003)
+        loader.upload(self.image)
+
+    def verify(self, loader):
+        loader.identify()
+        loader.verify_pages(FlashPlan.from_file(self.image, loader.flash_page_size))
+
+    def download(self, loader):
+        with tempfile.TemporaryDirectory() as directory:
+            loader.download(os.path.join(directory, "dump.hex"))
+
+    suites = [ "identify", "upload", "upload_differential", "upload_repair", "verify", "download" ]
+
+    def run(self, suites):
+        for name in suites:
+            #dump the benchmark image, not an erased chip, even when download runs on its own
+            if (name == "download"):
+                self.emulator.load(self.image)
+            self.measure(name, getattr(self, name))
+        return self.results
+
+def crc_benchmark(image, count = 2000, seed = 0):
+    """ time the crc of pages, 128 byte chunks and random ranges of an image
+
+    compares the former per call crcmod function on a list, crc16 on
+    memoryview slices and lookups in a CRCIndex
+    """
+    plan = FlashPlan.from_file(image)
+    data = plan.data
+    view = memoryview(data)
+    rng = random.Random(seed)
+    ranges = { "page": [], "chunk": [], "range": [] }
+    for _ in range(count):
+        page = rng.randrange(len(data) // plan.page_size) * plan.page_size
+        ranges["page"].append((page, page + plan.page_size))
+        chunk = rng.randrange(len(data) // 128) * 128
+        ranges["chunk"].append((chunk, chunk + 128))
+        start = rng.randrange(len(data))
+        ranges["range"].append((start, rng.randrange(start, len(data)) + 1))
+
+    def per_call(start, end):
+        return crcmod.predefined.mkCrcFun('xmodem')(bytearray(list(data[start:end])))
+
+    started = time.monotonic()
+    index = CRCIndex(data)
+    results = [{ "name": "index build", "calls": 1, "seconds": time.monotonic() - started }]
+    methods = [ ("crcmod per call", per_call), ("crc16 memoryview", lambda start, end: crc16(view[start:end])),
+                ("crc index", index.crc) ]
+    for kind, spans in ranges.items():
+        for name, method in methods:
+            started = time.monotonic()
+            for start, end in spans:
+                method(start, end)
+            results.append({ "name": "%s %s" % (kind, name), "calls": len(spans),
+                             "seconds": time.monotonic() - started })
+    return results
+
+def print_crc_results(results):
+    print("%-28s %8s %10s %10s" % ("CRC", "CALLS", "TIME", "PER CALL"))
+    for result in results:
+        print("%-28s %8d %9.4fs %8.2fus" % (result["name"], result["calls"], result["seconds"],
+                                           result["seconds"] * 1e6 / result["calls"]))
+
+def print_results(results):
+    print("%-20s %8s %10s %10s %9s" % ("BENCHMARK", "TRIPS", "BYTES IN", "BYTES OUT", "TIME"))
+    for result in results:
+        print("%-20s %8d %10d %10d %8.3fs" % (result["name"], result["round_trips"], result["bytes_in"],
+                                             result["bytes_out"], result["seconds"]))
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser(description='efm8bench - benchmark efm8load against an emulated bootloader')
+    argp.add_argument('suites', nargs="*", default=Benchmark.suites,
+                      help='benchmarks to run (default is all: %s)' % (", ".join(Benchmark.suites)))
+    argp.add_argument('-w', '--write', metavar="filename", help='hex file to upload (default is a synthetic image)')
+    argp.add_argument('--size', type=lambda value: int(value, 0), default=0x1A00,
+                      help='size of the synthetic image in bytes (default is 0x1A00)')
+    argp.add_argument('-d', '--device', default="EFM8BB21F16G_QSOP24", help='variant to emulate (default is EFM8BB21F16G_QSOP24)')
+    argp.add_argument('-b', '--baudrate', type=int, default=115200, help='baudrate (default is 115200 baud)')
+    argp.add_argument('--byte-delay', type=float, default=0.0, help='emulated delay per byte in ms')
+    argp.add_argument('--frame-delay', type=float, default=0.0, help='emulated delay per frame in ms')
+    argp.add_argument('--pipeline', type=int, default=1, help='number of write frames sent ahead of their reply')
+    argp.add_argument('--crc', action='store_true', help='run the crc microbenchmark instead of the emulator suites')
+    argp.add_argument('--json', metavar="filename", help='also store the results as json')
+    args = argp.parse_args()
+
+    for suite in args.suites:
+        if suite not in Benchmark.suites:
+            argp.error("unknown benchmark '%s'" % (suite))
+
+    try:
+        device_id, variant_id = find_variant(args.device)
+    except ValueError as e:
+        argp.error(str(e))
+
+    with tempfile.TemporaryDirectory() as directory:
+        image = args.write
+        if not image:
+            image = os.path.join(directory, "synthetic.hex")
+            synthetic_image(image, args.size)
+
+        if (args.crc):
+            results = crc_benchmark(image)
+            print_crc_results(results)
+            if (args.json):
+                with open(args.json, "w") as f:
+                    json.dump({ "results": results }, f, indent=2)
+            sys.exit(0)
+
+        emulator = EFM8Emulator(device_id, variant_id,
+                                byte_delay=args.byte_delay / 1000.0, frame_delay=args.frame_delay / 1000.0)
+        with emulator:
+            results = Benchmark(emulator, image, args.baudrate, args.pipeline).run(args.suites)
+
+    print_results(results)
+    if (args.json):
+        with open(args.json, "w") as f:
+            json.dump({ "device": args.device, "byte_delay": args.byte_delay, "frame_delay": args.frame_delay,
+                        "pipeline": args.pipeline, "results": results }, f, indent=2)
+    sys.exit(0)
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+#
+# This file is part of efm8load. efm8load is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+import argparse
+import collections
+import os
+import random
+import select
+import sys
+import termios
+import threading
+import time
+import tty
+
+from intelhex import IntelHex
+
+from efm8load import COMMAND, RESPONSE, EFM8Loader, crc16
+
+
+class EFM8Emulator:
+    """Emulates the EFM8 UART bootloader on a pseudo terminal
+
+    The emulated chip keeps its flash in memory. Frames are answered with the
+    same RESPONSE codes as the real bootloader, optionally delayed per byte
+    and per frame to mimic the latency of a USB serial adapter. Frames sent
+    faster than max_baudrate get lost with probability error_rate and are
+    answered with noise, like a link that can not keep up. Open self.port
+    with efm8load to talk to it.
+    """
+
+    def __init__(self, device_id = 0x32, variant_id = 0x02, byte_delay = 0.0, frame_delay = 0.0,
+                 max_baudrate = None, error_rate = 1.0, seed = 0):
+        if (device_id, variant_id) not in EFM8Loader.variants:
+            raise ValueError("unknown device 0x%02X variant 0x%02X" % (device_id, variant_id))
+        config = EFM8Loader.variants[(device_id, variant_id)][1]
+        self.device_id   = device_id
+        self.variant_id  = variant_id
+        self.name        = config[0]
+        self.flash_size  = config[1]
+        self.page_size   = config[2]
+        #the last page holds the lock byte and can not be erased or written
+        self.protected   = self.flash_size - config[3]
+        self.flash       = bytearray(b"\xFF") * self.flash_size
+        self.byte_delay  = byte_delay
+        self.frame_delay = frame_delay
+        self.max_baudrate = max_baudrate
+        self.error_rate   = error_rate
+        self.random       = random.Random(seed)
+        self.unlocked    = False
+        #address : number of writes that still get corrupted there
+        self.faults      = collections.Counter()
+        #statistics
+        self.frames      = collections.Counter()
+        self.bytes_in    = 0
+        self.bytes_out   = 0
+        self.link_errors = 0
+        #pty and worker thread
+        self.master      = None
+        self.slave       = None
+        self.port        = None
+        self.thread      = None
+        self.running     = False
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def load(self, filename):
+        """ preload the flash with a hex file """
+        ih = IntelHex()
+        ih.loadhex(filename)
+        for address in ih.addresses():
+            self.flash[address] = ih[address]
+
+    def corrupt(self, address, count = 1):
+        """ make the next count writes of flash[address] clear one bit too many """
+        self.faults[address] += count
+
+    def reset_stats(self):
+        self.frames.clear()
+        self.bytes_in    = 0
+        self.bytes_out   = 0
+        self.link_errors = 0
+
+    def open(self):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port    = os.ttyname(self.slave)
+        self.running = True
+        self.thread  = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                os.close(fd)
+        self.master = self.slave = None
+
+    def run(self):
+        buffer = bytearray()
+        while self.running:
+            readable, _, _ = select.select([self.master], [], [], 0.05)
+            if not readable:
+                continue
+            try:
+                received = os.read(self.master, 4096)
+            except OSError:
+                break
+            self.bytes_in += len(received)
+            buffer += received
+            while True:
+                #skip autobaud training and noise until the start of a frame
+                start = buffer.find(b"$")
+                if start < 0:
+                    buffer.clear()
+                    break
+                del buffer[:start]
+                if (len(buffer) < 2) or (len(buffer) < 2 + buffer[1]):
+                    break
+                length = buffer[1]
+                frame = bytes(buffer[2:2 + length])
+                del buffer[:2 + length]
+                if (self.byte_delay or self.frame_delay):
+                    time.sleep(self.frame_delay + self.byte_delay * (2 + length))
+                if self.garbled():
+                    #the frame is lost, the reply is noise
+                    self.link_errors += 1
+                    reply = 0x00
+                else:
+                    reply = self.handle(frame[0], frame[1:])
+                self.bytes_out += 1
+                os.write(self.master, bytes((reply,)))
+
+    def baudrate(self):
+        """ baudrate efm8load set on the port """
+        speed = termios.tcgetattr(self.slave)[4]
+        for name in dir(termios):
+            if name[:1] == "B" and name[1:].isdigit() and getattr(termios, name) == speed:
+                return int(name[1:])
+        return None
+
+    def garbled(self):
+        if (self.max_baudrate is None) or ((self.baudrate() or 0) <= self.max_baudrate):
+            return False
+        return self.random.random() < self.error_rate
+
+    def handle(self, cmd, data):
+        """ execute one command and return the response code """
+        self.frames[cmd] += 1
+        if (len(data) < 2):
+            return RESPONSE.RANGE_ERROR
+        address = (data[0] << 8) | data[1]
+
+        if (cmd == COMMAND.IDENTIFY):
+            if (data[0] == self.device_id) and (data[1] == self.variant_id):
+                return RESPONSE.ACK
+            return RESPONSE.BAD_ID
+
+        if (cmd == COMMAND.SETUP):
+            self.unlocked = (bytes(data[:2]) == b"\xA5\xF1")
+            return RESPONSE.ACK if self.unlocked else RESPONSE.BAD_ID
+
+        if (cmd == COMMAND.RESET):
+            self.unlocked = False
+            return RESPONSE.ACK
+
+        if not self.unlocked:
+            return RESPONSE.RANGE_ERROR
+
+        if (cmd == COMMAND.ERASE):
+            if (address >= self.protected):
+                return RESPONSE.RANGE_ERROR
+            start = address - (address % self.page_size)
+            self.flash[start:start + self.page_size] = b"\xFF" * self.page_size
+            #an erase frame may carry data to write right away
+            return self.program(address, data[2:])
+
+        if (cmd == COMMAND.WRITE):
+            return self.program(address, data[2:])
+
+        if (cmd == COMMAND.VERIFY):
+            if (len(data) != 6):
+                return RESPONSE.RANGE_ERROR
+            end = (data[2] << 8) | data[3]
+            crc = (data[4] << 8) | data[5]
+            if (end < address) or (end >= self.flash_size):
+                return RESPONSE.RANGE_ERROR
+            if (crc16(memoryview(self.flash)[address:end + 1]) == crc):
+                return RESPONSE.ACK
+            return RESPONSE.CRC_ERROR
+
+        return RESPONSE.RANGE_ERROR
+
+    def program(self, address, data):
+        if (address + len(data) > self.protected):
+            return RESPONSE.RANGE_ERROR
+        #flash bits can only be cleared by writing
+        for i, byte in enumerate(data):
+            if (self.faults[address + i] > 0) and (byte != 0):
+                self.faults[address + i] -= 1
+                byte &= byte - 1
+            self.flash[address + i] &= byte
+        return RESPONSE.ACK
+
+def find_variant(name):
+    """ (device_id, variant_id) of a variant name like EFM8BB21F16G_QSOP24 """
+    for variant, (device_name, config) in EFM8Loader.variants.items():
+        if config[0].lower() == name.lower():
+            return variant
+    raise ValueError("unknown variant '%s'" % (name))
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser(description='efm8emu - emulates the EFM8 uart bootloader on a pseudo terminal')
+    argp.add_argument('-d', '--device', default="EFM8BB21F16G_QSOP24", help='variant to emulate (default is EFM8BB21F16G_QSOP24)')
+    argp.add_argument('-l', '--load', metavar="filename", help='preload the flash with the given hex file')
+    argp.add_argument('--byte-delay', type=float, default=0.0, help='delay per received byte in ms')
+    argp.add_argument('--frame-delay', type=float, default=0.0, help='delay per frame in ms')
+    argp.add_argument('--corrupt', metavar="ADDRESS", type=lambda value: int(value, 0), action='append', default=[],
+                      help='corrupt the first write of this address (can be given multiple times)')
+    argp.add_argument('--max-baudrate', type=int, help='frames sent faster than this baudrate get lost')
+    argp.add_argument('--error-rate', type=float, default=1.0,
+                      help='share of the frames above --max-baudrate that get lost (default is 1.0, all)')
+    args = argp.parse_args()
+
+    try:
+        device_id, variant_id = find_variant(args.device)
+    except ValueError as e:
+        argp.error(str(e))
+
+    emulator = EFM8Emulator(device_id, variant_id,
+                            byte_delay=args.byte_delay / 1000.0, frame_delay=args.frame_delay / 1000.0,
+                            max_baudrate=args.max_baudrate, error_rate=args.error_rate)
+    if (args.load):
+        emulator.load(args.load)
+    for address in args.corrupt:
+        emulator.corrupt(address)
+
+    with emulator:
+        print("> emulating %s on %s, press ctrl+c to stop" % (emulator.name, emulator.port))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+    print("")
+    for cmd, count in sorted(emulator.frames.items()):
+        print("> %-8s %d frames" % (COMMAND.TO_STR.get(cmd, "0x%02X" % cmd), count))
+    print("> %d bytes received, %d bytes sent, %d frames lost" % (emulator.bytes_in, emulator.bytes_out, emulator.link_errors))
+    sys.exit(0)
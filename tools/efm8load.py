@@ -16,11 +16,24 @@
 # Copyright 2020 fishpepper.de
 #
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import glob
+import hashlib
+import json
+import mmap
 import operator
+import os
+import re
 import sys
+import threading
+import time
 
-import crcmod
+import crcmod.predefined
 import serial
+import serial.tools.list_ports
 from intelhex import IntelHex
 
 
@@ -36,6 +49,17 @@ class COMMAND:
     WRITE    = 0x33
     VERIFY   = 0x34
     RESET    = 0x36
+    TO_STR = { IDENTIFY: "identify", SETUP: "setup", ERASE: "erase", WRITE: "write", VERIFY: "verify", RESET: "reset" }
+
+    # default time to wait for the reply to each command (in seconds)
+    TIMEOUT = { IDENTIFY: 0.25, SETUP: 0.25, ERASE: 1.0, WRITE: 0.5, VERIFY: 0.5, RESET: 0.5 }
+
+    @staticmethod
+    def from_string(name):
+        for cmd, cmd_name in COMMAND.TO_STR.items():
+            if cmd_name == name.lower():
+                return cmd
+        raise ValueError("unknown command '%s'" % (name))
 
 class RESPONSE:
     ACK         = 0x40
@@ -51,6 +75,772 @@ class RESPONSE:
         else:
             return "unknown response"
 
+class EFM8Error(Exception):
+    """Base class of all errors raised by EFM8Loader
+
+    response holds the bootloader response code and address the flash address
+    the error refers to, both are None where they do not apply.
+    """
+
+    def __init__(self, message, response = None, address = None):
+        super().__init__(message)
+        self.response = response
+        self.address  = address
+
+class PortError(EFM8Error):
+    """The serial port could not be opened, read or written"""
+
+class ReplyTimeout(EFM8Error):
+    """The bootloader did not reply in time"""
+
+class ResponseError(EFM8Error):
+    """The bootloader rejected a command"""
+
+class VerifyError(ResponseError):
+    """The flash content does not match the expected crc"""
+
+class DeviceError(EFM8Error):
+    """No supported device was detected"""
+
+class ByteOrder:
+    """Order in which candidate values are tried when recovering a flash byte
+
+    The order is seeded from a rough 8051 opcode/operand frequency table and
+    learns from every byte read: values seen after the previous byte are tried
+    first, followed by all values ordered by their overall frequency.
+    """
+
+    # rough byte frequencies in BLHeli_S / Bluejay style 8051 code
+    PRIOR = {
+        0x00: 60, 0xFF: 50, 0x01: 20, 0x02: 18, 0x12: 18, 0x22: 10, 0x32: 4,
+        0x74: 16, 0x75: 16, 0xE5: 16, 0xF5: 16, 0x85: 8, 0x90: 6, 0x80: 10,
+        0x60: 8, 0x70: 8, 0x40: 8, 0x50: 8, 0x20: 8, 0x30: 8, 0x10: 3,
+        0xC2: 10, 0xD2: 10, 0xC3: 6, 0xD3: 4, 0xE4: 8, 0x04: 4, 0x14: 4,
+        0x24: 4, 0x34: 4, 0x94: 6, 0x95: 6, 0x25: 4, 0x35: 4, 0xE0: 3,
+        0xF0: 3, 0x93: 3, 0xA3: 4, 0xB4: 6, 0xB5: 4, 0xD5: 4, 0x13: 4,
+        0x33: 4, 0x03: 3, 0x23: 3, 0xC4: 2, 0x54: 4, 0x44: 4, 0x53: 4,
+        0x43: 4, 0xC0: 3, 0xD0: 3, 0xA2: 3, 0x92: 3, 0xF4: 2, 0xB2: 2,
+        0xC5: 2, 0xA4: 2, 0x84: 1, 0x08: 3, 0x0F: 3,
+    }
+    # registers, immediates and jump offsets
+    for _b in range(0x78, 0x80): PRIOR[_b] = 4
+    for _b in range(0xE8, 0xF0): PRIOR[_b] = 4
+    for _b in range(0xF8, 0xFF): PRIOR[_b] = 3
+    for _b in range(0xD8, 0xE0): PRIOR[_b] = 3
+    del _b
+
+    # settings page: 0xFF fillers, small parameter values and ascii tags
+    SETTINGS_PRIOR = { 0xFF: 60, 0x00: 30, 0x20: 30 }
+    for _b in range(0x01, 0x10): SETTINGS_PRIOR[_b] = 12
+    for _b in b"#_.()-": SETTINGS_PRIOR[_b] = 6
+    for _b in range(0x30, 0x3A): SETTINGS_PRIOR[_b] = 5
+    for _b in range(0x41, 0x5B): SETTINGS_PRIOR[_b] = 4
+    for _b in range(0x61, 0x7B): SETTINGS_PRIOR[_b] = 3
+    del _b
+
+    def __init__(self, prior = None):
+        prior = self.PRIOR if prior is None else prior
+        self.counts = [prior.get(b, 0) for b in range(256)]
+        self.order  = sorted(range(256), key=lambda b: -self.counts[b])
+        self.rank   = [0] * 256
+        for i, b in enumerate(self.order):
+            self.rank[b] = i
+        self.follows = {}
+
+    def candidates(self, previous):
+        """yield all byte values, most likely first, given the previous byte"""
+        seen = self.follows.get(previous)
+        if seen:
+            tried = sorted(seen, key=seen.get, reverse=True)
+            yield from tried
+            for b in self.order:
+                if b not in seen:
+                    yield b
+        else:
+            yield from self.order
+
+    def update(self, previous, byte):
+        """learn from a recovered byte"""
+        seen = self.follows.setdefault(previous, {})
+        seen[byte] = seen.get(byte, 0) + 1
+
+        #keep the overall order sorted by moving the byte forward
+        counts = self.counts
+        counts[byte] += 1
+        i = self.rank[byte]
+        while (i > 0) and (counts[self.order[i-1]] < counts[byte]):
+            other = self.order[i-1]
+            self.order[i] = other
+            self.rank[other] = i
+            i = i - 1
+        self.order[i] = byte
+        self.rank[byte] = i
+
+def print_output(message, end):
+    print(message, end=end)
+    sys.stdout.flush()
+
+class JsonCache:
+    """A json file in the user cache directory, shared by all threads
+
+    Subclasses set FILENAME and their own lock. Failing to write the file
+    is ignored, the caches are only an optimization.
+    """
+
+    FILENAME = None
+
+    def __init__(self, path = None):
+        if path is None:
+            cache_dir = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+            path = os.path.join(cache_dir, "efm8load", self.FILENAME)
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self, data):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp_path = "%s.%d.tmp" % (self.path, os.getpid())
+            with open(temp_path, "w") as f:
+                json.dump(data, f, indent=2, sort_keys=True)
+            os.replace(temp_path, self.path)
+        except OSError:
+            #the cache is only an optimization
+            pass
+
+    @staticmethod
+    def key(port):
+        """ identify an adapter by its USB serial number if it has one """
+        try:
+            for info in serial.tools.list_ports.comports():
+                if (info.device == port) and info.serial_number:
+                    return "%04X:%04X:%s" % (info.vid or 0, info.pid or 0, info.serial_number)
+        except Exception:
+            pass
+        return port
+
+class DeviceCache(JsonCache):
+    """Remembers which device was detected on each port or USB adapter
+
+    The cache is a small json file holding the last (device_id, variant_id)
+    per adapter and how often each variant was seen, so identify_chip() can
+    probe the likely candidates first.
+    """
+
+    FILENAME = "devices.json"
+    lock = threading.Lock()
+
+    def load(self):
+        data = JsonCache.load(self)
+        data.setdefault("ports", {})
+        data.setdefault("counts", {})
+        data.setdefault("baudrates", {})
+        return data
+
+    @staticmethod
+    def variant_key(device_id, variant_id):
+        return "%02X:%02X" % (device_id, variant_id)
+
+    def lookup(self, port):
+        """ returns (device_id, variant_id) last seen on this port and the counts per variant """
+        with self.lock:
+            data = self.load()
+        last = data["ports"].get(self.key(port))
+        counts = {}
+        for variant, count in data["counts"].items():
+            device_id, variant_id = variant.split(":")
+            counts[(int(device_id, 16), int(variant_id, 16))] = count
+        return (tuple(last) if last else None), counts
+
+    def store(self, port, device_id, variant_id):
+        with self.lock:
+            data = self.load()
+            data["ports"][self.key(port)] = [device_id, variant_id]
+            variant = self.variant_key(device_id, variant_id)
+            data["counts"][variant] = data["counts"].get(variant, 0) + 1
+            self.save(data)
+
+    def baudrate(self, port):
+        """ fastest baudrate that worked on this adapter, if any """
+        with self.lock:
+            return self.load()["baudrates"].get(self.key(port))
+
+    def store_baudrate(self, port, baudrate):
+        with self.lock:
+            data = self.load()
+            data["baudrates"][self.key(port)] = baudrate
+            self.save(data)
+
+class UploadJournal(JsonCache):
+    """Pages written by an unfinished upload, per port or USB adapter
+
+    A page is recorded once all of its chunks were acknowledged, along
+    with the sha256 of the hex file and the device. flash[0] stays 0xFF
+    until an upload is finished, so the next upload of the same image can
+    confirm the recorded pages with VERIFY and only write the rest.
+    Methods take the adapter key, see JsonCache.key().
+    """
+
+    FILENAME = "journal.json"
+    lock = threading.Lock()
+
+    def pages(self, key, image, device):
+        """ pages recorded for this image and device """
+        with self.lock:
+            entry = self.load().get(key)
+        if entry and (entry.get("image") == image) and (entry.get("device") == device):
+            return set(entry.get("pages", []))
+        return set()
+
+    def begin(self, key, image, device, pages = ()):
+        with self.lock:
+            data = self.load()
+            data[key] = { "image": image, "device": device, "pages": sorted(pages) }
+            self.save(data)
+
+    def add(self, key, page):
+        with self.lock:
+            data = self.load()
+            entry = data.get(key)
+            if (entry is not None) and (page not in entry["pages"]):
+                entry["pages"].append(page)
+                self.save(data)
+
+    def clear(self, key):
+        with self.lock:
+            data = self.load()
+            if data.pop(key, None) is not None:
+                self.save(data)
+
+#CRC-16/XMODEM as checked by the VERIFY command, built once
+#crc16(data, crc = 0) takes any buffer, memoryview slices are not copied
+crc16 = crcmod.predefined.mkCrcFun('xmodem')
+
+def crc16_multiply(a, b):
+    """ a * b modulo the CRC-16/XMODEM polynomial """
+    result = 0
+    while b:
+        if b & 1:
+            result ^= a
+        b >>= 1
+        a <<= 1
+        if a & 0x10000:
+            a ^= 0x11021
+    return result
+
+@functools.lru_cache(maxsize=None)
+def crc16_shift_table(length):
+    """ (low, high) byte tables moving a crc past length zero bytes
+
+    crc * x^(8 * length) = low[crc & 0xFF] ^ high[crc >> 8]
+    """
+    #a crc started at 1 over zero bytes is x^(8 * length)
+    power = crc16(bytes(length), 1)
+    basis = [crc16_multiply(1 << bit, power) for bit in range(16)]
+    low  = [0] * 256
+    high = [0] * 256
+    for value in range(1, 256):
+        bit = (value & -value).bit_length() - 1
+        low[value]  = low[value & (value - 1)] ^ basis[bit]
+        high[value] = high[value & (value - 1)] ^ basis[bit + 8]
+    return low, high
+
+class CRCIndex:
+    """Prefix CRCs of a buffer for the crc of any range without rescanning it
+
+    The crc of buffer[:address] is stored for every block boundary. As
+    CRC-16/XMODEM starts at 0 and is linear, the crc of buffer[start:end]
+    is the prefix crc at end xor the prefix crc at start moved past
+    end - start zero bytes. Moving a crc costs a table lookup per power
+    of two blocks, so a range costs two partial blocks no matter how long
+    it is. Ranges up to a few blocks are cheaper to compute directly.
+    """
+
+    def __init__(self, data, block = 128):
+        self.view   = memoryview(data)
+        self.block  = block
+        self.direct = 4 * block
+        self.zeros  = bytes(block)
+        prefixes = [0]
+        crc = 0
+        for start in range(0, len(self.view), block):
+            crc = crc16(self.view[start:start + block], crc)
+            prefixes.append(crc)
+        self.prefixes = prefixes
+
+    def shift(self, crc, length):
+        """ crc moved past length zero bytes """
+        blocks, rest = divmod(length, self.block)
+        crc = crc16(self.zeros[:rest], crc)
+        size = self.block
+        while blocks:
+            if blocks & 1:
+                low, high = crc16_shift_table(size)
+                crc = low[crc & 0xFF] ^ high[crc >> 8]
+            blocks >>= 1
+            size <<= 1
+        return crc
+
+    def prefix(self, address):
+        """ crc of buffer[:address] """
+        block_start = address - (address % self.block)
+        return crc16(self.view[block_start:address], self.prefixes[block_start // self.block])
+
+    def crc(self, start, end):
+        """ crc of buffer[start:end] """
+        if (end - start <= self.direct):
+            return crc16(self.view[start:end])
+        return self.prefix(end) ^ self.shift(self.prefix(start), end - start)
+
+class FlashPlan:
+    """Erase, write and verify schedule of an image, built once
+
+    The image is held in one buffer padded with 0xFF to whole pages, along
+    with a bitmap of occupied pages and the precomputed lists of pages to
+    erase, 128 byte chunks to write and CRCs to verify.
+    """
+
+    # typical EFM8 flash timing: page erase and byte write (in seconds)
+    ERASE_TIME = 0.0052
+    WRITE_TIME = 0.000019
+
+    def __init__(self, data, segments, page_size = 512, page_crcs = None):
+        self.page_size = page_size
+        self.segments  = segments
+        self.data      = data
+        self.view      = memoryview(data)
+        self.crc_index = CRCIndex(data)
+        #page : crc of the used pages, filled on demand or from ImageCache
+        self.page_crcs = dict(page_crcs or {})
+        #bitmap of pages holding image data
+        self.page_map  = bytearray(len(data) // page_size)
+        for start, end in segments:
+            for page in range(start // page_size, (end - 1) // page_size + 1):
+                self.page_map[page] = 1
+        self.used_pages = [page for page, used in enumerate(self.page_map) if used]
+        #flash[0] is written last, see EFM8Loader.write_pages()
+        self.byte_zero = data[0] if (segments and segments[0][0] == 0) else None
+        #schedule of a full upload
+        self.erase, self.runs = self.schedule()
+        self.verify = [(start, end, self.crc(start, end)) for start, end in segments]
+
+    @classmethod
+    def from_ihex(cls, ih, page_size = 512):
+        """ build a plan in a single pass over the addresses of an ihex """
+        addresses = sorted(address for address in ih.todict() if isinstance(address, int))
+        if not addresses:
+            raise ValueError("image is empty")
+        size = addresses[-1] + 1
+        data = bytearray(b"\xFF") * (((size + page_size - 1) // page_size) * page_size)
+        segments = []
+        start = previous = addresses[0]
+        for address in addresses:
+            data[address] = ih[address]
+            if (address != previous + 1) and (address != start):
+                segments.append((start, previous + 1))
+                start = address
+            previous = address
+        segments.append((start, previous + 1))
+        return cls(data, segments, page_size)
+
+    @classmethod
+    def from_file(cls, filename, page_size = 512):
+        ih = IntelHex()
+        ih.loadhex(filename)
+        return cls.from_ihex(ih, page_size)
+
+    def crc(self, start, end):
+        return self.crc_index.crc(start, end)
+
+    def page_range(self, page):
+        start = page * self.page_size
+        return start, start + self.page_size
+
+    def page_crc(self, page):
+        """ crc of a page as it reads after erasing and writing it """
+        crc = self.page_crcs.get(page)
+        if crc is None:
+            crc = self.page_crcs[page] = self.crc(*self.page_range(page))
+        return crc
+
+    def clip(self, pages = None):
+        """ segments clipped to the selected pages """
+        for start, end in self.segments:
+            if pages is None:
+                yield start, end
+                continue
+            run_start = None
+            address = start
+            while address < end:
+                page = address // self.page_size
+                page_end = min((page + 1) * self.page_size, end)
+                if page in pages:
+                    if run_start is None:
+                        run_start = address
+                elif run_start is not None:
+                    yield run_start, address
+                    run_start = None
+                address = page_end
+            if run_start is not None:
+                yield run_start, end
+
+    def schedule(self, pages = None):
+        """ pages to erase and (start, end, chunks, crc) runs to write for the selected pages """
+        #always erase page 0 to retain bootloader access
+        erase = [page for page in self.used_pages if (pages is None) or (page in pages)]
+        if (0 not in erase) and ((pages is None) or (0 in pages)):
+            erase.insert(0, 0)
+        runs = []
+        for start, end in self.clip(pages):
+            if start == 0:
+                start = 1
+            if start >= end:
+                continue
+            chunks = [(address, self.view[address:min(address + 128, end)]) for address in range(start, end, 128)]
+            runs.append((start, end, chunks, self.crc(start, end)))
+        return erase, runs
+
+    def estimate(self, baudrate, latency = 0.001, pages = None):
+        """ round trips, bytes on the wire and time of an upload """
+        erase, runs = self.schedule(pages) if pages is not None else (self.erase, self.runs)
+        #every frame is '$', length, command and data, answered by one byte
+        frames = [2] * len(erase)
+        written = 0
+        for start, end, chunks, crc in runs:
+            frames += [2 + len(chunk) for address, chunk in chunks]
+            frames.append(6)
+            written += end - start
+        if self.byte_zero is not None:
+            frames += [3, 6]
+            written += 1
+        frames += [6] * len(self.verify)
+        #session handshake (training, setup) and identify
+        wire = 2 + 7 + 6 + sum(3 + length + 1 for length in frames)
+        round_trips = 2 + len(frames)
+        seconds = wire * 10.0 / baudrate + round_trips * latency + \
+                  len(erase) * self.ERASE_TIME + written * self.WRITE_TIME
+        return { "round_trips": round_trips, "wire_bytes": wire, "erase_pages": len(erase),
+                 "write_bytes": written, "seconds": seconds }
+
+    def describe(self, baudrate, latency = 0.001):
+        """ human readable summary of the plan """
+        chunks = sum(len(run[2]) for run in self.runs)
+        estimate = self.estimate(baudrate, latency)
+        lines = ["> %d segments, %d of %d pages used, page size %d" % (len(self.segments), len(self.used_pages), len(self.page_map), self.page_size)]
+        for start, end in self.segments:
+            lines.append(">   segment 0x%04X-0x%04X (%d bytes)" % (start, end - 1, end - start))
+        lines.append("> erase %d pages: %s" % (len(self.erase), " ".join(str(page) for page in self.erase)))
+        lines.append("> write %d chunks (%d bytes)" % (chunks, estimate["write_bytes"]))
+        if self.byte_zero is not None:
+            lines.append("> write flash[0] = 0x%02X last" % (self.byte_zero))
+        lines.append("> verify %d segments" % (len(self.verify)))
+        lines.append("> %d round trips, %d bytes on the wire, estimated %.2fs at %d baud (%.1fms latency)" %
+                     (estimate["round_trips"], estimate["wire_bytes"], estimate["seconds"], baudrate, latency * 1000))
+        return lines
+
+class ReferenceLibrary:
+    """Page crcs of known builds, used to dump a flash page by page
+
+    For every flash page the crcs of all builds are indexed, pages a build
+    does not use count as erased. Every matched page scores the builds
+    holding it, so the crcs of the leading builds are tried first on the
+    next page.
+    """
+
+    # crcs of other builds tried on a page after those of the leading builds
+    EXTRA_CANDIDATES = 4
+
+    def __init__(self, references, page_size, flash_size):
+        self.names      = [name for name, plan in references]
+        self.plans      = [plan for name, plan in references]
+        self.page_size  = page_size
+        self.page_count = flash_size // page_size
+        self.erased_crc = crc16(b"\xFF" * page_size)
+        self.scores     = [0] * len(self.plans)
+        #per page: crc : builds holding it
+        self.pages = []
+        for page in range(self.page_count):
+            crcs = {}
+            for build, plan in enumerate(self.plans):
+                crcs.setdefault(self.page_crc(plan, page), []).append(build)
+            self.pages.append(crcs)
+        #pages shared by many builds first, they single out the leading
+        #builds before the pages that differ between all of them
+        self.order = sorted(range(self.page_count), key=lambda page: len(self.pages[page]))
+
+    @classmethod
+    def from_directory(cls, directory, load, page_size, flash_size):
+        """ index all hex files in a directory, load(filename) returns their FlashPlan """
+        references = []
+        for filename in sorted(glob.glob(os.path.join(directory, "*.hex"))):
+            try:
+                references.append((os.path.basename(filename), load(filename)))
+            except (OSError, ValueError):
+                continue
+        if not references:
+            raise EFM8Error("no hex files found in '%s'" % (directory))
+        return cls(references, page_size, flash_size)
+
+    def page_crc(self, plan, page):
+        if (page < len(plan.page_map)) and plan.page_map[page]:
+            return plan.page_crc(page)
+        return self.erased_crc
+
+    def page_data(self, build, page):
+        """ content of a page of a build as it reads from flash """
+        plan = self.plans[build]
+        start = page * self.page_size
+        if (page < len(plan.page_map)) and plan.page_map[page]:
+            return plan.view[start:start + self.page_size]
+        return b"\xFF" * self.page_size
+
+    def candidates(self, page):
+        """ crcs of this page except the erased one, those of the leading builds first """
+        crcs = self.pages[page]
+        ranked = sorted((crc for crc in crcs if crc != self.erased_crc),
+                        key=lambda crc: (-max(self.scores[build] for build in crcs[crc]), -len(crcs[crc])))
+        top = max(self.scores)
+        leading = [crc for crc in ranked if max(self.scores[build] for build in crcs[crc]) == top]
+        return leading + ranked[len(leading):len(leading) + self.EXTRA_CANDIDATES]
+
+    def match(self, page, crc):
+        """ score the builds holding crc on this page, returns the best of them """
+        builds = self.pages[page].get(crc, [])
+        for build in builds:
+            self.scores[build] += 1
+        return max(builds, key=lambda build: self.scores[build]) if builds else None
+
+    def best(self):
+        return max(range(len(self.scores)), key=lambda build: self.scores[build])
+
+    def differences(self, build, ih):
+        """ (start, end, inside) ranges where a dump differs from a build
+
+        inside tells whether the range lies on pages used by the build,
+        unreadable addresses are skipped
+        """
+        plan = self.plans[build]
+        dump = ih.todict()
+        ranges = []
+        for page in range(self.page_count):
+            data = self.page_data(build, page)
+            inside = (page < len(plan.page_map)) and bool(plan.page_map[page])
+            start = page * self.page_size
+            for offset in range(self.page_size):
+                address = start + offset
+                if (dump.get(address, data[offset]) == data[offset]):
+                    continue
+                if ranges and (ranges[-1][1] == address) and (ranges[-1][2] == inside):
+                    ranges[-1][1] = address + 1
+                else:
+                    ranges.append([address, address + 1, inside])
+        return [tuple(entry) for entry in ranges]
+
+class ImageCache:
+    """Compiled images of hex files, keyed by the sha256 of the hex file
+
+    Every hex file gets an entry in a .efm8cache directory next to it: the
+    padded image as a flat binary, which is memory mapped on load, and a
+    json sidecar with its segments and page crcs. Entries are named
+    <hex file>-<sha256>-<page size>. A changed hex file has a different
+    hash and is compiled again, its stale entries are removed.
+    """
+
+    VERSION = 1
+
+    def __init__(self, directory = None):
+        #None keeps the cache next to each hex file
+        self.directory = directory
+
+    def entry(self, filename, digest, page_size):
+        directory = self.directory or os.path.join(os.path.dirname(os.path.abspath(filename)), ".efm8cache")
+        base = os.path.join(directory, "%s-%s-%d" % (os.path.basename(filename), digest, page_size))
+        return base + ".bin", base + ".json"
+
+    @staticmethod
+    def digest(filename):
+        with open(filename, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    def load(self, filename, page_size = 512):
+        """ FlashPlan of a hex file, compiled and stored on the first load """
+        digest = self.digest(filename)
+        bin_path, json_path = self.entry(filename, digest, page_size)
+        try:
+            with open(json_path) as f:
+                sidecar = json.load(f)
+            if (sidecar["version"] == self.VERSION):
+                with open(bin_path, "rb") as f:
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                if (len(data) == sidecar["size"]):
+                    return FlashPlan(data, [tuple(segment) for segment in sidecar["segments"]], page_size,
+                                     dict((page, crc) for page, crc in sidecar["page_crcs"]))
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        plan = FlashPlan.from_file(filename, page_size)
+        self.store(filename, digest, plan, bin_path, json_path)
+        return plan
+
+    def store(self, filename, digest, plan, bin_path, json_path):
+        sidecar = { "version": self.VERSION, "source": os.path.basename(filename), "size": len(plan.data),
+                    "segments": plan.segments, "used_pages": plan.used_pages,
+                    "page_crcs": [(page, plan.page_crc(page)) for page in plan.used_pages] }
+        try:
+            directory = os.path.dirname(bin_path)
+            os.makedirs(directory, exist_ok=True)
+            self.prune(directory, sidecar["source"], digest)
+            #the sidecar is written last, an entry without one is never used
+            for path, mode, content in ((bin_path, "wb", plan.data), (json_path, "w", None)):
+                temp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+                with open(temp_path, mode) as f:
+                    if content is None:
+                        json.dump(sidecar, f)
+                    else:
+                        f.write(content)
+                os.replace(temp_path, path)
+        except OSError:
+            #the cache is only an optimization
+            pass
+
+    @staticmethod
+    def prune(directory, source, digest):
+        """ remove the entries of other versions of a hex file, found by their names """
+        pattern = re.compile(re.escape(source) + r"-([0-9a-f]{64})-\d+\.(bin|json)")
+        for path in glob.glob(os.path.join(glob.escape(directory), glob.escape(source) + "-*")):
+            match = pattern.fullmatch(os.path.basename(path))
+            if (match is None or match.group(1) == digest):
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+class Stats:
+    """Records every command sent with its phase, frame size, latency and response"""
+
+    # upper bounds of the latency histogram buckets (in ms)
+    BUCKETS = [ 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000 ]
+
+    def __init__(self):
+        self.records = []
+        self.seconds = collections.OrderedDict()
+        #stack of [phase, started, time spent in nested phases]
+        self.stack   = [["other", time.monotonic(), 0.0]]
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ attribute all commands sent in this context to a phase """
+        entry = [name, time.monotonic(), 0.0]
+        self.stack.append(entry)
+        try:
+            yield
+        finally:
+            self.stack.pop()
+            elapsed = time.monotonic() - entry[1]
+            self.seconds[name] = self.seconds.get(name, 0.0) + elapsed - entry[2]
+            self.stack[-1][2] += elapsed
+
+    def record(self, cmd, size, latency, res):
+        self.records.append((self.stack[-1][0], cmd, size, latency, res))
+
+    def histogram(self, latencies):
+        counts = [0] * (len(self.BUCKETS) + 1)
+        for latency in latencies:
+            for i, bucket in enumerate(self.BUCKETS):
+                if (latency * 1000 <= bucket):
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+        labels = ["<=%gms" % (bucket) for bucket in self.BUCKETS] + [">%gms" % (self.BUCKETS[-1])]
+        return collections.OrderedDict((label, count) for label, count in zip(labels, counts) if count)
+
+    def summary(self):
+        """ per phase and per command totals, ready to be stored as json """
+        phases = collections.OrderedDict()
+        for phase, cmd, size, latency, res in self.records:
+            totals = phases.setdefault(phase, { "round_trips": 0, "bytes_sent": 0, "commands": collections.OrderedDict() })
+            totals["round_trips"] += 1
+            totals["bytes_sent"] += size
+            command = totals["commands"].setdefault(COMMAND.TO_STR.get(cmd, "0x%02X" % (cmd)),
+                                                    { "count": 0, "bytes_sent": 0, "latencies": [], "responses": {} })
+            command["count"] += 1
+            command["bytes_sent"] += size
+            command["latencies"].append(latency)
+            response = "TIMEOUT" if res is None else RESPONSE.to_string(res)
+            command["responses"][response] = command["responses"].get(response, 0) + 1
+
+        #time outside of any phase
+        root = self.stack[0]
+        seconds = dict(self.seconds)
+        seconds[root[0]] = time.monotonic() - root[1] - root[2]
+        for name, totals in phases.items():
+            totals["seconds"] = round(seconds.get(name, 0.0), 6)
+            for command in totals["commands"].values():
+                latencies = command.pop("latencies")
+                command["latency_ms"] = { "total": round(sum(latencies) * 1000, 3),
+                                          "mean": round(sum(latencies) * 1000 / len(latencies), 3),
+                                          "min": round(min(latencies) * 1000, 3),
+                                          "max": round(max(latencies) * 1000, 3) }
+                command["histogram"] = self.histogram(latencies)
+
+        return { "total": { "round_trips": len(self.records),
+                            "bytes_sent": sum(record[2] for record in self.records),
+                            "bytes_received": sum(1 for record in self.records if record[4] is not None),
+                            "seconds": round(time.monotonic() - self.stack[0][1], 6) },
+                 "phases": phases }
+
+def phase(name):
+    """ decorator attributing all commands sent by a loader method to a phase """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.stats.phase(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+class ProgressBar:
+    """A single line progress bar, redrawn at most every interval seconds"""
+
+    def __init__(self, output, width = 40, interval = 0.1):
+        self.output   = output
+        self.width    = width
+        self.interval = interval
+        self.label    = None
+
+    def start(self, label, total):
+        self.label = label
+        self.total = max(total, 1)
+        self.done  = 0
+        self.last  = 0
+        self.draw()
+
+    def advance(self, count = 1):
+        if self.label is None:
+            return
+        self.done = min(self.done + count, self.total)
+        if (time.monotonic() - self.last >= self.interval) or (self.done == self.total):
+            self.draw()
+
+    def draw(self):
+        self.last = time.monotonic()
+        filled = self.width * self.done // self.total
+        self.output("\r> %s [%s%s] %3d%%" % (self.label, "#" * filled, "." * (self.width - filled),
+                                             100 * self.done // self.total), "")
+
+    def finish(self):
+        if self.label is not None:
+            self.done = self.total
+            self.draw()
+            self.output("", "\n")
+            self.label = None
+
 class EFM8Loader:
     """A python implementation of the EFM8 bootloader protocol"""
 
@@ -84,142 +874,452 @@ class EFM8Loader:
                                          }]
                  }
 
-    def __init__(self, port, baud, debug = False):
+    # (DEVICE_ID, VARIANT_ID) in the order they are most common on ESCs,
+    # variants not listed here are probed afterwards in devicelist order
+    fleet_order = [ (0x32, 0x02), (0x32, 0x03), (0x30, 0x02), (0x32, 0x01), (0x30, 0x01), (0x34, 0x01) ]
+
+    # (DEVICE_ID, VARIANT_ID) : [ DEVICE_NAME, VARIANT CONFIG ]
+    variants = dict(((device_id, variant_id), [device[0], config])
+                    for device_id, device in devicelist.items()
+                    for variant_id, config in device[1].items())
+
+    # maximum payload of a single frame
+    MAX_DATA = 130
+
+    # baudrates tried by --baudrate auto, slowest first
+    BAUDRATE_LADDER = [ 115200, 230400, 460800, 921600 ]
+    # probes that have to pass at a baudrate before it is used
+    BAUDRATE_PROBES = 3
+
+    # smallest range a failed verify is narrowed down to
+    VERIFY_BLOCK = 128
+
+    # crc of every single byte value
+    byte_crc = [crc16(bytes((byte,))) for byte in range(256)]
+
+    # start of the Bluejay settings page ("eeprom") per device, see src/Modules/Codespace.asm
+    SETTINGS_ADDRESS = { "EFM8BB1": 0x1A00, "EFM8BB2": 0x1A00 }
+    # settings, layout tag, mcu tag, name and melody, as offsets into the settings page
+    SETTINGS_FIELDS = [ ("settings", 0x00, 48), ("layout tag", 0x40, 16), ("mcu tag", 0x50, 16),
+                        ("name", 0x60, 16), ("melody", 0x70, 140) ]
+    SETTINGS_SIZE = 0x70 + 140
+    # offset of Eep_Initialized_L/H, the firmware resets all settings unless it reads 0x55 0xAA
+    SETTINGS_SIGNATURE = 13
+
+    def __init__(self, port, baud, debug = False, timeouts = None, pipeline = 1, output = None,
+                 cache = None, scan = True, scan_timeout = 0.05, quiet = False, verify_retries = 2,
+                 image_cache = None, settings_address = None, journal = None):
         self.debug           = debug
+        #receives every message as output(message, end)
+        self.output          = output or print_output
+        #every command sent is recorded here
+        self.stats           = Stats()
+        #in quiet mode per chunk messages are replaced by a progress bar
+        self.progress        = ProgressBar(self.log) if quiet else None
         self.serial          = serial.Serial()
         self.serial.port     = port
+        #negotiate the fastest working baudrate on the first training
+        self.auto_baud       = (baud == "auto")
+        self.baudrates       = [ ]
+        if (self.auto_baud):
+            baud = self.BAUDRATE_LADDER[0]
         self.serial.baudrate = baud
         self.serial.timeout  = 1
+        #reply timeout per command
+        self.timeouts        = dict(COMMAND.TIMEOUT)
+        if timeouts:
+            self.timeouts.update(timeouts)
+        #number of WRITE frames that may be in flight before waiting for a reply
+        self.pipeline        = max(1, pipeline)
+        #every frame is encoded into this buffer: '$', length, command, data
+        self.frame           = bytearray(3 + self.MAX_DATA)
+        self.frame_view      = memoryview(self.frame)
         #defaults
         self.flash_page_size = 512
         self.flash_size      = 16*1024
         self.flash_security_size = 512
-        #open serial connection
-        self.open_port()
+        self.round_trips     = 0
+        self.device_name     = None
+        self.device_family   = None
+        #remembers the detected device per port (see DeviceCache)
+        self.cache           = cache
+        #scan all ids if no known device answers
+        self.scan            = scan
+        self.scan_timeout    = scan_timeout
+        #session state, training and setup are only sent once per session
+        self.connected       = False
+        #number of times pages failing verify are rewritten before giving up
+        self.verify_retries  = verify_retries
+        #compiled hex files (see ImageCache)
+        self.image_cache     = image_cache
+        #overrides SETTINGS_ADDRESS, e.g. 0x3000 on BB51
+        self.settings_address = settings_address
+        #records the progress of uploads (see UploadJournal)
+        self.journal         = journal
+        self.journal_key     = None
+
+    def __enter__(self):
+        if not self.serial.is_open:
+            self.open_port()
+        return self
+
+    def __exit__(self, *args):
+        self.close_port()
 
     def __del__(self):
-        self.close_port()
+        try:
+            self.close_port()
+        except EFM8Error:
+            pass
+
+    def log(self, message = "", end = "\n"):
+        self.output(message, end)
+
+    def detail(self, message, end = "\n", count = 1):
+        """ per chunk messages, replaced by the progress bar in quiet mode """
+        if self.progress is not None:
+            self.progress.advance(count)
+        else:
+            self.log(message, end)
+
+    def progress_start(self, label, total):
+        if self.progress is not None:
+            self.progress.start(label, total)
+
+    def progress_finish(self):
+        if self.progress is not None:
+            self.progress.finish()
 
     def open_port(self):
-        print("> opening port '%s' (%d baud)" % (self.serial.port, self.serial.baudrate))
+        self.log("> opening port '%s' (%s baud)" % (self.serial.port, "auto" if self.auto_baud else self.serial.baudrate))
         try:
             self.serial.open()
-        except:
-            sys.exit("ERROR: failed to open serial port '%s'!" % (self.serial.port))
+        except (serial.SerialException, OSError, ValueError):
+            raise PortError("failed to open serial port '%s'" % (self.serial.port))
+        self.connected = False
 
     def close_port(self):
+        self.connected = False
         try:
             self.serial.close()
         except serial.SerialException:
-            sys.exit("ERROR: failed to close serial port")
+            raise PortError("failed to close serial port '%s'" % (self.serial.port))
+
+    def connect(self):
+        """ train the autobaud detection and enable flash access once per session """
+        if self.connected:
+            return
+        self.send_autobaud_training()
+        self.enable_flash_access()
+        self.connected = True
+
+    def identify(self):
+        """ identify the chip unless this session already did, connect again after a reset """
+        if self.device_name is None:
+            self.identify_chip()
+        else:
+            self.connect()
 
     def send_autobaud_training(self):
-        if (self.debug): print("> sending training char 0xFF")
+        if (self.auto_baud) and not (self.baudrates):
+            self.negotiate_baudrate()
+            return
+        if (self.debug): self.log("> sending training char 0xFF")
+        for i in range(2):
+            self.send_byte(0xff)
+
+    def set_baudrate(self, baudrate):
+        """ switch the port to a baudrate and let the bootloader train on it """
+        self.serial.baudrate = baudrate
+        self.serial.reset_input_buffer()
         for i in range(2):
             self.send_byte(0xff)
 
+    def probe_baudrate(self, baudrate):
+        """ check that the bootloader answers reliably at this baudrate """
+        self.set_baudrate(baudrate)
+        order = self.probe_order()
+        for i in range(self.BAUDRATE_PROBES):
+            #any valid reply shows the frame got through unharmed
+            if (self.send(COMMAND.SETUP, [0xA5, 0xF1, 0x00], allow_timeout=True) != RESPONSE.ACK):
+                return False
+            device_id, variant_id = order[i % len(order)]
+            if (self.send(COMMAND.IDENTIFY, [device_id, variant_id], allow_timeout=True) not in (RESPONSE.ACK, RESPONSE.BAD_ID)):
+                return False
+            if (self.send(COMMAND.VERIFY, [0x00, 0x00, 0x00, 0x7F, 0x00, 0x00], allow_timeout=True) not in RESPONSE.TO_STR):
+                return False
+        return True
+
+    @phase("baudrate")
+    def negotiate_baudrate(self):
+        """ climb the baudrate ladder and keep the fastest rate that works """
+        cached = self.cache.baudrate(self.serial.port) if self.cache is not None else None
+        if (cached in self.BAUDRATE_LADDER) and self.probe_baudrate(cached):
+            self.baudrates = [rate for rate in self.BAUDRATE_LADDER if rate <= cached]
+        else:
+            for baudrate in self.BAUDRATE_LADDER:
+                if not self.probe_baudrate(baudrate):
+                    break
+                self.baudrates.append(baudrate)
+            if not self.baudrates:
+                raise ReplyTimeout("no baudrate worked, is the bootloader running?")
+            #go back to the fastest working rate
+            if (self.serial.baudrate != self.baudrates[-1]):
+                self.set_baudrate(self.baudrates[-1])
+            if self.cache is not None:
+                self.cache.store_baudrate(self.serial.port, self.baudrates[-1])
+        self.log("> using %d baud" % (self.serial.baudrate))
+
+    def fall_back_baudrate(self):
+        """ drop to the next slower baudrate after a failed frame, returns False if there is none """
+        if not (self.auto_baud) or (len(self.baudrates) < 2):
+            return False
+        self.baudrates.pop()
+        self.log("> link errors, falling back to %d baud" % (self.baudrates[-1]))
+        self.set_baudrate(self.baudrates[-1])
+        if self.cache is not None:
+            self.cache.store_baudrate(self.serial.port, self.baudrates[-1])
+        #flash access has to be enabled again after training
+        return self.send(COMMAND.SETUP, [0xA5, 0xF1, 0x00], allow_timeout=True) == RESPONSE.ACK
+
     def send_byte(self, b):
         try:
             self.serial.write(b.to_bytes(1, 'little'))
         except serial.SerialException:
-            sys.exit("ERROR: failed to send byte to serial port")
+            raise PortError("failed to send byte to serial port")
 
+    @phase("identify")
     def identify_chip(self):
-        print("> checking for device")
-
-        #send autobaud training
-        self.send_autobaud_training()
-
-        #enable flash access
-        self.enable_flash_access()
-
-        #we will now iterate through all known device ids
-        for device_id, device in self.devicelist.items():
-            device_name = device[0]
-            variant_ids = device[1]
-            if (self.debug): print("> checking for device %s" % (device_name))
-            for variant_id, config in variant_ids.items():
-                #test all possible variant ids
-                variant_name = config[0]
-
-                if (self.check_id(device_id, variant_id)):
-                    print("> success, detected %s cpu (variant %s)" % (device_name, variant_name))
-                    #set up chip data
-                    self.flash_size               = config[1]
-                    self.flash_page_size          = config[2]
-                    self.flash_security_page_size = config[3]
-                    print("> detected %s cpu (variant %s, flash_size=%d, pagesize=%d)" % (device_name, variant_name, self.flash_size, self.flash_page_size))
-                    return 1
-
-        #we did not detect a known device, scann all posible ids:
-        for device_id in range(0xFF):
-            print("\r> checking device_id 0x%02X..." % (device_id), end="")
-            sys.stdout.flush()
-            for variant_id in range(24):
-                if (self.check_id(device_id, variant_id)):
-                    sys.exit("\n> ERROR: unknown device detected: id=0x%02X, variant=0x%02X\n"\
-                             "         please add it to the devicelist. will exit now\n" % (device_id, variant_id))
-
-        sys.exit("> ERROR: could not find any device...")
-
+        """ find the connected chip and set up its flash geometry """
+        self.log("> checking for device")
+
+        #send autobaud training and enable flash access
+        self.connect()
+
+        #we will now iterate through all known device ids, most likely first
+        for device_id, variant_id in self.probe_order():
+            device_name, config = self.variants[(device_id, variant_id)]
+            if (self.debug): self.log("> checking for device %s" % (config[0]))
+            if (self.check_id(device_id, variant_id)):
+                self.set_device(device_id, variant_id)
+                if self.cache is not None:
+                    self.cache.store(self.serial.port, device_id, variant_id)
+                return 1
+
+        if not self.scan:
+            raise DeviceError("could not find any known device")
+
+        #we did not detect a known device, scan all possible ids
+        #with a short timeout, press ctrl+c to stop early
+        timeout = self.timeouts[COMMAND.IDENTIFY]
+        self.timeouts[COMMAND.IDENTIFY] = self.scan_timeout
+        try:
+            for device_id in range(0xFF):
+                self.log("\r> checking device_id 0x%02X..." % (device_id), end="")
+                for variant_id in range(24):
+                    if ((device_id, variant_id) in self.variants):
+                        continue
+                    if (self.check_id(device_id, variant_id, allow_timeout=True)):
+                        self.log("")
+                        raise DeviceError("unknown device detected: id=0x%02X, variant=0x%02X, "\
+                                          "please add it to the devicelist" % (device_id, variant_id))
+        except KeyboardInterrupt:
+            self.log("")
+            raise DeviceError("scan aborted")
+        finally:
+            self.timeouts[COMMAND.IDENTIFY] = timeout
+            #drop replies that arrived after their timeout
+            self.serial.reset_input_buffer()
+
+        self.log("")
+        raise DeviceError("could not find any device")
+
+    def probe_order(self):
+        """ known variants in the order they should be probed """
+        last, counts = (None, {})
+        if self.cache is not None:
+            last, counts = self.cache.lookup(self.serial.port)
+
+        rank = dict((variant, i) for i, variant in enumerate(self.fleet_order))
+        order = sorted(self.variants, key=lambda variant: (-counts.get(variant, 0),
+                                                           rank.get(variant, len(rank))))
+        #the variant last seen on this port goes first
+        if last in self.variants:
+            order.remove(last)
+            order.insert(0, last)
+        return order
+
+    def set_device(self, device_id, variant_id):
+        """ set up chip data for a detected variant """
+        device_name, config = self.variants[(device_id, variant_id)]
+        variant_name = config[0]
+        self.log("> success, detected %s cpu (variant %s)" % (device_name, variant_name))
+        self.flash_size               = config[1]
+        self.flash_page_size          = config[2]
+        self.flash_security_page_size = config[3]
+        self.device_name              = variant_name
+        self.device_family            = device_name
+        self.log("> detected %s cpu (variant %s, flash_size=%d, pagesize=%d)" % (device_name, variant_name, self.flash_size, self.flash_page_size))
+
+    @phase("reset")
     def send_reset(self):
-        print("> send reset command")
+        self.log("> send reset command")
 
         if (self.send(COMMAND.RESET, [255, 255]) == RESPONSE.ACK):
-            print("> success, device restarted...")
-
-    def send(self, cmd, data):
-        length = len(data)
+            self.log("> success, device restarted...")
+            #the next session has to train and enable flash access again, the chip stays the same
+            self.connected = False
+
+    def encode(self, cmd, data, address = None):
+        """ encode a frame into the frame buffer, an address is prepended to the data """
+        pos = 3
+        if address is not None:
+            self.frame[3] = (address >> 8) & 0xFF
+            self.frame[4] = address & 0xFF
+            pos = 5
+        end = pos + len(data)
+        length = end - 3
 
         #check length
-        if (length < 2) or (length > 130):
-            sys.exit("> ERROR: invalid data length! allowed 2...130, got %d" % (length))
+        if (length < 2) or (length > self.MAX_DATA):
+            raise ValueError("invalid data length! allowed 2...%d, got %d" % (self.MAX_DATA, length))
+
+        self.frame[0] = 0x24
+        self.frame[1] = length + 1
+        self.frame[2] = cmd
+        self.frame[pos:end] = data
+
+        if (self.debug):
+            payload = self.frame[3:end]
+            data_str = "".join('0x{:02x} '.format(x) for x in payload[:16])
+            if (length > 16): data_str = data_str + "..."
+            self.log("> sending $ len=%d cmd=0x%02X data={ %s}" % (length, cmd, data_str))
+
+        return self.frame_view[:end]
+
+    def send(self, cmd, data, address = None, allow_timeout = False):
+        while True:
+            frame = self.encode(cmd, data, address)
+            started = time.monotonic()
+            try:
+                self.serial.write(frame)
+                self.round_trips += 1
+            except serial.SerialException:
+                raise PortError("failed to send data")
+            res = self.read_reply(cmd, allow_timeout or self.auto_baud)
+            self.stats.record(cmd, len(frame), time.monotonic() - started, res)
+            #with a negotiated baudrate, retry failed frames at a lower rate
+            if not (allow_timeout) and self.link_error(cmd, res) and self.fall_back_baudrate():
+                continue
+            if (res is None) and not (allow_timeout):
+                raise ReplyTimeout("serial read timed out (%s)" % (COMMAND.TO_STR.get(cmd, "0x%02X" % cmd)), address=address)
+            return res
 
+    @staticmethod
+    def link_error(cmd, res):
+        """ a reply that means the frame or the reply got corrupted """
+        if (res is None) or (res not in RESPONSE.TO_STR):
+            return True
+        return (res == RESPONSE.CRC_ERROR) and (cmd != COMMAND.VERIFY)
+
+    def read_reply(self, cmd, allow_timeout = False):
+        """ read the reply to a command, a timeout returns None if allowed """
+        timeout = self.timeouts.get(cmd, 1)
         try:
-            if (self.debug):
-                data_str = "".join('0x{:02x} '.format(x) for x in data[:16])
-                if (length > 16): data_str = data_str + "..."
-                print("> sending $ len=%d cmd=0x%02X data={ %s}" % (length, cmd, data_str))
-            self.serial.write(b'$')
-            self.serial.write((length + 1).to_bytes(1, 'little'))
-            self.serial.write(cmd.to_bytes(1, 'little'))
-            self.serial.write(bytearray(data))
+            #changing the timeout reconfigures the port, only do it if needed
+            if (self.serial.timeout != timeout):
+                self.serial.timeout = timeout
 
             #read back reply
             res_bytes = self.serial.read(1)
-            #res_bytes = b"\x40"
-            if (len(res_bytes) != 1):
-                sys.exit("> ERROR: serial read timed out")
-                return 0
-            else:
-                res = res_bytes[0]
-                if(self.debug): print("> reply 0x%02X" % (res))
-                return res
-
         except serial.SerialException:
-            sys.exit("ERROR: failed to send data")
-
+            raise PortError("failed to read reply")
+
+        if (len(res_bytes) != 1):
+            if (allow_timeout):
+                return None
+            raise ReplyTimeout("serial read timed out (%s)" % (COMMAND.TO_STR.get(cmd, "0x%02X" % cmd)))
+        res = res_bytes[0]
+        if(self.debug): self.log("> reply 0x%02X" % (res))
+        return res
 
-    def check_id(self, device_id, derivative_id):
+    def send_pipelined(self, cmd, frames):
+        """ send (address, data) frames, keeping up to self.pipeline frames in flight
+
+        yields (address, response) for every frame in order. Like send, a link
+        error with a negotiated baudrate falls back to a slower rate, the frames
+        in flight at the failing rate are sent again.
+        """
+        if (self.pipeline == 1):
+            for address, data in frames:
+                yield address, self.send(cmd, data, address)
+            return
+
+        frames  = iter(frames)
+        #frames to send again after a fallback, before the next new frame
+        resend  = collections.deque()
+        pending = collections.deque()
+        try:
+            while True:
+                while (len(pending) < self.pipeline):
+                    address, data = resend.popleft() if resend else next(frames, (None, None))
+                    if address is None:
+                        break
+                    frame = self.encode(cmd, data, address)
+                    started = time.monotonic()
+                    try:
+                        self.serial.write(frame)
+                        self.round_trips += 1
+                    except serial.SerialException:
+                        raise PortError("failed to send data")
+                    pending.append((address, data, len(frame), started))
+                if not pending:
+                    return
+
+                address, data, size, started = pending.popleft()
+                res = self.read_reply(cmd, self.auto_baud)
+                self.stats.record(cmd, size, time.monotonic() - started, res)
+                if self.link_error(cmd, res) and (self.auto_baud) and (len(self.baudrates) > 1):
+                    #drain the replies of the frames in flight, they all went out at the failing rate
+                    failed = [(address, data)] + [(item[0], item[1]) for item in pending]
+                    for item in pending:
+                        self.read_reply(cmd, allow_timeout=True)
+                    pending.clear()
+                    if self.fall_back_baudrate():
+                        resend.extend(failed)
+                        continue
+                    #training failed, send one by one, send raises if nothing works
+                    for failed_address, failed_data in failed:
+                        yield failed_address, self.send(cmd, failed_data, failed_address)
+                    continue
+                if (res is None):
+                    raise ReplyTimeout("serial read timed out (%s)" % (COMMAND.TO_STR.get(cmd, "0x%02X" % cmd)), address=address)
+                yield address, res
+        finally:
+            #an error or a consumer that stops early leaves replies in flight,
+            #read them so the next command does not get a stale reply
+            for item in pending:
+                self.read_reply(cmd, allow_timeout=True)
+
+    def check_id(self, device_id, derivative_id, allow_timeout = False):
         #verify that the given id matches the target
-        return self.send(COMMAND.IDENTIFY, [device_id, derivative_id]) == RESPONSE.ACK
+        return self.send(COMMAND.IDENTIFY, [device_id, derivative_id], allow_timeout=allow_timeout) == RESPONSE.ACK
 
     def enable_flash_access(self):
         res = self.send(COMMAND.SETUP, [0xA5, 0xF1, 0x00])
         if (res != RESPONSE.ACK):
-            sys.exit("> ERROR enabling flash access, error code 0x%02X (%s)" % (res, RESPONSE.to_string(res)))
+            raise ResponseError("enabling flash access failed, error code 0x%02X (%s)" % (res, RESPONSE.to_string(res)), response=res)
 
     def erase_page(self, page):
         start = page * self.flash_page_size
         end   = start + self.flash_page_size-1
-        start_hi = (start >> 8) & 0xFF
-        start_lo = start & 0xFF
-        print("> will erase page %d (0x%04X-0x%04X)" % (page, start, end))
-        return self.send(COMMAND.ERASE, [start_hi, start_lo])
+        self.detail("> will erase page %d (0x%04X-0x%04X)" % (page, start, end))
+        res = self.send(COMMAND.ERASE, b"", address=start)
+        if not (res == RESPONSE.ACK):
+            raise ResponseError("erase failed at address 0x%04X (response = %s)" % (start, RESPONSE.to_string(res)), response=res, address=start)
+        return res
 
-    def write(self, address, data):
-        if (len(data) > 128):
-            sys.exit("ERROR: invalid chunksize, maximum allowed write is 128 bytes (%d)" % (len(data)))
+    def print_write(self, address, data):
         #print some of the data as debug info
         if (len(data) > 8):
             data_excerpt = "".join('0x{:02x} '.format(x) for x in data[:4]) + \
@@ -228,194 +1328,719 @@ class EFM8Loader:
         else:
             data_excerpt = "".join('0x{:02x} '.format(x) for x in data)
 
-        print("> write at 0x%04X (%3d): %s" % (address, len(data), data_excerpt))
+        self.detail("> write at 0x%04X (%3d): %s" % (address, len(data), data_excerpt))
+
+    def write(self, address, data):
+        if (len(data) > 128):
+            raise ValueError("invalid chunksize, maximum allowed write is 128 bytes (%d)" % (len(data)))
+        self.print_write(address, data)
 
         #send request
-        address_hi = (address >> 8) & 0xFF
-        address_lo = address & 0xFF
-        res = self.send(COMMAND.WRITE, [address_hi, address_lo] + data)
+        res = self.send(COMMAND.WRITE, data, address=address)
         if not (res == RESPONSE.ACK):
-            sys.exit("ERROR: write failed at address 0x%04X (response = %s)" % (address, RESPONSE.to_string(res)))
+            raise ResponseError("write failed at address 0x%04X (response = %s)" % (address, RESPONSE.to_string(res)), response=res, address=address)
         return res
 
+    def write_chunks(self, chunks, written = None):
+        """ write (address, data) chunks of up to 128 bytes, pipelining frames if enabled
+
+        written(address, size) is called for every acknowledged chunk
+        """
+        sizes = {}
+        def frames():
+            for address, chunk in chunks:
+                self.print_write(address, chunk)
+                sizes[address] = len(chunk)
+                yield address, chunk
+
+        with contextlib.closing(self.send_pipelined(COMMAND.WRITE, frames())) as replies:
+            for address, res in replies:
+                if not (res == RESPONSE.ACK):
+                    raise ResponseError("write failed at address 0x%04X (response = %s)" % (address, RESPONSE.to_string(res)), response=res, address=address)
+                if written is not None:
+                    written(address, sizes.pop(address))
+
     def verify(self, address, data):
-        length = len(data)
-        crc16 = crcmod.predefined.mkCrcFun('xmodem')(bytearray(data))
-
-        if (self.debug): print("> verify address 0x%04X (len=%d, crc16=0x%04X)" % (address, length, crc16))
-        start_hi = (address >> 8) & 0xFF
-        start_lo = address & 0xFF
-        end      = address + length - 1
-        end_hi   = (end >> 8) & 0xFF
-        end_lo   = end & 0xFF
-        crc_hi   = (crc16 >> 8) & 0xFF
-        crc_lo   = crc16 & 0xFF
-        res = self.send(COMMAND.VERIFY, [start_hi, start_lo] + [end_hi, end_lo] + [crc_hi, crc_lo])
+        """ check that flash[address:] equals data (bytes, bytearray or memoryview) """
+        return self.verify_crc(address, address + len(data), crc16(data))
+
+    def verify_crc(self, start, end, crc):
+        """ check the crc16 of flash[start:end] """
+        if (self.debug): self.log("> verify address 0x%04X (len=%d, crc16=0x%04X)" % (start, end - start, crc))
+        last = end - 1
+        res = self.send(COMMAND.VERIFY, ((last >> 8) & 0xFF, last & 0xFF, (crc >> 8) & 0xFF, crc & 0xFF), address=start)
         return res
 
-    def download(self, filename):
-        print("> dumping flash content to '%s'" % filename)
-        print("> please note that this will take long")
+    def download(self, filename, reference = None):
+        """ dump the flash to filename, reference is a directory of hex files of known builds """
+        self.log("> dumping flash content to '%s'" % filename)
 
-        #check for chip
-        self.identify_chip()
+        #check for chip, this also sets up the flash size
+        self.identify()
 
         self.debug = False
 
-        #send autobaud training character
-        self.send_autobaud_training()
-
-        #enable flash access
-        self.enable_flash_access()
-
         #the bootloader protocol does not allow reading flash
         #however it allows to verify written bytes
         #we will exploit this feature to dump the flash contents
-        #for now assume 8kb flash
-        flash_size = 8 * 1024
         ih = IntelHex()
-        for address in range(flash_size):
-            #test one byte by byte
-            #first check 0x00
-            byte = 0
-            if (self.verify(address, [byte]) == RESPONSE.ACK):
-                ih[address] = byte
-            else:
-                #now start with 0xFF (empty flash)
-                for byte in range(0xFF, -1, -1):
-                    if (self.verify(address, [byte]) == RESPONSE.ACK):
-                        #success, the flash content on this address euals <byte>
-                        ih[address] = byte
-                        break
-            print("\r> flash[0x%04X] = 0x%02X" % (address, byte), end="")
-            sys.stdout.flush()
-
-        print("\n> finished")
+        if (reference):
+            library = ReferenceLibrary.from_directory(reference, self.load_image, self.flash_page_size, self.flash_size)
+            self.log("> indexed %d reference builds in '%s'" % (len(library.names), reference))
+            self.dump_reference(ih, library)
+            self.describe_match(ih, library)
+        else:
+            self.dump_range(ih, 0, self.flash_size)
 
         #done, all flash contents have been read, now store this to the file
         ih.write_hex_file(filename)
 
-
-    def upload(self, filename):
-        print("> uploading file '%s'" % (filename))
-
-        #identify chip
-        self.identify_chip()
-
-        #read hex file
+    def describe_match(self, ih, library):
+        """ log the build matching the dump best and where they differ """
+        build = library.best()
+        self.log("> best match: %s (%d of %d pages)" % (library.names[build], library.scores[build], library.page_count))
+        for start, end, inside in library.differences(build, ih):
+            self.log("> flash[0x%04X-0x%04X] differs%s" % (start, end-1, "" if inside else " (not part of the build)"))
+
+    @phase("dump")
+    def dump_range(self, ih, start, end, chunk_size = 64, prior = None):
+        """ recover flash[start:end] into ih by probing it with VERIFY commands
+
+        prior seeds the order in which byte values are tried (see ByteOrder)
+        """
+        order = ByteOrder(prior)
+        #crcs of erased ranges
+        erased = b"\xFF" * self.flash_page_size
+        round_trips = self.round_trips
+        started = time.monotonic()
+        unreadable = []
+        self.progress_start("reading", end - start)
+
+        page = start - (start % self.flash_page_size)
+        while page < end:
+            page_start = max(page, start)
+            page_end   = min(page + self.flash_page_size, end)
+            page = page + self.flash_page_size
+
+            #erased pages cost a single round trip
+            res = self.verify(page_start, erased[:page_end - page_start])
+            if (res == RESPONSE.RANGE_ERROR):
+                unreadable.append((page_start, page_end))
+                self.detail("\r> flash[0x%04X-0x%04X] unreadable" % (page_start, page_end-1), end="", count=page_end-page_start)
+                continue
+            if (res == RESPONSE.ACK):
+                for address in range(page_start, page_end):
+                    ih[address] = 0xFF
+                self.detail("\r> flash[0x%04X-0x%04X] erased   " % (page_start, page_end-1), end="", count=page_end-page_start)
+                continue
+
+            self.recover_page(ih, page_start, page_end, order, chunk_size)
+
+        self.finish_dump(start, end, round_trips, started, unreadable)
+
+    def finish_dump(self, start, end, round_trips, started, unreadable):
+        elapsed = time.monotonic() - started
+        round_trips = self.round_trips - round_trips
+        kbytes = (end - start) / 1024.0
+        self.progress_finish()
+        self.log("\n> finished")
+        for first, last in unreadable:
+            self.log("> flash[0x%04X-0x%04X] is not readable, skipped" % (first, last-1))
+        self.log("> %d round trips, %.1fs (%.2fs per KB, %.1f round trips per byte)" %
+              (round_trips, elapsed, elapsed / kbytes, round_trips / float(end - start)))
+
+    def recover_page(self, ih, page_start, page_end, order, chunk_size, guess = None):
+        """ recover a used page chunk by chunk, then byte by byte
+
+        guess is a buffer holding the likely content of flash[page_start:page_end],
+        the page is then bisected against it and only differing bytes are
+        recovered one by one
+        """
+        if (guess is not None):
+            self.recover_guessed(ih, page_start, page_end, guess, order)
+        else:
+            erased = b"\xFF" * chunk_size
+            for chunk in range(page_start, page_end, chunk_size):
+                chunk_end = min(chunk + chunk_size, page_end)
+                #so do erased chunks within a used page
+                if (self.verify(chunk, erased[:chunk_end - chunk]) == RESPONSE.ACK):
+                    for address in range(chunk, chunk_end):
+                        ih[address] = 0xFF
+                    self.detail("\r> flash[0x%04X-0x%04X] erased   " % (chunk, chunk_end-1), end="", count=chunk_end-chunk)
+                    continue
+                for address in range(chunk, chunk_end):
+                    self.recover_byte(ih, address, order)
+
+        #make sure the recovered page is consistent
+        data = bytes(ih[x] for x in range(page_start, page_end))
+        if (self.verify(page_start, data) != RESPONSE.ACK):
+            raise VerifyError("verify of recovered page 0x%04X-0x%04X failed" % (page_start, page_end-1), address=page_start)
+
+    def recover_byte(self, ih, address, order):
+        previous = ih[address-1] if (address > 0) else 0xFF
+        for byte in order.candidates(previous):
+            if (self.verify_crc(address, address + 1, self.byte_crc[byte]) == RESPONSE.ACK):
+                #success, the flash content on this address equals <byte>
+                break
+        else:
+            raise VerifyError("no value matched flash[0x%04X]" % (address), address=address)
+        ih[address] = byte
+        order.update(previous, byte)
+        self.detail("\r> flash[0x%04X] = 0x%02X" % (address, byte), end="")
+
+    def recover_guessed(self, ih, start, end, guess, order):
+        """ recover flash[start:end], known to differ from guess, by bisecting it """
+        if (end - start == 1):
+            self.recover_byte(ih, start, order)
+            return
+        middle = (start + end) // 2
+        for first, last in ((start, middle), (middle, end)):
+            data = guess[first - start:last - start]
+            if (self.verify(first, data) == RESPONSE.ACK):
+                for address, byte in zip(range(first, last), data):
+                    ih[address] = byte
+                self.detail("\r> flash[0x%04X-0x%04X] matched  " % (first, last-1), end="", count=last-first)
+            else:
+                self.recover_guessed(ih, first, last, data, order)
+
+    @phase("dump")
+    def dump_reference(self, ih, library, chunk_size = 64):
+        """ recover the flash into ih, trying the pages of known builds first
+
+        every page is checked against the page crcs of the builds in the
+        ReferenceLibrary, only pages none of them holds are recovered chunk
+        by chunk, guessed from the best matching build, and byte by byte
+        """
+        order = ByteOrder()
+        round_trips = self.round_trips
+        started = time.monotonic()
+        unreadable = []
+        self.progress_start("reading", self.flash_size)
+
+        for page in library.order:
+            start = page * self.flash_page_size
+            end   = start + self.flash_page_size
+            res = self.verify_crc(start, end, library.erased_crc)
+            if (res == RESPONSE.RANGE_ERROR):
+                unreadable.append((start, end))
+                self.detail("\r> flash[0x%04X-0x%04X] unreadable" % (start, end-1), end="", count=end-start)
+                continue
+            if (res == RESPONSE.ACK):
+                library.match(page, library.erased_crc)
+                for address in range(start, end):
+                    ih[address] = 0xFF
+                self.detail("\r> flash[0x%04X-0x%04X] erased   " % (start, end-1), end="", count=end-start)
+                continue
+
+            for crc in library.candidates(page):
+                if (self.verify_crc(start, end, crc) == RESPONSE.ACK):
+                    build = library.match(page, crc)
+                    for address, byte in zip(range(start, end), library.page_data(build, page)):
+                        ih[address] = byte
+                    self.detail("\r> flash[0x%04X-0x%04X] matched  " % (start, end-1), end="", count=end-start)
+                    break
+            else:
+                self.recover_page(ih, start, end, order, chunk_size, library.page_data(library.best(), page))
+
+        self.finish_dump(0, self.flash_size, round_trips, started, unreadable)
+
+    def settings_page(self):
+        """ start and end of the settings page of the detected device """
+        start = self.settings_address
+        if start is None:
+            start = self.SETTINGS_ADDRESS.get(self.device_family)
+        if start is None:
+            raise DeviceError("settings page of %s is unknown, pass its address" % (self.device_name))
+        end = start + self.flash_page_size
+        #never touch page 0, it keeps the bootloader active
+        if (start % self.flash_page_size) or (start == 0) or (end > self.flash_size - self.flash_security_page_size):
+            raise DeviceError("0x%04X is not a valid settings page" % (start), address=start)
+        return start, end
+
+    def describe_settings(self, data):
+        """ log the revisions and tags of a settings page """
+        self.log("> settings revision %d.%d, layout revision %d" % (data[0], data[1], data[2]))
+        for name, offset, size in self.SETTINGS_FIELDS[1:4]:
+            text = bytes(data[offset:offset + size]).rstrip(b"\xFF").decode("ascii", "replace").strip()
+            self.log("> %-10s '%s'" % (name, text))
+        signature = data[self.SETTINGS_SIGNATURE:self.SETTINGS_SIGNATURE + 2]
+        if (bytes(signature) != b"\x55\xAA"):
+            self.log("> settings are not initialized, the firmware will reset them to defaults")
+
+    def read_settings(self, filename):
+        """ store the settings, tags, name and melody of a Bluejay ESC to a hex file """
+        self.log("> reading settings to '%s'" % (filename))
+        self.identify()
+        start, end = self.settings_page()
+        #only the used part of the page, erased 16 byte fields cost a single VERIFY
         ih = IntelHex()
-        ih.loadhex(filename)
+        self.dump_range(ih, start, start + self.SETTINGS_SIZE, chunk_size=16, prior=ByteOrder.SETTINGS_PRIOR)
+        self.describe_settings([ih[address] for address in range(start, start + self.SETTINGS_SIZE)])
+        ih.write_hex_file(filename)
 
-        #send autobaud training character
-        self.send_autobaud_training()
+    def write_settings(self, filename):
+        """ write only the settings page of a hex file
+
+        The page is erased and written with the initialized signature
+        left at 0xFF, which is written last once the rest of the page was
+        verified. Until then the firmware falls back to its defaults, just
+        like flash[0] keeps the bootloader active during an upload.
+        """
+        self.log("> writing settings from '%s'" % (filename))
+        self.identify()
+        start, end = self.settings_page()
+        page = start // self.flash_page_size
+        plan = self.load_image(filename)
+        if (page >= len(plan.page_map)) or not (plan.page_map[page]):
+            raise EFM8Error("'%s' holds no settings at 0x%04X" % (filename, start), address=start)
+        if (len(plan.used_pages) > 1):
+            self.log("> only writing the settings page 0x%04X-0x%04X" % (start, end-1))
+        segments = list(plan.clip({page}))
+        self.describe_settings(plan.view[start:end])
+
+        #stage the page without the signature
+        data = bytearray(b"\xFF") * end
+        data[start:end] = plan.view[start:end]
+        signature_address = start + self.SETTINGS_SIGNATURE
+        signature = bytes(data[signature_address:signature_address + 2])
+        data[signature_address:signature_address + 2] = b"\xFF\xFF"
+        staged = FlashPlan(data, segments, self.flash_page_size)
+
+        self.erase_pages(staged, {page})
+        self.write_pages(staged, {page})
+        if (signature != b"\xFF\xFF"):
+            self.write_settings_signature(signature_address, signature)
+
+        #the page now has to match the image
+        for segment_start, segment_end in segments:
+            res = self.verify_crc(segment_start, segment_end, plan.crc(segment_start, segment_end))
+            if (res != RESPONSE.ACK):
+                raise VerifyError("verify of settings 0x%04X-0x%04X failed" % (segment_start, segment_end-1), response=res, address=segment_start)
+        self.log("> settings written")
 
-        #enable flash access
-        self.enable_flash_access()
+    @phase("finalize")
+    def write_settings_signature(self, address, signature):
+        """ write the initialized signature, this makes the firmware use the new settings """
+        self.log("> will now write the settings signature")
+        self.write(address, signature)
 
-        #erase pages where we are going to write
-        self.erase_pages_ih(ih)
+    def upload(self, filename, differential = False):
+        self.log("> uploading file '%s'" % (filename))
 
-        #write all data bytes
-        self.write_pages_ih(ih)
-        self.verify_pages_ih(ih)
+        #identify chip
+        self.identify()
 
-    def erase_pages_ih(self, ih):
-        """ erase all pages that are occupied """
-        last_address = ih.addresses()[-1]
-        last_page = int(last_address / self.flash_page_size)
-        for page in range(last_page+1):
-            start = page * self.flash_page_size
-            end   = start +  self.flash_page_size-1
-            page_used = False
-            for x in ih.addresses():
-                if x >= start and x <= end:
-                    page_used = True
-                    break
-            #always erase page 0 to retain bootloader access
-            if (page == 0) or (page_used):
-                self.erase_page(page)
+        #read hex file
+        plan = self.load_image(filename)
+
+        #only touch pages that do not hold the new content yet
+        pages = None
+        confirmed = ()
+        if (self.journal is not None):
+            image = ImageCache.digest(filename)
+            self.journal_key = self.journal.key(self.serial.port)
+        if (differential):
+            pages = self.changed_pages(plan)
+            if not pages:
+                self.log("> flash content is up to date, nothing to write")
+                return
+        elif (self.journal is not None):
+            confirmed = self.resume_pages(plan, image)
+            if confirmed:
+                pages = set(plan.used_pages).difference(confirmed)
+                pages.add(0)
+
+        erase, runs = (plan.erase, plan.runs) if pages is None else plan.schedule(pages)
+        self.progress_start("writing", len(erase) + sum(len(run[2]) for run in runs))
+        if (self.journal is not None):
+            self.journal.begin(self.journal_key, image, self.device_name, confirmed)
 
-    def write_pages_ih(self, ih):
-        """ write all segments from this ihex to flash"""
+        try:
+            #erase pages where we are going to write
+            self.erase_pages(plan, pages)
+
+            #write all data bytes
+            self.write_pages(plan, pages)
+            self.progress_finish()
+            self.verify_pages(plan)
+            if (self.journal is not None):
+                self.journal.clear(self.journal_key)
+        finally:
+            self.journal_key = None
+
+    @phase("resume")
+    def resume_pages(self, plan, image):
+        """ pages of an interrupted upload of this image that hold their content already """
+        recorded = self.journal.pages(self.journal_key, image, self.device_name)
+        #page 0 is always rewritten
+        recorded.discard(0)
+        if not recorded:
+            return set()
+        #an upload that got as far as writing flash[0] has finished
+        if (self.verify(0, b"\xFF") != RESPONSE.ACK):
+            return set()
+        confirmed = set()
+        for page in sorted(recorded):
+            if (page < len(plan.page_map)) and plan.page_map[page]:
+                start, end = plan.page_range(page)
+                if (self.verify_crc(start, end, plan.page_crc(page)) == RESPONSE.ACK):
+                    confirmed.add(page)
+        self.log("> resuming an interrupted upload, %d of %d pages are written already" % (len(confirmed), len(plan.used_pages)))
+        return confirmed
+
+    def load_image(self, filename):
+        """ FlashPlan of a hex file, from the image cache if there is one """
+        if self.image_cache is not None:
+            return self.image_cache.load(filename, self.flash_page_size)
+        return FlashPlan.from_file(filename, self.flash_page_size)
+
+    @phase("diff")
+    def changed_pages(self, plan):
+        """ find all occupied pages whose flash content differs from the plan """
+        changed = set()
+        for page in plan.used_pages:
+            #erased and written pages are 0xFF where the image holds no data
+            start, end = plan.page_range(page)
+            if (self.verify_crc(start, end, plan.page_crc(page)) != RESPONSE.ACK):
+                changed.add(page)
+        #page 0 is always rewritten, flash[0] keeps the bootloader active
+        #until everything else was written
+        if changed:
+            changed.add(0)
+        self.log("> %d of %d pages need to be written" % (len(changed), len(plan.used_pages)))
+        return changed
+
+    @phase("erase")
+    def erase_pages(self, plan, pages = None):
+        """ erase all pages that are occupied (and selected) """
+        erase = plan.erase if pages is None else plan.schedule(pages)[0]
+        for page in erase:
+            self.erase_page(page)
+
+    @phase("write")
+    def write_pages(self, plan, pages = None):
+        """ write all segments (clipped to the selected pages) of the plan to flash"""
         #NOTE: it is important to keep flash location 0
         #      equal to 0xFF until we are almost finished...
         #      therefore the bootloader will still be functional in case
         #      something goes wrong in the process.
         #      (the bootloader will be executed as long the first flash
         #      content equals 0xFF)
-        byte_zero = -1
-        for start,end in ih.segments():
-            print("> writing segment 0x%04X-0x%04X" % (start, end-1))
-
-            #fetch data
-            data = []
-            for x in range(start,end):
-                data.append(ih[x])
+        runs = plan.runs if pages is None else plan.schedule(pages)[1]
+        byte_zero = plan.byte_zero
+        if (pages is not None) and (0 not in pages):
+            byte_zero = None
+        if (byte_zero is not None):
+            self.detail("> delaying write of flash[0] = 0x%02X to the end" % (byte_zero), count=0)
+
+        #record every page in the journal once all of its chunks were written
+        written = None
+        if (self.journal_key is not None):
+            pending = collections.Counter()
+            page_size = plan.page_size
+            for start, end, chunks, crc in runs:
+                for address, chunk in chunks:
+                    for page in range(address // page_size, (address + len(chunk) - 1) // page_size + 1):
+                        pending[page] += 1
+            def written(address, size):
+                for page in range(address // page_size, (address + size - 1) // page_size + 1):
+                    pending[page] -= 1
+                    if (pending[page] == 0) and (page != 0):
+                        self.journal.add(self.journal_key, page)
+
+        for start, end, chunks, crc in runs:
+            self.detail("> writing segment 0x%04X-0x%04X" % (start, end-1), count=0)
+
             #write in 128byte blobs
-            data_pos = 0
-            #keep byte zero 0xFF in order to keep bootloader active (for now)
-            if (start == 0):
-                print("> delaying write of flash[0] = 0x%02X to the end" % (data[0]))
-                byte_zero = data[0]
-                start = start + 1
-                data.pop(0)
-            while ((data_pos + start) < end):
-                length = min(128, end - (data_pos + start))
-                self.write(start + data_pos, data[data_pos:data_pos+length])
-                data_pos = data_pos + length
+            self.write_chunks(chunks, written)
 
             #now verify this segment
-            print("> verifying segment... ", end="")
-            sys.stdout.flush()
-            if (self.verify(start, data) == RESPONSE.ACK):
-                print("OK")
+            self.detail("> verifying segment... ", end="", count=0)
+            res = self.verify_crc(start, end, crc)
+            if (res == RESPONSE.ACK):
+                self.detail("OK", count=0)
             else :
-                sys.exit("FAILURE. will abort now\n")
+                self.detail("FAILURE", count=0)
+                self.repair(plan, start, end, res)
 
         #all bytes except byte zero were written, do this now
-        if (byte_zero != -1):
-            print("> will now write flash[0] = 0x%02X" % (byte_zero))
-            res = self.write(0, [byte_zero])
-            if (res != RESPONSE.ACK):
-                print("> ERROR, write of flash[0] failed (response = %s)" % (RESPONSE.to_string(res)))
-                self.restore_bootloader_autostart()
-                sys.exit("FAILED")
-            #verify
-            res = self.verify(0, [byte_zero])
-            if (res != RESPONSE.ACK):
-                print("> ERROR, verify of flash[0] failed (response = %s)" % (RESPONSE.to_string(res)))
-                self.self.restore_bootloader_autostarti()
-                sys.exit("FAILED")
+        if (byte_zero is not None):
+            self.write_byte_zero(byte_zero)
+
+    @phase("finalize")
+    def write_byte_zero(self, byte_zero):
+        """ write flash[0], this makes the bootloader start the application """
+        self.progress_finish()
+        self.log("> will now write flash[0] = 0x%02X" % (byte_zero))
+        try:
+            self.write(0, [byte_zero])
+        except ResponseError as e:
+            self.log("> ERROR, write of flash[0] failed (response = %s)" % (RESPONSE.to_string(e.response)))
+            self.restore_bootloader_autostart()
+            raise
+        #verify
+        res = self.verify(0, bytes((byte_zero,)))
+        if (res != RESPONSE.ACK):
+            self.log("> ERROR, verify of flash[0] failed (response = %s)" % (RESPONSE.to_string(res)))
+            self.restore_bootloader_autostart()
+            raise VerifyError("verify of flash[0] failed", response=res, address=0)
 
     def restore_bootloader_autostart(self):
         #the bootloader will always start if flash[0] = 0xFF
         #in case something went wrong during programming,
         #call this in order to clear page 0 so that the bootloader
         #will always start
-        print("> will now erase page 0 in order to re-enable bootloader autorun");
+        self.log("> will now erase page 0 in order to re-enable bootloader autorun");
         self.erase_page(0)
 
-    def verify_pages_ih(self, ih):
+    @phase("verify")
+    def verify_pages(self, plan):
         """ verify written data """
-        #do a pagewise compare to find the position of
-        #the mismatch
-        for start,end in ih.segments():
-            print("> verifying segment 0x%04X-0x%04X... " % (start, end-1), end="")
-            sys.stdout.flush()
-
-            #fetch data
-            data = []
-            for x in range(start,end):
-                data.append(ih[x])
-
-            #calc crc16
-            if (self.verify(start, data) == RESPONSE.ACK):
-                print("OK")
+        for start, end, crc in plan.verify:
+            self.log("> verifying segment 0x%04X-0x%04X... " % (start, end-1), end="")
+            res = self.verify_crc(start, end, crc)
+            if (res == RESPONSE.ACK):
+                self.log("OK")
             else :
-                sys.exit("FAILURE. will abort now\n")
+                self.log("FAILURE")
+                self.repair(plan, start, end, res, finalized=True)
 
         return 1
 
+    @phase("repair")
+    def repair(self, plan, start, end, res, finalized = False):
+        """ rewrite the pages that make flash[start:end] fail verify
+
+        finalized tells whether flash[0] was written already, it is written
+        again if page 0 has to be rewritten. Raises VerifyError with the
+        failing ranges once self.verify_retries rewrites did not help.
+        """
+        self.progress_finish()
+        attempt = 0
+        while (res != RESPONSE.ACK):
+            #a range error is not caused by bad flash content
+            if (res != RESPONSE.CRC_ERROR):
+                raise VerifyError("verify of 0x%04X-0x%04X failed (response = %s)" % (start, end-1, RESPONSE.to_string(res)), response=res, address=start)
+            failed = self.locate_errors(plan, start, end)
+            for first, last in failed:
+                self.log("> flash[0x%04X-0x%04X] does not match the image" % (first, last-1))
+            if (attempt == self.verify_retries):
+                ranges = ", ".join("0x%04X-0x%04X" % (first, last-1) for first, last in failed) or "0x%04X-0x%04X" % (start, end-1)
+                raise VerifyError("verify failed at %s after %d rewrites" % (ranges, attempt), response=res, address=(failed or [(start, end)])[0][0])
+            attempt += 1
+            pages = sorted(set(page for first, last in failed
+                               for page in range(first // plan.page_size, (last - 1) // plan.page_size + 1)))
+            if pages:
+                self.log("> rewriting page%s %s (attempt %d of %d)" % ("s" if len(pages) > 1 else "", " ".join(str(page) for page in pages),
+                                                                  attempt, self.verify_retries))
+                self.rewrite_pages(plan, pages, finalized)
+            res = self.verify_crc(start, end, plan.crc(start, end))
+        if attempt:
+            self.log("> flash[0x%04X-0x%04X] repaired" % (start, end-1))
+
+    def locate_errors(self, plan, start, end):
+        """ bisect a failing range with VERIFY commands, returns the failing (start, end) ranges
+
+        ranges are split at page boundaries first, then at VERIFY_BLOCK
+        boundaries. If the first half of a failing range passes, the second
+        half has to fail and is not verified.
+        """
+        failed  = []
+        pending = [(start, end)]
+        while pending:
+            first, last = pending.pop()
+            if (first // self.VERIFY_BLOCK == (last - 1) // self.VERIFY_BLOCK):
+                failed.append((first, last))
+                continue
+            unit = plan.page_size if (first // plan.page_size != (last - 1) // plan.page_size) else self.VERIFY_BLOCK
+            middle = ((first + last) // 2) // unit * unit
+            middle = min(max(middle, (first // unit + 1) * unit), (last - 1) // unit * unit)
+            if (self.verify_crc(first, middle, plan.crc(first, middle)) != RESPONSE.ACK):
+                #the second half may fail as well
+                if (self.verify_crc(middle, last, plan.crc(middle, last)) != RESPONSE.ACK):
+                    pending.append((middle, last))
+                pending.append((first, middle))
+            else:
+                pending.append((middle, last))
+        #merge adjacent blocks
+        ranges = []
+        for first, last in sorted(failed):
+            if ranges and (ranges[-1][1] == first):
+                ranges[-1] = (ranges[-1][0], last)
+            else:
+                ranges.append((first, last))
+        return ranges
+
+    def rewrite_pages(self, plan, pages, finalized = False):
+        """ erase and write the given pages again """
+        erase, runs = plan.schedule(pages)
+        for page in erase:
+            self.erase_page(page)
+        for start, end, chunks, crc in runs:
+            self.write_chunks(chunks)
+        #erasing page 0 cleared flash[0], the bootloader starts again until it is restored
+        if (finalized) and (0 in erase) and (plan.byte_zero is not None):
+            self.write_byte_zero(plan.byte_zero)
+
+    def erase_pages_ih(self, ih, pages = None):
+        self.erase_pages(FlashPlan.from_ihex(ih, self.flash_page_size), pages)
+
+    def write_pages_ih(self, ih, pages = None):
+        self.write_pages(FlashPlan.from_ihex(ih, self.flash_page_size), pages)
+
+    def verify_pages_ih(self, ih):
+        return self.verify_pages(FlashPlan.from_ihex(ih, self.flash_page_size))
+
+def expand_ports(patterns):
+    """ expand port globs like /dev/ttyUSB* into a sorted list of ports """
+    ports = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                raise ValueError("no port matches '%s'" % (pattern))
+        else:
+            matches = [pattern]
+        for port in matches:
+            if port not in ports:
+                ports.append(port)
+    return ports
+
+class FleetProgress:
+    """Shows the latest message of every port on its own line"""
+
+    def __init__(self, ports, stream = sys.stdout, interval = 0.1):
+        self.ports    = ports
+        self.stream   = stream
+        self.interval = interval
+        self.lines    = dict((port, "waiting") for port in ports)
+        self.partial  = dict((port, "") for port in ports)
+        self.width    = max(len(port) for port in ports)
+        self.lock     = threading.Lock()
+        #redraw the status block on terminals, log complete lines otherwise
+        self.redraw   = stream.isatty()
+        self.drawn    = False
+        self.last     = 0
+
+    def output(self, port, message, end):
+        with self.lock:
+            lines = (self.partial[port] + message + end).split("\n")
+            self.partial[port] = lines.pop()
+            for line in lines + [self.partial[port]]:
+                line = line.split("\r")[-1].strip()
+                if line:
+                    self.lines[port] = line
+            if self.redraw:
+                self.draw()
+            else:
+                for line in lines:
+                    line = line.split("\r")[-1].strip()
+                    if line:
+                        self.stream.write("%-*s  %s\n" % (self.width, port, line))
+
+    def draw(self, force = False):
+        now = time.monotonic()
+        if not force and (now - self.last) < self.interval:
+            return
+        self.last = now
+        if self.drawn:
+            self.stream.write("\x1b[%dA" % (len(self.ports)))
+        for port in self.ports:
+            self.stream.write("\r\x1b[K%-*s  %s\n" % (self.width, port, self.lines[port]))
+        self.stream.flush()
+        self.drawn = True
+
+    def finish(self):
+        if self.redraw:
+            with self.lock:
+                self.draw(force=True)
+
+def run_action(loader, args, fleet = False):
+    """ run the action selected on the command line, returns False if there was none
+
+    the loader has to be open, EFM8Error is raised on failures
+    """
+    if (args.identify):
+        loader.identify_chip()
+    elif (args.write):
+        loader.upload(args.write, differential=args.differential)
+        #fleet devices are started right away
+        if (fleet):
+            loader.send_reset()
+    elif (args.read):
+        loader.download(args.read, reference=args.reference)
+    elif (args.read_settings):
+        loader.read_settings(args.read_settings)
+    elif (args.write_settings):
+        loader.write_settings(args.write_settings)
+        #restart so the firmware loads the new settings
+        if (fleet):
+            loader.send_reset()
+    elif (args.reset):
+        loader.send_reset()
+    else:
+        return False
+    return True
+
+def loader_options(args, timeouts):
+    """ EFM8Loader keyword arguments from the command line """
+    return dict(debug=args.verbose, timeouts=timeouts, pipeline=args.pipeline,
+                cache=None if args.no_cache else DeviceCache(),
+                scan=not args.no_scan, scan_timeout=args.scan_timeout, quiet=args.quiet,
+                verify_retries=args.verify_retries,
+                image_cache=None if args.no_image_cache else ImageCache(),
+                settings_address=args.settings_address,
+                journal=None if args.no_journal else UploadJournal())
+
+def write_stats(filename, stats):
+    with open(filename, "w") as f:
+        json.dump(stats, f, indent=2)
+
+FleetResult = collections.namedtuple("FleetResult", ["port", "ok", "message", "device", "seconds", "stats"])
+
+def flash_port(port, args, timeouts, progress):
+    """ run the selected action on one port, never raises """
+    started = time.monotonic()
+    output  = lambda message, end: progress.output(port, message, end)
+    loader  = EFM8Loader(port, args.baudrate, output=output, **loader_options(args, timeouts))
+    ok      = False
+    try:
+        with loader:
+            run_action(loader, args, fleet=True)
+        ok, message = True, "OK"
+    except EFM8Error as e:
+        message = "ERROR: %s" % (e)
+    except Exception as e:
+        message = "%s: %s" % (type(e).__name__, e)
+    if not ok:
+        output("> " + message, "\n")
+    device = loader.device_name
+    stats = loader.stats.summary()
+    return FleetResult(port, ok, message, device, time.monotonic() - started, stats)
+
+def run_fleet(ports, args, timeouts):
+    """ run the selected action on all ports at once, returns the list of results """
+    progress = FleetProgress(ports)
+    jobs = args.jobs or len(ports)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(flash_port, port, args, timeouts, progress) for port in ports]
+        results = [future.result() for future in futures]
+    progress.finish()
+
+    width = max(len(port) for port in ports + ["PORT"])
+    print("")
+    print("%-*s  %-6s  %8s  %-20s  %s" % (width, "PORT", "RESULT", "TIME", "DEVICE", "MESSAGE"))
+    for result in results:
+        line = "%-*s  %-6s  %7.1fs  %-20s  %s" % (width, result.port, "OK" if result.ok else "FAILED",
+                                                 result.seconds, result.device or "-",
+                                                 "" if result.ok else result.message)
+        print(line.rstrip())
+    failed = sum(1 for result in results if not result.ok)
+    print("> %d of %d devices succeeded" % (len(results) - failed, len(results)))
+    if (args.stats_json):
+        write_stats(args.stats_json, dict((result.port, result.stats) for result in results))
+    return results
+
 if __name__ == "__main__":
     argp = argparse.ArgumentParser(description='efm8load - a plain python implementation for the EFM8 usart bootloader protocol')
 
@@ -424,31 +2049,91 @@ if __name__ == "__main__":
     group.add_argument("-r", "--read", metavar="filename", help="download the flash memory contents to the given filename") #action="store_true", nargs=1)
     group.add_argument("-i", "--identify", help="identify the chip", action="store_true")
     group.add_argument("-s", "--reset", help="send reset command", action="store_true")
+    group.add_argument("--read-settings", metavar="filename", help="download only the Bluejay settings page to the given filename")
+    group.add_argument("--write-settings", metavar="filename", help="write only the settings page of the given hex file")
+
+    argp.add_argument('--settings-address', type=lambda value: int(value, 0),
+                      help='start of the settings page, e.g. 0x3000 on BB51 (default is 0x1A00 on BB1 and BB2)')
+    argp.add_argument('--reference', metavar="directory",
+                      help='hex files of known builds, e.g. build/hex, --read checks whole pages against them first')
+    argp.add_argument('-d', '--differential', action='store_true', help='only erase and write pages whose content differs (use with --write)')
+    argp.add_argument('-n', '--dry-run', action='store_true', help='print the flash plan of --write and its estimated time, then exit')
+    argp.add_argument('--latency', type=float, default=1.0, help='round trip latency of the adapter for --dry-run in ms (default is 1.0)')
 
     #argp.add_argument('filename', help='firmware file to upload to the mcu')
-    argp.add_argument('-b', '--baudrate', type=int, default=115200, help='baudrate (default is 115200 baud)')
-    argp.add_argument('-p', '--port', default="/dev/ttyUSB0", help='port (default is /dev/ttyUSB0)')
+    argp.add_argument('-b', '--baudrate', type=lambda value: value if value == "auto" else int(value), default=115200,
+                      help='baudrate or "auto" to use the fastest rate that works (default is 115200 baud)')
+    argp.add_argument('-p', '--port', nargs="+", default=["/dev/ttyUSB0"],
+                      help='port, several ports or globs like /dev/ttyUSB* flash a fleet at once (default is /dev/ttyUSB0)')
+    argp.add_argument('-j', '--jobs', type=int, default=0, help='maximum number of ports handled at once (default is all)')
     argp.add_argument('-v', '--verbose', action='store_true', help='Verbose mode')
+    argp.add_argument('--timeout', metavar="COMMAND=SECONDS", action='append', default=[],
+                      help='reply timeout for a command, e.g. erase=2.0 (can be given multiple times)')
+    argp.add_argument('--pipeline', type=int, default=1,
+                      help='number of write frames sent ahead of their reply (default is 1, no pipelining)')
+    argp.add_argument('--verify-retries', type=int, default=2,
+                      help='times pages failing verify are rewritten before giving up (default is 2)')
+    argp.add_argument('-q', '--quiet', action='store_true', help='show a progress bar instead of every erased page and written chunk')
+    argp.add_argument('--stats-json', metavar="filename", help='store per phase command counts, bytes and latencies as json')
+    argp.add_argument('--no-cache', action='store_true', help='do not remember the detected device per port')
+    argp.add_argument('--no-image-cache', action='store_true', help='do not keep compiled hex files in .efm8cache next to them')
+    argp.add_argument('--no-journal', action='store_true', help='do not record upload progress to resume interrupted uploads')
+    argp.add_argument('--no-scan', action='store_true', help='do not scan all device ids if no known device answers')
+    argp.add_argument('--scan-timeout', type=float, default=0.05,
+                      help='reply timeout while scanning for unknown devices (default is 0.05s)')
     args = argp.parse_args()
 
+    timeouts = {}
+    for timeout in args.timeout:
+        try:
+            name, seconds = timeout.split("=")
+            timeouts[COMMAND.from_string(name)] = float(seconds)
+        except ValueError:
+            argp.error("invalid timeout '%s', expected COMMAND=SECONDS" % (timeout))
+
     print("########################################")
     print("# efm8load.py - (c) 2020 fishpepper.de #")
     print("########################################")
     print("")
 
-    efm8loader = EFM8Loader(args.port, args.baudrate, debug=args.verbose)
-
-    if (args.identify):
-        efm8loader.identify_chip()
-    elif (args.write):
-        efm8loader.upload(args.write)
-    elif (args.read):
-        efm8loader.download(args.read)
-    elif (args.reset):
-        efm8loader.send_reset()
-    else:
+    if (args.dry_run):
+        if not args.write:
+            argp.error("--dry-run needs --write")
+        print("> flash plan for '%s'" % (args.write))
+        baudrate = EFM8Loader.BAUDRATE_LADDER[0] if args.baudrate == "auto" else args.baudrate
+        plan = FlashPlan.from_file(args.write) if args.no_image_cache else ImageCache().load(args.write)
+        for line in plan.describe(baudrate, args.latency / 1000.0):
+            print(line)
+        sys.exit(0)
+
+    try:
+        ports = expand_ports(args.port)
+    except ValueError as e:
+        argp.error(str(e))
+
+    if (len(ports) > 1):
+        if (args.read or args.read_settings):
+            argp.error("--read and --read-settings only support a single port")
+        if not (args.identify or args.write or args.write_settings or args.reset):
+            argp.print_help()
+            sys.exit(1)
+        results = run_fleet(ports, args, timeouts)
+        sys.exit(0 if all(result.ok for result in results) else 1)
+
+    if not (args.identify or args.write or args.read or args.read_settings or args.write_settings or args.reset):
         argp.print_help()
         sys.exit(1)
 
+    efm8loader = EFM8Loader(ports[0], args.baudrate, **loader_options(args, timeouts))
+    try:
+        with efm8loader:
+            run_action(efm8loader, args)
+    except EFM8Error as e:
+        efm8loader.log("")
+        sys.exit("> ERROR: %s" % (e))
+
+    if (args.stats_json):
+        write_stats(args.stats_json, efm8loader.stats.summary())
+
     print()
     sys.exit(0)
@@ -0,0 +1,364 @@
+'''
+Measures how many lines per second the formatter handles and how much
+memory it needs.
+
+By default src/Bluejay.asm and src/Modules/*.asm and a generated corpus
+ten times their size are formatted with every option set. Generated
+corpora contain long banners and comment blocks, deeply nested IF blocks,
+macros and big definition files like the ones in src/Silabs. Their files
+grow with the corpus, so rules that do not scale linearly show up as a
+drop in lines/s:
+
+    python3 benchmark.py --scale 10 100 --options default comments
+
+To compare with an older version of the formatter pass it with
+--baseline, e.g. the first one, which formats a directory when it is run:
+
+    git log --reverse --format=%h -- formatter.py | head -1
+    git show <commit>:tools/formatter/formatter.py > /tmp/formatter_old.py
+    python3 benchmark.py --baseline /tmp/formatter_old.py
+'''
+import argparse
+import glob
+import importlib.util
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import formatter
+
+srcDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src")
+defaultPaths = [os.path.join(srcDir, "Bluejay.asm"), os.path.join(srcDir, "Modules", "*.asm")]
+
+optionSets = {
+    "default": {},
+    "labels": {"indentLabels": True},
+    "macros": {"indentMacros": True},
+    "comments": {"formatComments": True},
+    "all": {"indentLabels": True, "indentMacros": True, "formatComments": True},
+}
+
+# Files a generated corpus is split into
+corpusFiles = 10
+
+mnemonics = [
+    ("mov", 2), ("mov", 2), ("mov", 2), ("clr", 1), ("setb", 1), ("add", 2), ("subb", 2), ("anl", 2),
+    ("orl", 2), ("inc", 1), ("dec", 1), ("push", 1), ("pop", 1), ("rlc", 1), ("swap", 1), ("cpl", 1),
+]
+branches = ["jnb", "jb", "jz", "jnz", "jc", "jnc", "sjmp", "ajmp", "call", "djnz", "cjne"]
+registers = ["A", "B", "Temp1", "Temp2", "Temp3", "@Temp1", "R0", "R7", "DPL", "DPH", "C"]
+words = ["set", "the", "timer", "reload", "value", "for", "next", "commutation", "wait", "until",
+         "pwm", "cycle", "done", "read", "dshot", "frame", "store", "rpm", "limit", "power"]
+
+# Command line flags of the option values, for formatters that are scripts
+optionFlags = {"indentLabels": "--indent-labels", "indentMacros": "--indent-macros",
+               "formatComments": "--format-comments"}
+
+def loadScript(path):
+    '''
+    makeFormat of a formatter that formats a directory when it is run, like
+    the one before formatter.py got functions.
+
+    Every call runs the script on a directory holding only the source, so
+    reading and writing the file is part of the measurement.
+    '''
+    with open(path, 'r') as file:
+        code = compile(file.read(), path, "exec")
+
+    def makeFormat(values):
+        flags = [optionFlags[name] for name, value in values.items() if value]
+
+        def format(source):
+            with tempfile.TemporaryDirectory() as directory:
+                sourcePath = os.path.join(directory, "source.asm")
+                with open(sourcePath, 'w') as file:
+                    file.write(source)
+
+                argv = sys.argv
+                sys.argv = [path, directory, "--suffix", ".out"] + flags
+                try:
+                    exec(code, {"__name__": "formatter_baseline", "__file__": path})
+
+                finally:
+                    sys.argv = argv
+
+                with open(sourcePath + ".out", 'r') as file:
+                    return file.read()
+
+        return format
+
+    return makeFormat
+
+def loadFormatter(path):
+    '''
+    Returns a function that takes option values and returns
+    format(source) of the formatter module at path.
+    '''
+    with open(path, 'r') as file:
+        text = file.read()
+
+    if "def formatLines" not in text:
+        return loadScript(path)
+
+    spec = importlib.util.spec_from_file_location("formatter_baseline", path)
+    module = importlib.util.module_from_spec(spec)
+
+    # Older versions parse the command line when they are imported
+    argv = sys.argv
+    sys.argv = [path, "."]
+    try:
+        spec.loader.exec_module(module)
+
+    finally:
+        sys.argv = argv
+
+    if hasattr(module, "format_text"):
+        def makeFormat(values):
+            options = module.Options(**values)
+            return lambda source: module.format_text(source, options)
+
+        return makeFormat
+
+    # Versions before format_text took the parsed command line
+    def makeFormat(values):
+        args = module.parseArgs(["."])
+        for name, value in values.items():
+            setattr(args, name, value)
+
+        return lambda source: module.formatLines(io.StringIO(source, newline=None).readlines(), args)
+
+    return makeFormat
+
+def currentFormatter(values):
+    options = formatter.Options(**values)
+    return lambda source: formatter.format_text(source, options)
+
+def sentence(rng, count):
+    return " ".join(rng.choice(words) for _ in range(count))
+
+def messy(rng, line):
+    '''
+    Whitespace the formatter has to clean up.
+    '''
+    choice = rng.random()
+    if choice < 0.1:
+        return line.replace(" ", "\t", 1)
+
+    if choice < 0.2:
+        return line.replace(" ", "   ")
+
+    if choice < 0.25:
+        return "  %s  " % line
+
+    return line
+
+def instruction(rng):
+    if rng.random() < 0.2:
+        branch = rng.choice(branches)
+        target = "label_%d" % rng.randrange(1000)
+        if branch == "djnz":
+            return "%s Temp%d, %s" % (branch, rng.randrange(1, 9), target)
+
+        if branch == "cjne":
+            return "%s A, #%d, %s" % (branch, rng.randrange(256), target)
+
+        return "%s %s" % (branch, target)
+
+    mnemonic, operands = rng.choice(mnemonics)
+    if operands == 1:
+        return "%s %s" % (mnemonic, rng.choice(registers))
+
+    return "%s %s, #%d" % (mnemonic, rng.choice(registers), rng.randrange(256))
+
+def codeBlock(rng, lines):
+    for _ in range(rng.randrange(3, 20)):
+        line = instruction(rng)
+        if rng.random() < 0.3:
+            line = "%s ; %s" % (line, sentence(rng, rng.randrange(2, 8)))
+
+        if rng.random() < 0.05:
+            lines.append("label_%d:" % rng.randrange(1000))
+
+        elif rng.random() < 0.03:
+            line = "label_%d: %s" % (rng.randrange(1000), line)
+
+        lines.append(messy(rng, line))
+
+def banner(rng, lines):
+    lines.append(";**** **** **** **** **** **** **** **** **** **** **** **** ****")
+    for _ in range(rng.randrange(5, 60)):
+        lines.append("; %s" % sentence(rng, rng.randrange(0, 12)))
+
+    lines.append(";**** **** **** **** **** **** **** **** **** **** **** **** ****")
+    lines.append("")
+
+def commentBlock(rng, lines):
+    for _ in range(rng.randrange(3, 80)):
+        lines.append(messy(rng, "; %s" % sentence(rng, rng.randrange(1, 12))))
+
+    codeBlock(rng, lines)
+
+def nestedIf(rng, lines, depth=0):
+    lines.append("IF MCU_TYPE == MCU_BB%d" % rng.randrange(1, 3))
+    codeBlock(rng, lines)
+    if depth < 8 and rng.random() < 0.7:
+        nestedIf(rng, lines, depth + 1)
+
+    if rng.random() < 0.5:
+        lines.append("ELSEIF MCU_TYPE == MCU_BB51")
+        codeBlock(rng, lines)
+
+    if rng.random() < 0.5:
+        lines.append("ELSE")
+        codeBlock(rng, lines)
+
+    lines.append("ENDIF")
+
+def macro(rng, lines):
+    name = "Macro_%d" % rng.randrange(1000)
+    lines.append("%s MACRO reg" % name)
+    lines.append("LOCAL %s_done" % name.lower())
+    codeBlock(rng, lines)
+    lines.append("%s_done:" % name.lower())
+    codeBlock(rng, lines)
+    lines.append("ENDM")
+    lines.append("")
+    for _ in range(rng.randrange(1, 5)):
+        lines.append("%s Temp%d" % (name, rng.randrange(1, 9)))
+
+def definitions(rng, lines):
+    for index in range(rng.randrange(100, 600)):
+        kind = rng.choice(["DATA", "DATA", "BIT", "EQU"])
+        line = "SFR_%d_%d %s 0%02Xh" % (rng.randrange(1000), index, kind, rng.randrange(256))
+        if rng.random() < 0.5:
+            line = "%s ; %s" % (line, sentence(rng, rng.randrange(1, 6)))
+
+        lines.append(messy(rng, line))
+
+    lines.append("")
+
+blocks = [(codeBlock, 8), (banner, 1), (commentBlock, 2), (nestedIf, 2), (macro, 1), (definitions, 1)]
+
+def syntheticCorpus(lineCount, seed=0):
+    '''
+    Returns corpusFiles sources with lineCount lines in total.
+    '''
+    rng = random.Random(seed)
+    functions = [function for function, weight in blocks for _ in range(weight)]
+    sources = []
+    for index in range(corpusFiles):
+        lines = []
+        banner(rng, lines)
+        target = lineCount * (index + 1) // corpusFiles - lineCount * index // corpusFiles
+        while len(lines) < target:
+            rng.choice(functions)(rng, lines)
+            if rng.random() < 0.5:
+                lines.append("")
+
+        sources.append("\n".join(lines) + "\n")
+
+    return sources
+
+def countLines(sources):
+    return sum(len(io.StringIO(source, newline=None).readlines()) for source in sources)
+
+def measure(format, sources, repeat):
+    '''
+    Returns the best time of formatting all sources repeat times.
+    '''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for source in sources:
+            format(source)
+
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+def measureMemory(format, sources):
+    '''
+    Returns the peak of memory allocated while formatting sources.
+
+    This is a separate run because tracing slows down every allocation.
+    '''
+    tracemalloc.start()
+    try:
+        for source in sources:
+            format(source)
+
+        return tracemalloc.get_traced_memory()[1]
+
+    finally:
+        tracemalloc.stop()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the 8051 assembler formatter.")
+    parser.add_argument("paths", metavar="PATH", nargs="*", default=defaultPaths,
+                        help="files or globs to format")
+    parser.add_argument("--repeat", dest="repeat", type=int,
+                        default=3, help="runs, the fastest one is reported")
+    parser.add_argument("--scale", dest="scales", type=int, nargs="*",
+                        default=[10], help="sizes of generated corpora in multiples of PATH")
+    parser.add_argument("--options", dest="options", nargs="+", choices=list(optionSets),
+                        default=list(optionSets), help="option sets to format with")
+    parser.add_argument("--no-memory", dest="memory", action="store_false",
+                        default=True, help="do not measure the peak memory")
+    parser.add_argument("--baseline", dest="baseline",
+                        default=None, help="older formatter.py to compare with")
+    parser.add_argument("--json", dest="json",
+                        default=None, help="also store the results as json")
+    args = parser.parse_args(argv)
+
+    paths = sorted(set(path for pattern in args.paths for path in glob.glob(pattern)))
+    if not paths:
+        parser.error("no files found")
+
+    sources = []
+    for path in paths:
+        with open(path, 'r') as file:
+            sources.append(file.read())
+
+    lines = countLines(sources)
+    corpora = [("src", sources, lines)]
+    for scale in args.scales:
+        synthetic = syntheticCorpus(lines * scale)
+        corpora.append(("%dx" % scale, synthetic, countLines(synthetic)))
+
+    candidates = [("format_text", currentFormatter)]
+    if args.baseline:
+        candidates.insert(0, ("baseline", loadFormatter(args.baseline)))
+
+    results = []
+    print("%-8s %-10s %-12s %6s %8s %10s %12s %10s" %
+          ("CORPUS", "OPTIONS", "FORMATTER", "FILES", "LINES", "TIME", "LINES/S", "PEAK"))
+    for corpus, corpusSources, corpusLines in corpora:
+        for optionSet in args.options:
+            for name, makeFormat in candidates:
+                format = makeFormat(optionSets[optionSet])
+                elapsed = measure(format, corpusSources, args.repeat)
+                peak = measureMemory(format, corpusSources) if args.memory else None
+                results.append({
+                    "corpus": corpus, "options": optionSet, "formatter": name,
+                    "files": len(corpusSources), "lines": corpusLines, "seconds": elapsed,
+                    "linesPerSecond": corpusLines / elapsed, "peakBytes": peak,
+                })
+                print("%-8s %-10s %-12s %6d %8d %8.1fms %12.0f %10s" % (
+                    corpus, optionSet, name, len(corpusSources), corpusLines, elapsed * 1000,
+                    corpusLines / elapsed, "%.0f KiB" % (peak / 1024) if peak is not None else "-"))
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({"results": results}, file, indent=2)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
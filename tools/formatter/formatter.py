@@ -3,57 +3,40 @@ Attempts to auto format assembler code by the following rules:
 * Replace all tabs with whitespaces
 * Replace multiple ;  with single ;
 * Replace multiple empty lines with single empty line
-* Find longest fields
+* Align fields and inline comments
+
+Lines are split into tokens by lexer.py, which other tools can use too.
+format_text(source, options) formats a string and can be imported, the
+command line formats and lints whole directories:
+
+    from formatter import Options, format_text
+    formatted = format_text(source, Options(indentLabels=True))
+
+Files are processed in parallel. In lint mode nothing is written, every
+file that would change is reported with a unified diff. Files are only
+written when they change. With --cache FILE, files that are known to be
+formatted with the same options are skipped, nothing is cached without it.
+
+With --serve the formatter stays resident: it polls PATH and formats or
+lints every file that changes. Format requests are answered over stdin
+(--stdin) or a unix socket (--socket), one JSON object per line:
+
+    {"id": 1, "source": "..."}  ->  {"id": 1, "formatted": "...", "changed": true, "ms": 1.2}
 '''
 import argparse
-import filecmp
+import collections
+import concurrent.futures
+import difflib
+import hashlib
+import io
+import json
 import os
-import re
+import socketserver
 import sys
+import threading
+import time
 
-parser = argparse.ArgumentParser(description="Format and lint 8051 assembler files.")
-parser.add_argument("path", metavar="PATH", type=str,
-                    help="directory to search for files")
-parser.add_argument("--extensions", dest="extensions", nargs="+",
-                    default=["asm", "inc"],
-                    help="list of file extension to parse")
-parser.add_argument("--exclude", dest="exclude", nargs="+",
-                    default=["build", "tools", "Silabs"],
-                    help="list of directories to exclude")
-parser.add_argument("--suffix", dest="suffix",
-                    default="", help="suffix for formatted file, default overwrites current file")
-parser.add_argument("--spaces", dest="spaces",
-                    default=4, help="spaces per level of indent")
-parser.add_argument("--comment-offset", dest="commentOffset",
-                    default=40, help="offset for comments from beginning of the line")
-parser.add_argument("--lint", dest="lint", action="store_true",
-                    default=False, help="lint files")
-parser.add_argument("--indent-labels", dest="indentLabels", action="store_true",
-                    default=False, help="Indent code after labels")
-parser.add_argument("--indent-macros", dest="indentMacros", action="store_true",
-                    default=False, help="Indent code within macros")
-parser.add_argument("--min-indentation", dest="minIndentation",
-                    default=1, help="Minimum indentation for all instructions")
-parser.add_argument("--format-comments", dest="formatComments", action="store_true",
-                    default=False, help="Attempt to format comments")
-
-
-args = parser.parse_args()
-
-path = args.path
-processExtensions = args.extensions
-excludeDirs = args.exclude
-suffix = args.suffix
-spaces = args.spaces
-offsetInlineComments = args.commentOffset
-lint = args.lint
-indentLabels = args.indentLabels
-indentMacros = args.indentMacros
-minIndentation = args.minIndentation
-formatComments = args.formatComments
-
-if lint:
-    suffix = ".asmb"
+import lexer
 
 noIndent = ["AT", "IF", "ELSE", "ELSEIF", "MACRO", "ENDM", "$if", "$endif", "$set", "EQU", "DB", "DS", "END", "$include", "$set"]
 indentInIf = ["$include", "$set", "EQU", "AT"]
@@ -63,252 +46,246 @@ decreaseDepth = ["ENDIF"]
 temporaryDecreaseDepth = ["ELSE", "ELSEIF"]
 nestedSameDepth = ["IF", "ENDIF"]
 resetLabel = ["MACRO", "ENDM", "$include", ";****"]
-maxLength = [0, 0]
-
-if indentMacros:
-    increaseDepth.append("MACRO")
-    decreaseDepth.append("ENDM")
-
-def cleanup(line):
-    line = re.sub('[\r\n]', '', line)
 
-    match = re.match(r"\s*\;.*", line)
-    if not match:
-        # Strip spaces from beginning and end
-        line = line.strip()
-
-        # Replace tabs in all lines
-        line = re.sub('\t+', ' ', line)
-
-        # Replace muliple spaces with one unless in quotes or in inline comments
-        fields = line.split(';')
-        fields[0] = re.sub(r'("[^"]*")| +', lambda m: m.group(1) if m.group(1) else ' ', fields[0])
-        line = ";".join(fields)
-
-        # Replace multiple semicolons with one
-        line = re.sub(';+', ';', line)
-
-        # Replace comma with comma space
-        line = re.sub(', +', ',', line)
-
-        # Add space after pre-processor directive
-        line = re.sub(r'\$set\(', '$set (', line)
-
-        fields = line.split(" ")
-        field0 = fields[0]
-        field1 = fields[1] if (len(fields) > 1) else None
+commentKinds = frozenset([lexer.COMMENT, lexer.BANNER])
 
-        # Find long strings to indent calculation
-        if (not field1 or not field1.startswith(tuple(noIndent))) and not field0.endswith(":"):
-            length = len(field0)
-            if length > maxLength[0] and not field0.startswith(tuple(noIndent)):
-                maxLength[0] = length
-
-            # Only cound if filed 1 is available and does not contain a comma
-            if field1 and "," not in field1:
-                # Only count field 1 if there is one following
-                if len(fields) > 2 and fields[2] != ";":
-                    # Only count if field 0 should have indent
-                    if not field0.startswith(tuple(noIndent)):
-                        length = len(field1)
-                        if length > maxLength[1]:
-                            maxLength[1] = length
+# Options that change the formatted output
+formatOptions = ["spaces", "commentOffset", "indentLabels", "indentMacros", "minIndentation", "formatComments"]
 
-    else:
-        line = re.sub('\t', ' ' * spaces, line)
+class Options:
+    '''
+    Formatter options with the rules compiled once, instances are never
+    changed by formatting and can be shared.
+    '''
 
-    return line
+    def __init__(self, spaces=4, commentOffset=40, indentLabels=False, indentMacros=False,
+                 minIndentation=1, formatComments=False):
+        self.spaces = spaces
+        self.commentOffset = commentOffset
+        self.indentLabels = indentLabels
+        self.indentMacros = indentMacros
+        self.minIndentation = minIndentation
+        self.formatComments = formatComments
+
+        self.noIndent = frozenset(noIndent)
+        self.noIndentPrefixes = tuple(noIndent)
+        self.indentInIf = frozenset(indentInIf)
+        self.increaseDepth = frozenset(increaseDepth + (["MACRO"] if indentMacros else []))
+        self.decreaseDepth = frozenset(decreaseDepth + (["ENDM"] if indentMacros else []))
+        self.temporaryDecreaseDepth = frozenset(temporaryDecreaseDepth)
+        self.nestedSameDepth = frozenset(nestedSameDepth)
+        self.resetLabel = frozenset(resetLabel)
+        self.tab = " " * spaces
+
+    @classmethod
+    def fromArgs(cls, args):
+        return cls(**dict((name, getattr(args, name)) for name in formatOptions))
+
+    def values(self):
+        return dict((name, getattr(self, name)) for name in formatOptions)
+
+Result = collections.namedtuple("Result", ["path", "status", "diff", "error", "key"])
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description="Format and lint 8051 assembler files.")
+    parser.add_argument("path", metavar="PATH", type=str,
+                        help="directory to search for files")
+    parser.add_argument("--extensions", dest="extensions", nargs="+",
+                        default=["asm", "inc"],
+                        help="list of file extension to parse")
+    parser.add_argument("--exclude", dest="exclude", nargs="+",
+                        default=["build", "tools", "Silabs"],
+                        help="list of directories to exclude")
+    parser.add_argument("--suffix", dest="suffix",
+                        default="", help="suffix for formatted file, default overwrites current file")
+    parser.add_argument("--spaces", dest="spaces", type=int,
+                        default=4, help="spaces per level of indent")
+    parser.add_argument("--comment-offset", dest="commentOffset", type=int,
+                        default=40, help="offset for comments from beginning of the line")
+    parser.add_argument("--lint", dest="lint", action="store_true",
+                        default=False, help="lint files")
+    parser.add_argument("--indent-labels", dest="indentLabels", action="store_true",
+                        default=False, help="Indent code after labels")
+    parser.add_argument("--indent-macros", dest="indentMacros", action="store_true",
+                        default=False, help="Indent code within macros")
+    parser.add_argument("--min-indentation", dest="minIndentation", type=int,
+                        default=1, help="Minimum indentation for all instructions")
+    parser.add_argument("--format-comments", dest="formatComments", action="store_true",
+                        default=False, help="Attempt to format comments")
+    parser.add_argument("--jobs", "-j", dest="jobs", type=int,
+                        default=os.cpu_count() or 1, help="number of files processed in parallel")
+    parser.add_argument("--cache", dest="cache",
+                        default=None, help="cache of formatted files, default is no cache")
+    parser.add_argument("--no-cache", dest="noCache", action="store_true",
+                        default=False, help="ignore --cache, do not skip files known to be formatted")
+    parser.add_argument("--serve", dest="serve", action="store_true",
+                        default=False, help="stay resident and process files in PATH when they change")
+    parser.add_argument("--interval", dest="interval", type=float,
+                        default=0.5, help="seconds between polls of PATH in serve mode")
+    parser.add_argument("--stdin", dest="stdin", action="store_true",
+                        default=False, help="answer format requests on stdin in serve mode, stops at end of input")
+    parser.add_argument("--socket", dest="socket",
+                        default=None, help="answer format requests on this unix socket in serve mode")
+
+    return parser.parse_args(argv)
+
+def format_text(source, options=None):
+    '''
+    Format the source of one file and return the formatted text.
+    '''
+    if options is None:
+        options = Options()
 
-# Collect all files to be processed
-processPaths = []
-for root, dirs, files in os.walk(path):
-    dirs[:] = [d for d in dirs if d not in excludeDirs]
-    for file in files:
-        extension = file.split(".")[-1]
-        if extension in processExtensions:
-            path = os.path.join(root, file)
-            processPaths.append(path)
+    # Split lines like reading a file in text mode does
+    return formatLines(io.StringIO(source, newline=None).readlines(), options)
 
-for path in processPaths:
+def formatLines(lines, options):
     '''
-    In the first run we find out what our longest fields are and do some base
-    sanitation.
+    Format the lines of one file and return the formatted text.
+
+    The lexer cleans up every line and splits labels from instructions. In
+    the first pass over its tokens empty lines are collapsed and fields
+    are aligned and indented, the second pass indents comments.
     '''
+    spaces = options.spaces
+    offsetInlineComments = options.commentOffset
+    indentLabels = options.indentLabels
+    minIndentation = options.minIndentation
+    formatComments = options.formatComments
+
+    noIndent = options.noIndent
+    indentInIf = options.indentInIf
+    increase = options.increaseDepth
+    decrease = options.decreaseDepth
+    temporaryDecreaseDepth = options.temporaryDecreaseDepth
+    nestedSameDepth = options.nestedSameDepth
+    resetLabel = options.resetLabel
+
     depth = 0
     sawLabel = False
     inBanner = False
 
-    cleanLines = []
     formattedLinesRough = []
     formattedLines = []
 
     lastEmpty = False
-    maxLength = [0, 0]
     ifDepth = 0
 
-    file = open(path, 'r')
-    lines = file.readlines()
-    for line in lines:
-        line = cleanup(line)
-
-        # split label and non comment line into two lines
-        match = re.match(r"([\w\s]+\:)(.+)", line)
-        if(match):
-            field0 = match.group(1).strip()
-            field1 = match.group(2).strip()
-
-            if (
-                not field1.startswith(";") and
-                not field1.startswith("DS") and
-                not field1.startswith("DB")
-            ):
-                cleanLines.append(field0)
-                cleanLines.append(field1)
-
-            else:
-                cleanLines.append(line)
-
-            continue
-
-        # Prevent two empty lines after each other
-        if line != "" or not lastEmpty:
-          cleanLines.append(line)
+    for token in lexer.tokenize(lines, options.tab):
+        line = token.text
 
-        lastEmpty = False
+        # Empty line, prevent two empty lines after each other
         if line == "":
-          lastEmpty = True
-
-    file.close()
+            if lastEmpty:
+                continue
 
-    # Reformat all available lines
-    targetPath = "%s%s" % (path, suffix)
-    file = open(targetPath, 'w')
-    for line in cleanLines:
-        lineIsLabel = False
-        lineIsComment = False
-
-        # Empty line
-        if line == "":
+            lastEmpty = True
             inBanner = False
+            formattedLinesRough.append(line)
+            continue
 
-        if line != "":
-            fields = line.split(" ")
-
-            match = re.match(r"\s*\;.*", line)
-            if match:
-                lineIsComment = True
-
-            if inBanner:
-                if not line.startswith(";"):
-                    inBanner = False
-
-            if line.startswith(";****"):
-                inBanner = True
-
-
-            field0 = fields[0]
-            field1 = fields[1] if (len(fields) > 1) else None
-
-            if field0.endswith(":"):
-                if not field1 or field1.startswith(";"):
-                    lineIsLabel = True
-                    sawLabel = True
+        # Lines that had a label in front don't end a run of empty lines
+        if not token.inlineLabel:
+            lastEmpty = False
 
-            # Do not touch comments
-            if not lineIsComment and len(fields) > 1:
-                if field0 not in noIndent and field1 not in noIndent:
-                    # Append spaces to field 0
-                    # append0 = maxLength[0] - len(field0) - (depth * spaces)
-                    append0 = 4 - len(field0)
-                    fields[0] = "%s%s" % (field0, " " * append0)
+        fields = token.fields
+        field0 = fields[0]
+        field1 = fields[1] if (len(fields) > 1) else None
 
-                    # Append spaced to field 1
-                    if len(fields) > 1 and field1 != ";" and "," not in field1:
-                        #append1 = maxLength[1] - len(field1)
-                        append1 = 0
+        lineIsComment = token.kind in commentKinds
+        lineIsLabel = False
 
-                        # Compensate for lines where field 0 is longer due to indendation
-                        if append0 < 0:
-                            append1 += append0
+        if inBanner:
+            if not line.startswith(";"):
+                inBanner = False
 
-                        fields[1] = "%s%s" % (field1, " " * append1)
+        if token.kind == lexer.BANNER:
+            inBanner = True
+
+        if field0.endswith(":"):
+            if not field1 or field1.startswith(";"):
+                lineIsLabel = True
+                sawLabel = True
+
+        # Do not touch comments
+        if not lineIsComment and field1 is not None:
+            if field0 not in noIndent and field1 not in noIndent:
+                # Pad field 0 and put a space after commas in field 1
+                aligned1 = field1
+                if field1 != ";" and "," in field1:
+                    aligned1 = field1.replace(',', ', ')
+
+                rest = line[len(field0) + len(field1) + 1:]
+                line = ("%s %s%s" % (field0.ljust(4), aligned1, rest)).rstrip()
+
+        if field0 in decrease or field1 in decrease:
+            # Nested IFs are not further indented
+            if field0 == "ENDIF":
+                ifDepth -= 1
+                if ifDepth == 0:
+                    depth -= 1
+            else:
+                depth -= 1
 
-                    if len(fields) > 1 and field1 != ";" and "," in field1:
-                        fields[1] = re.sub(',', ', ', field1)
+        if sawLabel and (field0 in resetLabel or field1 in resetLabel):
+            sawLabel = False
+            depth -= 1
 
-                line = " ".join(fields)
-                line = line.rstrip()
+        if sawLabel and indentLabels:
+            if depth == 0:
+                depth += 1
 
-            if field0 in decreaseDepth or field1 in decreaseDepth:
-                # Nested IFs are not further indented
-                if field0 == "ENDIF":
-                    ifDepth -= 1
-                    if ifDepth == 0:
-                        depth -= 1
-                else:
-                    depth -= 1
+        if depth < 0:
+            depth = 0
 
-            if sawLabel and (field0 in resetLabel or field1 in resetLabel):
-                sawLabel = False
-                depth -= 1
+        # Calculate space prefix
+        spacePrefix = depth * spaces
 
-            if sawLabel and indentLabels:
-                if depth == 0:
-                    depth += 1
+        if field0 in temporaryDecreaseDepth:
+            spacePrefix -= spaces
 
-            if depth < 0:
-                depth = 0
+        if lineIsLabel and spacePrefix > 0:
+            spacePrefix = 0
 
-            # Calculate space prefix
-            spacePrefix = depth * spaces
+        if inBanner:
+            spacePrefix = 0
 
-            if field0 in temporaryDecreaseDepth:
+        # Do not further indent nested ifs
+        if ifDepth > 0:
+            if field0 in nestedSameDepth:
                 spacePrefix -= spaces
 
-            if lineIsLabel and spacePrefix > 0:
-                spacePrefix = 0
-
-            if inBanner:
-                spacePrefix = 0
-
-            # Do not further indent nested ifs
-            if ifDepth > 0:
-                if field0 in nestedSameDepth:
-                    spacePrefix -= spaces
-
-            if spacePrefix == 0:
-                if (
-                    field0 not in noIndent and
-                    field1 not in noIndent and
-                    field0 not in decreaseDepth and
-                    not lineIsLabel and
-                    not lineIsComment
-                ):
-                    spacePrefix = spaces * minIndentation
-
-            if spacePrefix == 0 and ifDepth > 0:
-                if field0 in indentInIf or field1 in indentInIf:
-                    spacePrefix = spaces * minIndentation
-
-            if not lineIsComment or formatComments:
-                line = "%s%s" % (" " * spacePrefix, line)
-
-            # Align all inline comments
-            fields = line.split(";")
-            if not line.startswith(";") and fields[0].strip() != "":
-                if len(fields) > 1:
-                    append = offsetInlineComments - len(fields[0])
-                    fields[0] = "%s%s" % (fields[0], " " * append)
-                    line = ";".join(fields)
-
-            if field0 in increaseDepth or field1 in increaseDepth:
-                # Nested IFs should not further be indented
-                if field0 == "IF":
-                    ifDepth += 1
-                    if ifDepth == 1:
-                        depth += 1
-                else:
+        if spacePrefix == 0:
+            if (
+                field0 not in noIndent and
+                field1 not in noIndent and
+                field0 not in decrease and
+                not lineIsLabel and
+                not lineIsComment
+            ):
+                spacePrefix = spaces * minIndentation
+
+        if spacePrefix == 0 and ifDepth > 0:
+            if field0 in indentInIf or field1 in indentInIf:
+                spacePrefix = spaces * minIndentation
+
+        if not lineIsComment or formatComments:
+            line = "%s%s" % (" " * spacePrefix, line)
+
+        # Align all inline comments
+        if ";" in line and not line.startswith(";"):
+            index = line.index(";")
+            if line[:index].strip() != "":
+                line = "%s%s" % (line[:index].ljust(offsetInlineComments), line[index:])
+
+        if field0 in increase or field1 in increase:
+            # Nested IFs should not further be indented
+            if field0 == "IF":
+                ifDepth += 1
+                if ifDepth == 1:
                     depth += 1
+            else:
+                depth += 1
 
         formattedLinesRough.append(line)
 
@@ -332,14 +309,17 @@ for path in processPaths:
                     # find first line that is not a comment (or empty) and apply
                     # indentation to all previous lines
                     offset = 1
-                    while (
+                    while index + offset < lineCount and (
                         formattedLinesRough[index + offset].startswith(";") or
                         formattedLinesRough[index + offset] == ""
                     ):
                         offset += 1
 
-                    spacePrefix = formattedLinesRough[index + offset]
-                    spaceCount = len(spacePrefix) - len(spacePrefix.lstrip())
+                    # Comments at the end of a file are not indented
+                    spaceCount = 0
+                    if index + offset < lineCount:
+                        spacePrefix = formattedLinesRough[index + offset]
+                        spaceCount = len(spacePrefix) - len(spacePrefix.lstrip())
 
                     targetIndex = index + offset
                     while index < targetIndex:
@@ -360,13 +340,284 @@ for path in processPaths:
     if formattedLines[-1] != "":
         formattedLines.append("")
 
-    file.write("\n".join(formattedLines))
-    file.close()
+    return "\n".join(formattedLines)
+
+def optionsHash(options):
+    '''
+    Hash of the formatter and lexer source and all options that change
+    its output.
+    '''
+    digest = hashlib.sha256()
+    for path in (__file__, lexer.__file__):
+        with open(os.path.abspath(path), 'rb') as file:
+            digest.update(file.read())
+
+    digest.update(json.dumps(options.values(), sort_keys=True).encode())
+    return digest.hexdigest()
+
+def cacheKey(content, args):
+    return "%s:%s" % (hashlib.sha256(content).hexdigest(), args.optionsHash)
+
+def loadCache(path):
+    try:
+        with open(path, 'r') as file:
+            return set(json.load(file)["formatted"])
+
+    except (OSError, ValueError, KeyError, TypeError):
+        return set()
+
+def saveCache(path, keys):
+    try:
+        tempPath = "%s.%d.tmp" % (path, os.getpid())
+        with open(tempPath, 'w') as file:
+            json.dump({"formatted": sorted(keys)}, file, indent=0)
+
+        os.replace(tempPath, path)
+
+    except OSError:
+        # The cache only saves time
+        pass
+
+def processFile(path, args, cached=frozenset()):
+    '''
+    Format a single file and return its Result.
+
+    Files whose cache key is in cached are skipped without parsing. In lint
+    mode the diff of a file that is not formatted is returned, otherwise
+    the formatted file is written to path + suffix unless it is unchanged.
+    The key is set for files that turned out to be formatted.
+    '''
+    try:
+        with open(path, 'rb') as file:
+            original = file.read()
+
+        key = cacheKey(original, args)
+        if key in cached and (args.lint or not args.suffix):
+            return Result(path, "cached", None, None, key)
+
+        # Decode the same way as reading the file in text mode would
+        lines = io.TextIOWrapper(io.BytesIO(original)).readlines()
+        formatted = formatLines(lines, args.options).encode()
+        isFormatted = formatted == original
+
+        if not args.lint:
+            targetPath = "%s%s" % (path, args.suffix)
+            current = original
+            if args.suffix:
+                try:
+                    with open(targetPath, 'rb') as file:
+                        current = file.read()
+
+                except OSError:
+                    current = None
+
+            if formatted == current:
+                return Result(path, "unchanged", None, None, key if isFormatted else None)
+
+            with open(targetPath, 'wb') as file:
+                file.write(formatted)
+
+            return Result(path, "written", None, None, key if isFormatted else None)
+
+        if isFormatted:
+            return Result(path, "unchanged", None, None, key)
+
+        diff = difflib.unified_diff(
+            [line.rstrip("\r\n") for line in lines], formatted.decode().split("\n"),
+            fromfile=path, tofile="%s (formatted)" % path, lineterm="")
+        return Result(path, "failed", "\n".join(diff), None, None)
+
+    except Exception as e:
+        return Result(path, "error", None, "%s: %s" % (type(e).__name__, e), None)
+
+def collectPaths(path, processExtensions, excludeDirs):
+    processPaths = []
+    for root, dirs, files in os.walk(path):
+        dirs[:] = [d for d in dirs if d not in excludeDirs]
+        for file in files:
+            extension = file.split(".")[-1]
+            if extension in processExtensions:
+                processPaths.append(os.path.join(root, file))
+
+    return processPaths
+
+def processFiles(processPaths, args, cached):
+    if args.jobs <= 1 or len(processPaths) <= 1:
+        return [processFile(path, args, cached) for path in processPaths]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [executor.submit(processFile, path, args, cached) for path in processPaths]
+        return [future.result() for future in futures]
+
+def handleRequest(line, options):
+    '''
+    Answer one JSON format request, returns the JSON response.
+    '''
+    start = time.perf_counter()
+    request = {}
+    try:
+        request = json.loads(line)
+        source = request["source"]
+        formatted = format_text(source, options)
+        response = {"formatted": formatted, "changed": formatted != source}
+
+    except Exception as e:
+        response = {"error": "%s: %s" % (type(e).__name__, e)}
+
+    if isinstance(request, dict) and "id" in request:
+        response["id"] = request["id"]
+
+    response["ms"] = round((time.perf_counter() - start) * 1000, 3)
+    return json.dumps(response)
+
+def report(result, output):
+    if result.status == "error":
+        print("Failed processing %s: %s" % (result.path, result.error), file=output)
+
+    elif result.status == "failed":
+        print("Failed linting %s" % result.path, file=output)
+        print(result.diff, file=output)
+
+    elif result.status == "written":
+        print("Formatted %s" % result.path, file=output)
+
+def watch(args, stop, output):
+    '''
+    Poll PATH until stop is set and process every file that changes.
+    '''
+    known = {}
+    first = True
+    while not stop.is_set():
+        for path in collectPaths(args.path, args.extensions, args.exclude):
+            try:
+                stat = os.stat(path)
+
+            except OSError:
+                continue
+
+            signature = (stat.st_mtime_ns, stat.st_size)
+            if known.get(path) == signature:
+                continue
+
+            if not first:
+                report(processFile(path, args), output)
+                # Do not process the file again because it was just written
+                try:
+                    stat = os.stat(path)
+                    signature = (stat.st_mtime_ns, stat.st_size)
+
+                except OSError:
+                    pass
+
+            known[path] = signature
+
+        first = False
+        stop.wait(args.interval)
+
+def serve(args):
+    '''
+    Stay resident until interrupted or, with --stdin, until the end of input.
+
+    Requests are answered on stdout, everything else goes to stderr.
+    '''
+    stop = threading.Event()
+    lock = threading.Lock()
+    output = sys.stderr
+
+    watcher = threading.Thread(target=watch, args=(args, stop, output), daemon=True)
+    watcher.start()
+
+    server = None
+    if args.socket:
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if line.strip():
+                        response = handleRequest(line, args.options)
+                        self.wfile.write(response.encode() + b"\n")
+                        self.wfile.flush()
+
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+
+        server = socketserver.ThreadingUnixStreamServer(args.socket, Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    if args.stdin:
+        def readStdin():
+            for line in sys.stdin:
+                if line.strip():
+                    response = handleRequest(line, args.options)
+                    with lock:
+                        sys.stdout.write(response + "\n")
+                        sys.stdout.flush()
+
+            stop.set()
+
+        threading.Thread(target=readStdin, daemon=True).start()
+
+    print("Serving %s%s, press ctrl+c to stop" % (args.path, " and %s" % args.socket if args.socket else ""), file=output)
+    try:
+        while not stop.wait(0.5):
+            pass
+
+    except KeyboardInterrupt:
+        pass
+
+    stop.set()
+    watcher.join()
+    if server:
+        server.shutdown()
+        server.server_close()
+        os.unlink(args.socket)
+
+    return 0
+
+def main(argv=None):
+    args = parseArgs(argv)
+
+    start = time.monotonic()
+    args.options = Options.fromArgs(args)
+    args.optionsHash = optionsHash(args.options)
+    if args.serve:
+        return serve(args)
+
+    useCache = args.cache and not args.noCache
+    cached = frozenset(loadCache(args.cache)) if useCache else frozenset()
+
+    processPaths = collectPaths(args.path, args.extensions, args.exclude)
+    results = processFiles(processPaths, args, cached)
+
+    if useCache:
+        # Keep the entries of other options, drop outdated ones of these
+        keys = set(key for key in cached if not key.endswith(args.optionsHash))
+        keys.update(result.key for result in results if result.key)
+        saveCache(args.cache, keys)
+
+    elapsed = time.monotonic() - start
+
+    counts = collections.Counter(result.status for result in results)
+    for result in results:
+        if result.status != "written":
+            report(result, sys.stdout)
+
+    failed = counts["failed"]
+    errors = counts["error"]
+    action = "Linted" if args.lint else "Formatted"
+    summary = "%s %d files in %.2fs (%d jobs), %d cached" % (action, len(results), elapsed, args.jobs, counts["cached"])
+    if args.lint:
+        summary += ", %d not formatted" % failed
+
+    else:
+        summary += ", %d written" % counts["written"]
+
+    if errors:
+        summary += ", %d errors" % errors
+
+    print(summary)
 
-    if lint:
-        match = filecmp.cmp(path, targetPath)
-        os.unlink(targetPath)
+    return 1 if (failed or errors) else 0
 
-        if not match:
-            print("Failed linting %s" % path)
-            sys.exit(1)
+if __name__ == "__main__":
+    sys.exit(main())
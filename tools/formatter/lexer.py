@@ -0,0 +1,261 @@
+'''
+Splits 8051 assembler (Keil AX51) sources into Line tokens.
+
+Every source line is cleaned up and split into its fields once: tabs and
+repeated spaces or semicolons are collapsed, and a label in front of an
+instruction becomes a token of its own. The formatter only looks at the
+fields of a token, other tools can use its kind, mnemonic, operands and
+comment:
+
+    import lexer
+    with open("src/Modules/Isrs.asm") as file:
+        for line in lexer.tokenize(file):
+            if line.kind == lexer.INSTRUCTION:
+                print(line.number, line.mnemonic, line.operands)
+'''
+import re
+
+# Kinds of lines
+EMPTY = "empty"
+COMMENT = "comment"
+BANNER = "banner"
+LABEL = "label"
+INSTRUCTION = "instruction"
+DIRECTIVE = "directive"
+CONDITIONAL = "conditional"
+MACRO = "macro"
+PREPROCESSOR = "preprocessor"
+
+conditionals = frozenset(["IF", "ELSE", "ELSEIF", "ENDIF"])
+macros = frozenset(["MACRO", "ENDM"])
+directives = frozenset(["AT", "BSEG", "CSEG", "DB", "DBIT", "DS", "DSEG", "DW", "END", "EXTRN", "ISEG",
+                        "LOCAL", "NAME", "ORG", "PUBLIC", "RSEG", "USING", "XSEG"])
+
+# Directives that follow the symbol they define
+namedDirectives = frozenset(["BIT", "CODE", "DATA", "EQU", "IDATA", "LIT", "SEGMENT", "SET", "XDATA"])
+
+tabsPattern = re.compile('\t+')
+spacesPattern = re.compile(r'("[^"]*")| +')
+semicolonsPattern = re.compile(';+')
+commaPattern = re.compile(', +')
+setPattern = re.compile(r'\$set\(')
+labelPattern = re.compile(r"([\w\s]+\:)(.+)")
+
+class Line:
+    '''
+    One cleaned up line of source.
+
+    text is the cleaned line and fields its text split at single spaces.
+    number is the line in the source the token comes from, a label in
+    front of an instruction gets the number of its instruction. label is
+    set for labels and for directives behind a label (Temp1: DS 1) and
+    inlineLabel is set for every token of a source line that carried a
+    label in front of something else.
+    '''
+    __slots__ = ("kind", "label", "number", "text", "fields", "inlineLabel")
+
+    def __init__(self, kind, label, number, text, fields, inlineLabel=False):
+        self.kind = kind
+        self.number = number
+        self.text = text
+        self.fields = fields
+        self.label = label
+        self.inlineLabel = inlineLabel
+
+    def __repr__(self):
+        return "Line(%s, %d, %r)" % (self.kind, self.number, self.text)
+
+    @property
+    def code(self):
+        '''
+        Text in front of the comment, without a leading label.
+        '''
+        if self.kind in (EMPTY, COMMENT, BANNER):
+            return ""
+
+        code = self.text.split(";", 1)[0].strip()
+        if self.label is not None:
+            code = code[len(self.label) + 1:].lstrip()
+
+        return code
+
+    @property
+    def comment(self):
+        '''
+        Text behind the first semicolon or None.
+        '''
+        index = self.text.find(";")
+        return self.text[index + 1:] if index >= 0 else None
+
+    def _parts(self):
+        words = self.code.split(" ", 2)
+        if len(words) > 1 and (words[1].upper() in namedDirectives or words[1].upper() in macros):
+            return words[0], words[1], words[2] if len(words) > 2 else ""
+
+        if not words[0]:
+            return None, None, ""
+
+        return None, words[0], " ".join(words[1:])
+
+    @property
+    def name(self):
+        '''
+        Symbol defined by a directive like EQU or a macro definition.
+        '''
+        return self._parts()[0]
+
+    @property
+    def mnemonic(self):
+        '''
+        Instruction, directive or macro that is invoked.
+        '''
+        return self._parts()[1]
+
+    @property
+    def argument(self):
+        '''
+        Everything behind the mnemonic, e.g. the condition of an IF.
+        '''
+        return self._parts()[2]
+
+    @property
+    def operands(self):
+        return splitOperands(self.argument)
+
+def splitOperands(text):
+    '''
+    Split at commas that are not in quotes or parentheses.
+    '''
+    operands = []
+    depth = 0
+    quote = None
+    start = 0
+    for index, char in enumerate(text):
+        if quote:
+            if char == quote:
+                quote = None
+
+        elif char in "'\"":
+            quote = char
+
+        elif char == "(":
+            depth += 1
+
+        elif char == ")":
+            depth -= 1
+
+        elif char == "," and depth == 0:
+            operands.append(text[start:index].strip())
+            start = index + 1
+
+    last = text[start:].strip()
+    if last or operands:
+        operands.append(last)
+
+    return operands
+
+def keepQuoted(match):
+    return match.group(1) if match.group(1) else ' '
+
+def cleanup(line, tab="    "):
+    '''
+    Normalize whitespace and semicolons of one line.
+
+    Comment lines only get their tabs expanded, in code lines whitespace
+    is collapsed except in quotes and inline comments.
+    '''
+    if line.endswith("\n"):
+        line = line[:-1]
+
+    if "\r" in line or "\n" in line:
+        line = line.replace("\r", "").replace("\n", "")
+
+    stripped = line.strip()
+    if stripped.startswith(";"):
+        return line.replace('\t', tab) if "\t" in line else line
+
+    line = stripped
+    if "\t" in line:
+        line = tabsPattern.sub(' ', line)
+
+    # Replace muliple spaces with one unless in quotes or in inline comments
+    if "  " in line:
+        fields = line.split(';')
+        fields[0] = spacesPattern.sub(keepQuoted, fields[0])
+        line = ";".join(fields)
+
+    if ";;" in line:
+        line = semicolonsPattern.sub(';', line)
+
+    if ", " in line:
+        line = commaPattern.sub(',', line)
+
+    if "$set(" in line:
+        line = setPattern.sub('$set (', line)
+
+    return line
+
+def classify(fields):
+    '''
+    Kind and label of a cleaned up line from its fields.
+    '''
+    first = fields[0]
+    if first.startswith(";"):
+        return (BANNER if first.startswith(";****") else COMMENT), None
+
+    if not first:
+        # Only comment lines keep leading whitespace
+        return (EMPTY if len(fields) == 1 else COMMENT), None
+
+    label = None
+    if first.endswith(":"):
+        if len(fields) == 1 or fields[1].startswith(";"):
+            return LABEL, first[:-1]
+
+        label = first[:-1]
+        fields = fields[1:]
+
+    keyword = fields[0].upper()
+    following = fields[1].upper() if len(fields) > 1 else ""
+    if keyword.startswith("$"):
+        return PREPROCESSOR, label
+
+    if keyword in conditionals:
+        return CONDITIONAL, label
+
+    if keyword in macros or following in macros:
+        return MACRO, label
+
+    if keyword in directives or following in namedDirectives:
+        return DIRECTIVE, label
+
+    return INSTRUCTION, label
+
+def tokenize(lines, tab="    "):
+    '''
+    Yield the Line tokens of an iterable of source lines.
+
+    tab replaces tabs in comment lines, which are not collapsed.
+    '''
+    for number, line in enumerate(lines, 1):
+        line = cleanup(line, tab)
+        if not line:
+            yield Line(EMPTY, None, number, line, [line])
+            continue
+
+        # Split a label from whatever follows it unless that is a comment or data
+        match = labelPattern.match(line) if ":" in line else None
+        if match:
+            label = match.group(1).strip()
+            rest = match.group(2).strip()
+            if not rest.startswith(";") and not rest.startswith("DS") and not rest.startswith("DB"):
+                fields = label.split(" ")
+                yield Line(*classify(fields), number, label, fields, True)
+                line = rest
+
+            fields = line.split(" ")
+            yield Line(*classify(fields), number, line, fields, True)
+            continue
+
+        fields = line.split(" ")
+        yield Line(*classify(fields), number, line, fields)
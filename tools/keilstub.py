@@ -0,0 +1,142 @@
+'''
+Stands in for the Keil AX51, LX51 and Ohx51 binaries so builds can be
+tested without wine and a Keil installation:
+
+    python3 buildmatrix.py --stub --layout A B --deadtime 5
+
+The first argument selects the tool, the rest are the arguments the
+Makefile passes to it:
+
+    python3 keilstub.py ax51 src/Bluejay.asm "INCDIR(src/Settings) " "DEFINE(ESCNO=1) " ...
+    python3 keilstub.py lx51 A_H_5_24.OBJ TO A_H_5_24.OMF
+    python3 keilstub.py ohx51 A_H_5_24.OMF "HEXFILE (A_H_5_24.hex)"
+
+The object file holds the DEFINE() values and a hash of the preprocessed
+source, so outputs change exactly when a real build would change. Like
+the real linker LX51 reports 1 warning in its map file. Set
+KEILSTUB_DELAY to the seconds every call should take.
+'''
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "cycles"))
+from preprocessor import Preprocessor, PreprocessorError
+
+controlPattern = re.compile(r"(\w+)\s*\((.*)\)")
+
+def controls(arguments):
+    '''
+    Split "NAME(value) " arguments into (NAME, value) pairs.
+    '''
+    for argument in arguments:
+        for word in re.findall(r"\w+\s*\([^)]*\)|\S+", argument):
+            match = controlPattern.fullmatch(word)
+            if match:
+                yield match.group(1).upper(), match.group(2).strip()
+
+            else:
+                yield word.upper(), None
+
+def ax51(arguments):
+    source = arguments[0]
+    defines = {}
+    includeDirs = []
+    output = os.path.splitext(source)[0] + ".OBJ"
+    listing = os.path.splitext(output)[0] + ".LST"
+    for name, value in controls(arguments[1:]):
+        if name == "DEFINE":
+            symbol, _, number = value.partition("=")
+            defines[symbol.strip()] = int(number or 1)
+
+        elif name == "INCDIR":
+            includeDirs.extend(value.split(";"))
+
+        elif name == "OBJECT":
+            output = value
+
+        elif name == "PRINT":
+            listing = value
+
+    preprocessor = Preprocessor(defines, includeDirs)
+    digest = hashlib.sha256()
+    try:
+        for statement in preprocessor.run(source):
+            digest.update(statement.line.code.encode() + b"\n")
+
+    except (PreprocessorError, OSError) as e:
+        with open(listing, 'w') as file:
+            file.write("AX51 STUB\n\n%s\n*** ERROR #1 IN %d (%s): %s\n\n1 ERROR(S)\n" %
+                       (source, getattr(e, "number", None) or 0, getattr(e, "path", None) or source,
+                        getattr(e, "message", e)))
+
+        return 2
+
+    with open(output, 'w') as file:
+        json.dump({"defines": defines, "source": digest.hexdigest()}, file, sort_keys=True)
+
+    with open(listing, 'w') as file:
+        file.write("AX51 STUB\n\nASSEMBLY COMPLETE. 0 WARNING(S), 0 ERROR(S).\n")
+
+    return 0
+
+def lx51(arguments):
+    source = arguments[0]
+    output = arguments[2] if len(arguments) > 2 and arguments[1].upper() == "TO" else \
+        os.path.splitext(source)[0]
+    with open(source, 'rb') as file:
+        content = file.read()
+
+    with open(output, 'wb') as file:
+        file.write(b"OMF STUB\n" + content)
+
+    mapPath = os.path.join(os.path.dirname(output), os.path.basename(os.path.splitext(output)[0]).upper() + ".MAP")
+    with open(mapPath, 'w') as file:
+        file.write("LX51 STUB\n\n*** WARNING L16: UNCALLED SEGMENT, IGNORED FOR OVERLAY PROCESS\n\n"
+                   "LINK/LOCATE RUN COMPLETE.  1 WARNING(S),  0 ERROR(S)\n")
+
+    return 1
+
+def hexRecord(address, kind, data):
+    record = bytes([len(data), address >> 8, address & 0xFF, kind]) + data
+    return ":%s%02X\n" % (record.hex().upper(), -sum(record) & 0xFF)
+
+def ohx51(arguments):
+    source = arguments[0]
+    output = os.path.splitext(source)[0] + ".hex"
+    for name, value in controls(arguments[1:]):
+        if name == "HEXFILE":
+            output = value
+
+    with open(source, 'rb') as file:
+        block = hashlib.sha256(file.read()).digest()
+
+    image = b""
+    while len(image) < 1024:
+        image += block
+        block = hashlib.sha256(block).digest()
+
+    with open(output, 'w') as file:
+        for address in range(0, len(image), 16):
+            file.write(hexRecord(address, 0, image[address:address + 16]))
+
+        file.write(hexRecord(0, 1, b""))
+
+    return 0
+
+tools = {"ax51": ax51, "lx51": lx51, "ohx51": ohx51}
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) < 2 or argv[0].lower() not in tools:
+        print("usage: keilstub.py {%s} ARGUMENTS..." % ",".join(sorted(tools)))
+        return 2
+
+    time.sleep(float(os.environ.get("KEILSTUB_DELAY", 0)))
+    return tools[argv[0].lower()](argv[1:])
+
+if __name__ == "__main__":
+    sys.exit(main())
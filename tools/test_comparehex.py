@@ -0,0 +1,28 @@
+'''
+Tests of the region lookup of comparehex.py:
+
+    cd tools && python3 -m unittest test_comparehex
+'''
+import unittest
+
+from comparehex import differences, regionsOf
+
+class RegionTest(unittest.TestCase):
+    def regions(self, key, addresses):
+        imageA = dict((address, 0x00) for address in addresses)
+        return [r.region for r in differences(imageA, {}, regionsOf(key))]
+
+    def testMelody(self):
+        # The melody is 140 bytes, its last bytes are not unused flash
+        self.assertEqual(self.regions("A_H_5_24", [0x1A70, 0x1AF5, 0x1AFB]), ["melody"] * 3)
+        self.assertEqual(self.regions("A_X_5_24", [0x3070, 0x30F5, 0x30FB]), ["melody"] * 3)
+
+    def testUnused(self):
+        self.assertEqual(self.regions("A_H_5_24", [0x1AFC]), ["unused"])
+        self.assertEqual(self.regions("A_X_5_24", [0x30FC]), ["unused"])
+
+    def testRangeSplitAtRegion(self):
+        self.assertEqual(self.regions("A_H_5_24", range(0x1AFA, 0x1AFE)), ["melody", "unused"])
+
+if __name__ == "__main__":
+    unittest.main()
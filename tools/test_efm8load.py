@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+#
+# This file is part of efm8load. efm8load is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+import os
+import tempfile
+import unittest
+
+from intelhex import IntelHex
+
+from efm8bench import synthetic_image
+from efm8emu import EFM8Emulator
+from efm8load import RESPONSE, EFM8Loader, ResponseError
+
+
+class LoaderTest(unittest.TestCase):
+    """Runs efm8load against an emulated bootloader"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.image = os.path.join(self.directory.name, "image.hex")
+        synthetic_image(self.image, 0x600)
+        self.emulator = EFM8Emulator()
+        self.emulator.open()
+
+    def tearDown(self):
+        self.emulator.close()
+        self.directory.cleanup()
+
+    def loader(self, **options):
+        return EFM8Loader(self.emulator.port, 115200, output=lambda message, end: None, **options)
+
+    def flashed(self):
+        ih = IntelHex(self.image)
+        return all(self.emulator.flash[address] == ih[address] for address in ih.addresses())
+
+    def test_upload_after_reset(self):
+        with self.loader() as loader:
+            loader.upload(self.image)
+            loader.send_reset()
+            self.emulator.flash[:] = b"\xFF" * len(self.emulator.flash)
+            loader.upload(self.image)
+        self.assertTrue(self.flashed())
+
+    def test_erase_error(self):
+        with self.loader() as loader:
+            loader.identify()
+            last_page = self.emulator.flash_size // self.emulator.page_size - 1
+            with self.assertRaises(ResponseError) as context:
+                loader.erase_page(last_page)
+            self.assertEqual(context.exception.address, last_page * self.emulator.page_size)
+
+    def test_pipelined_write_error(self):
+        with self.loader(pipeline=4) as loader:
+            loader.identify()
+            chunks = [(0x0000, b"\x55" * 64), (self.emulator.protected, b"\x55" * 64),
+                      (0x0040, b"\x55" * 64), (0x0080, b"\x55" * 64)]
+            with self.assertRaises(ResponseError) as context:
+                loader.write_chunks(chunks)
+            self.assertEqual(context.exception.address, self.emulator.protected)
+            #the replies of the frames sent after the failing one must not be taken for this one
+            self.assertEqual(loader.verify(0x0000, b"\x00"), RESPONSE.CRC_ERROR)
+
+if __name__ == "__main__":
+    unittest.main()